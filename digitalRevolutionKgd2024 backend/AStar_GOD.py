@@ -1,34 +1,44 @@
-import networkx as nx
-from queue import PriorityQueue
+import heapq
+import math
+import numpy as np
 
+import Metrics
+from RoutingGraph import RoutingGraph
+
+
+def _finish_search(algorithm, settled, stats):
+    # Число раскрытых узлов - в stats вызывающего и в метрики (Metrics.record_search)
+    if stats is not None:
+        stats["settled"] = settled
+    if Metrics.enabled:
+        Metrics.record_search(algorithm, settled)
+
+
+def dijkstra(graph, start, goal, forbidden_nodes=None, stats=None):
+    graph = RoutingGraph.ensure(graph)
+    index = graph.index
 
-def dijkstra(graph, start, goal, forbidden_nodes=None):
     if forbidden_nodes is None:
         forbidden_nodes = set()
     else:
-        forbidden_nodes = set(forbidden_nodes)
-
-    # Инициализация
-    distances = {node: float('inf') for node in graph.nodes}
-    distances[start] = 0
+        forbidden_nodes = {index[node] for node in forbidden_nodes if node in index}
 
-    pq = PriorityQueue()
-    pq.put((0, start))
+    # Инициализация: расстояния и предки хранятся только для достигнутых узлов
+    source = index[start]
+    target = index[goal]
+    offsets, targets, weights = graph.adjacency()
+    distances = {source: 0}
+    predecessors = {source: -1}
 
-    predecessors = {node: None for node in graph.nodes}
+    pq = [(0, source)]
     visited = set()
 
-    while not pq.empty():
-        current_distance, current_node = pq.get()
+    while pq:
+        current_distance, current_node = heapq.heappop(pq)
 
-        if current_node == goal:
-            # Восстанавливаем путь
-            path = []
-            while current_node is not None:
-                path.append(current_node)
-                current_node = predecessors[current_node]
-            path.reverse()
-            return distances[goal], path
+        if current_node == target:
+            _finish_search("dijkstra", len(visited), stats)
+            return distances[target], _restore_path(graph, predecessors, target)
 
         if current_node in visited or current_node in forbidden_nodes:
             continue
@@ -36,49 +46,273 @@ def dijkstra(graph, start, goal, forbidden_nodes=None):
         visited.add(current_node)
 
         # Проверяем всех соседей
-        for neighbor in graph.neighbors(current_node):
+        current_distance = distances[current_node]
+        for k in range(offsets[current_node], offsets[current_node + 1]):
+            neighbor = targets[k]
             if neighbor in forbidden_nodes:
                 continue
 
-            edge_weight = graph[current_node][neighbor]['weight']
-            new_distance = distances[current_node] + edge_weight
+            new_distance = current_distance + weights[k]
 
-            if new_distance < distances[neighbor]:
+            if new_distance < distances.get(neighbor, float('inf')):
                 distances[neighbor] = new_distance
-                pq.put((new_distance, neighbor))
+                heapq.heappush(pq, (new_distance, neighbor))
                 predecessors[neighbor] = current_node
 
+    _finish_search("dijkstra", len(visited), stats)
     return float('inf'), []
 
 
-def find_alternative_paths(graph, start, goal, num_paths=3):
-    paths = []
-    forbidden_nodes = set()
+def _restore_path(graph, predecessors, node):
+    # Восстанавливаем путь по предкам, -1 - начало пути
+    path = []
+    while node != -1:
+        path.append(graph.node_ids[node])
+        node = predecessors[node]
+    path.reverse()
+    return path
+
+
+def euclidean_heuristic(graph):
+    """
+    Расстояние по прямой до цели (координаты pos в метрах EPSG:3857)
+
+    Из расстояния вычитается запас цели (RoutingGraph.heuristic_slack): рёбра
+    от дорог к зданиям короче прямой, и без поправки эвристика переоценивала бы
+    путь до здания.
+
+    Returns:
+        function: h(u, goal) для номеров узлов
+    """
+    coords = graph.coordinates()
+    slack = graph.heuristic_slack()
+
+    def heuristic(u, goal):
+        h = math.hypot(coords[2 * u] - coords[2 * goal], coords[2 * u + 1] - coords[2 * goal + 1]) - slack[goal]
+        return h if h > 0 else 0.0
+
+    return heuristic
+
+
+def astar(graph, start, goal, heuristic=None, forbidden_nodes=None, stats=None, weights=None):
+    """
+    Поиск A* от start до goal
+
+    Args:
+        graph: RoutingGraph или nx.Graph
+        start, goal: str - id узлов
+        heuristic: function h(u, goal) для номеров узлов; по умолчанию euclidean_heuristic.
+            Эвристика должна быть допустимой (не переоценивать расстояние)
+        forbidden_nodes: узлы, через которые нельзя проходить
+        stats: dict - если передан, в stats["settled"] пишется число раскрытых узлов
+        weights: веса полурёбер вместо graph.weights (например, со штрафами).
+            Эвристика по умолчанию допустима, пока веса не меньше исходных
+
+    Returns:
+        tuple: (distance, path) как у dijkstra; distance считается по weights
+    """
+    graph = RoutingGraph.ensure(graph)
+    index = graph.index
+    if heuristic is None:
+        heuristic = euclidean_heuristic(graph)
+
+    if forbidden_nodes is None:
+        forbidden_nodes = set()
+    else:
+        forbidden_nodes = {index[node] for node in forbidden_nodes if node in index}
+
+    source = index[start]
+    target = index[goal]
+    if weights is None:
+        offsets, targets, weights = graph.adjacency()
+    else:
+        offsets, targets, _ = graph.adjacency()
+    distances = {source: 0}
+    predecessors = {source: -1}
+
+    pq = [(heuristic(source, target), 0, source)]
+    settled = 0
+
+    while pq:
+        estimate, current_distance, current_node = heapq.heappop(pq)
+
+        # Устаревшая запись: узел уже достигнут более коротким путём
+        if current_distance > distances[current_node]:
+            continue
+
+        if current_node == target:
+            _finish_search("astar", settled, stats)
+            return current_distance, _restore_path(graph, predecessors, target)
+
+        if current_node in forbidden_nodes:
+            continue
+
+        settled += 1
+
+        for k in range(offsets[current_node], offsets[current_node + 1]):
+            neighbor = targets[k]
+            if neighbor in forbidden_nodes:
+                continue
 
-    for i in range(num_paths):
-        # Ищем кратчайший путь с текущими запрещенными узлами
-        distance, path = dijkstra(graph, start, goal, forbidden_nodes)
+            new_distance = current_distance + weights[k]
 
-        if not path:
-            # Если путь не найден, пробуем разблокировать узлы
-            temp_forbidden = forbidden_nodes.copy()
-            found_path = False
+            if new_distance < distances.get(neighbor, float('inf')):
+                distances[neighbor] = new_distance
+                predecessors[neighbor] = current_node
+                heapq.heappush(pq, (new_distance + heuristic(neighbor, target), new_distance, neighbor))
+
+    _finish_search("astar", settled, stats)
+    return float('inf'), []
 
-            for node in list(forbidden_nodes):
-                temp_forbidden.remove(node)
-                distance, path = dijkstra(graph, start, goal, temp_forbidden)
-                if path:
-                    forbidden_nodes = temp_forbidden
-                    found_path = True
-                    break
 
-            if not found_path:
-                break
+def bidirectional_dijkstra(graph, start, goal, forbidden_nodes=None, stats=None):
+    """
+    Двунаправленная Дейкстра: поиски от start и от goal идут навстречу друг другу
+
+    Поиск останавливается, когда сумма минимальных расстояний в обеих очередях
+    становится не меньше лучшего найденного пути через точку встречи.
+
+    Returns:
+        tuple: (distance, path) как у dijkstra
+    """
+    graph = RoutingGraph.ensure(graph)
+    index = graph.index
+
+    if forbidden_nodes is None:
+        forbidden_nodes = set()
+    else:
+        forbidden_nodes = {index[node] for node in forbidden_nodes if node in index}
+
+    source = index[start]
+    target = index[goal]
+    if source == target:
+        _finish_search("bidirectional", 0, stats)
+        return 0, [start]
+
+    offsets, targets, weights = graph.adjacency()
+    # Индекс 0 - прямой поиск от start, 1 - обратный от goal
+    distances = ({source: 0}, {target: 0})
+    predecessors = ({source: -1}, {target: -1})
+    queues = ([(0, source)], [(0, target)])
+    visited = (set(), set())
+    if source in forbidden_nodes or target in forbidden_nodes:
+        queues = ([], [])
+
+    best = float('inf')
+    meeting_node = -1
+
+    while queues[0] and queues[1]:
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+
+        # Расширяем ту сторону, у которой меньше фронт
+        side = 0 if len(queues[0]) <= len(queues[1]) else 1
+        current_distance, current_node = heapq.heappop(queues[side])
+        if current_node in visited[side] or current_node in forbidden_nodes:
+            continue
+        visited[side].add(current_node)
+
+        own = distances[side]
+        other = distances[1 - side]
+        current_distance = own[current_node]
+        for k in range(offsets[current_node], offsets[current_node + 1]):
+            neighbor = targets[k]
+            if neighbor in forbidden_nodes:
+                continue
+
+            new_distance = current_distance + weights[k]
+            if new_distance < own.get(neighbor, float('inf')):
+                own[neighbor] = new_distance
+                predecessors[side][neighbor] = current_node
+                heapq.heappush(queues[side], (new_distance, neighbor))
+
+            # Фронты встретились - запоминаем лучший путь через эту точку
+            if neighbor in other and own[neighbor] + other[neighbor] < best:
+                best = own[neighbor] + other[neighbor]
+                meeting_node = neighbor
+
+    _finish_search("bidirectional", len(visited[0]) + len(visited[1]), stats)
+    if meeting_node < 0:
+        return float('inf'), []
+
+    path = _restore_path(graph, predecessors[0], meeting_node)
+    node = predecessors[1][meeting_node]
+    while node != -1:
+        path.append(graph.node_ids[node])
+        node = predecessors[1][node]
+    return best, path
+
+
+def multi_source_dijkstra(graph, sources, weights=None):
+    """
+    Один проход Дейкстры сразу от всех источников (например, от всех школ)
+
+    Каждый узел получает ближайший источник, расстояние до него и предка на пути
+    к этому источнику. При равных расстояниях выигрывает источник, который стоит
+    раньше в списке sources.
+
+    Args:
+        graph: RoutingGraph или nx.Graph
+        sources: list - строковые id источников
+        weights: веса полурёбер вместо graph.weights; inf - ребро закрыто
+
+    Returns:
+        tuple: (distances, nearest, predecessors) - массивы длины graph.num_nodes.
+            nearest и predecessors содержат номера узлов, -1 - если узел недостижим
+            (для самих источников predecessors тоже -1)
+    """
+    graph = RoutingGraph.ensure(graph)
+    if weights is None:
+        offsets, targets, weights = graph.adjacency()
+    else:
+        offsets, targets, _ = graph.adjacency()
+
+    distances = {}
+    rank = {}
+    nearest = {}
+    predecessors = {}
+    pq = []
+    for i, node in enumerate(sources):
+        source = graph.index[node]
+        if source in distances:
+            continue
+        distances[source] = 0
+        rank[source] = i
+        nearest[source] = source
+        predecessors[source] = -1
+        pq.append((0, i, source))
+    heapq.heapify(pq)
+
+    visited = set()
+    while pq:
+        current_distance, current_rank, current_node = heapq.heappop(pq)
+        if current_node in visited:
+            continue
+        visited.add(current_node)
+
+        label = nearest[current_node]
+        for k in range(offsets[current_node], offsets[current_node + 1]):
+            neighbor = targets[k]
+            new_distance = current_distance + weights[k]
+            old_distance = distances.get(neighbor, float('inf'))
+
+            # При равенстве расстояний оставляем источник с меньшим номером
+            if new_distance < old_distance or (new_distance == old_distance and current_rank < rank.get(neighbor, -1)):
+                distances[neighbor] = new_distance
+                rank[neighbor] = current_rank
+                nearest[neighbor] = label
+                predecessors[neighbor] = current_node
+                heapq.heappush(pq, (new_distance, current_rank, neighbor))
+    _finish_search("multi_source", len(visited), None)
 
-        if path:
-            paths.append(path)
-            print(f"Путь{i} - {distance}")
-            # Добавляем промежуточные узлы в запрещенные
-            forbidden_nodes.update(path[1:-1])
+    n = graph.num_nodes
+    distance_array = np.full(n, np.inf)
+    nearest_array = np.full(n, -1, dtype=np.int32)
+    predecessor_array = np.full(n, -1, dtype=np.int32)
+    if distances:
+        reached = np.fromiter(distances.keys(), dtype=np.int64, count=len(distances))
+        distance_array[reached] = np.fromiter(distances.values(), dtype=np.float64, count=len(distances))
+        nearest_array[reached] = [nearest[node] for node in distances]
+        predecessor_array[reached] = [predecessors[node] for node in distances]
+    return distance_array, nearest_array, predecessor_array
 
-    return paths
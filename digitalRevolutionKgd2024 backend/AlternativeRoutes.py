@@ -0,0 +1,117 @@
+import numpy as np
+
+import AStar_GOD
+from RoutingGraph import RoutingGraph
+
+# Параметры поиска по умолчанию; от них зависят маршруты в RouteCache
+K_ROUTES = 3
+MAX_OVERLAP = 0.7
+MAX_DETOUR = 1.5
+PENALTY = 2.0
+
+
+def k_alternative_paths(graph, start, goal, k=K_ROUTES, max_overlap=MAX_OVERLAP, max_detour=MAX_DETOUR,
+                        penalty=PENALTY, max_searches=None, blocked=None, stats=None):
+    """
+    Ищет до k различных маршрутов методом штрафов на рёбра
+
+    После каждого поиска веса рёбер найденного маршрута умножаются на penalty,
+    и следующий поиск A* уходит в сторону. Маршрут принимается, если его реальная
+    длина не больше max_detour * длина кратчайшего и он пересекается с каждым уже
+    принятым маршрутом не больше чем на max_overlap своей длины.
+
+    Args:
+        graph: RoutingGraph или nx.Graph
+        start, goal: str - id узлов
+        k: int - сколько маршрутов нужно
+        max_overlap: float - допустимая доля общей длины с уже принятым маршрутом
+        max_detour: float - допустимое отношение длины к кратчайшему маршруту
+        penalty: float - множитель веса рёбер найденного маршрута
+        max_searches: int - предел числа поисков (по умолчанию 3 * k)
+        blocked: iterable - номера рёбер, по которым ходить нельзя (закрытые дороги)
+        stats: dict - если передан, в stats["edges"] пишутся номера рёбер всех найденных
+            поисками маршрутов, в том числе отклонённых (их рёбра тоже штрафовались),
+            а в stats["reach"] - наибольшая длина найденного маршрута с учётом штрафов.
+            Поиски найдут те же маршруты, пока эти рёбра не изменились, а новые пути не
+            короче reach (так RouteCache решает, устарела ли запись)
+
+    Returns:
+        list: маршруты (списки id узлов) по возрастанию длины, кратчайший первый.
+            Маршрутов может быть меньше k, если подходящих объездов нет
+    """
+    graph = RoutingGraph.ensure(graph)
+    if max_searches is None:
+        max_searches = 3 * k
+
+    base = graph.weights
+    penalized = base.astype(np.float64)
+    blocked = list(blocked) if blocked is not None else []
+    if blocked:
+        penalized[graph.half_edges(blocked).ravel()] = np.inf
+    edge_length = np.zeros(graph.num_edges)
+    edge_length[graph.edge_index] = base
+
+    heuristic = AStar_GOD.euclidean_heuristic(graph)
+    shortest, path = AStar_GOD.astar(graph, start, goal, heuristic,
+                                     weights=memoryview(penalized) if blocked else None)
+    if stats is not None:
+        stats["edges"] = set()
+        stats["reach"] = 0.0
+    if not path:
+        return []
+    if len(path) == 1:
+        return [path]
+
+    accepted = [(shortest, path, _edge_set(graph, path))]
+    candidate_edges = accepted[0][2]
+    seen = {tuple(path)}
+    if stats is not None:
+        stats["edges"].update(candidate_edges)
+        stats["reach"] = shortest
+
+    for _ in range(max_searches - 1):
+        if len(accepted) >= k:
+            break
+
+        # Штрафуем рёбра последнего найденного маршрута в обе стороны
+        halves = graph.half_edges(list(candidate_edges))
+        penalized[halves[:, 0]] *= penalty
+        penalized[halves[:, 1]] *= penalty
+
+        weighted, path = AStar_GOD.astar(graph, start, goal, heuristic, weights=memoryview(penalized))
+        if not path:
+            break
+        candidate_edges = _edge_set(graph, path)
+        if stats is not None:
+            stats["edges"].update(candidate_edges)
+            stats["reach"] = max(stats["reach"], weighted)
+        if tuple(path) in seen:
+            continue
+        seen.add(tuple(path))
+
+        length = _path_length(edge_length, graph, path)
+        if length > max_detour * shortest:
+            continue
+        if all(_overlap(edge_length, candidate_edges, edges, length) <= max_overlap for _, _, edges in accepted):
+            accepted.append((length, path, candidate_edges))
+
+    accepted.sort(key=lambda item: item[0])
+    return [path for _, path, _ in accepted]
+
+
+def _edge_set(graph, path):
+    return set(graph.path_edges(path))
+
+
+def _path_length(edge_length, graph, path):
+    return float(edge_length[graph.path_edges(path)].sum())
+
+
+def _overlap(edge_length, edges, other_edges, length):
+    # Доля длины маршрута, проходящая по рёбрам другого маршрута
+    shared = edges & other_edges
+    if not shared:
+        return 0.0
+    if length <= 0:
+        return 1.0
+    return float(edge_length[list(shared)].sum()) / length
@@ -0,0 +1,261 @@
+import argparse
+import json
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+import FacilityIndex
+import GraphSnapshot
+import Main_alko
+from RoutingGraph import RoutingGraph
+
+# Функция задержки BPR: t = t0 * (1 + BPR_ALPHA * (поток / пропускная способность) ** BPR_BETA)
+BPR_ALPHA = 0.15
+BPR_BETA = 4
+
+# Пропускная способность пешеходной части: человек на метр ширины за период симуляции
+PEDESTRIANS_PER_METER = 1500
+
+# Ширина пешеходной части (м) по категории дороги, если в слое нет Width
+WALKWAY_WIDTH = {
+    "Пешеходные дорожки": 2.0,
+    "Внутриквартальные проезды": 1.5,
+    "Дороги минимальной значимости": 1.5,
+    "Прочие улицы города": 3.0,
+    "Основные улицы города": 4.0,
+    "Магистральные улицы города": 6.0,
+}
+DEFAULT_WALKWAY_WIDTH = 2.0
+# У улиц Width - ширина проезжей части; на тротуары приходится такая доля от неё
+SIDEWALK_SHARE = 0.5
+# Дорога без пешеходного движения (Foot = 0): идти можно только по обочине
+FOOTLESS_WIDTH = 0.5
+
+# Нулевые веса рёбер склейки заменяются на этот, чтобы csgraph не принял их за отсутствие ребра
+MIN_COST = 1e-9
+
+
+def walkway_width(attrs):
+    """
+    Ширина пешеходной части ребра по road_type, is_footpath и width
+
+    Returns:
+        float: метры; inf - ребро без ограничения (связи зданий, склейки концов дорог)
+    """
+    road_type = attrs.get("road_type")
+    if road_type is None or road_type == "building_connection":
+        return np.inf
+    if not attrs.get("is_footpath", True):
+        return FOOTLESS_WIDTH
+    width = attrs.get("width")
+    if width is None or not width > 0:
+        return WALKWAY_WIDTH.get(road_type, DEFAULT_WALKWAY_WIDTH)
+    if road_type == "Пешеходные дорожки":
+        return width
+    return width * SIDEWALK_SHARE
+
+
+def edge_capacities(edges, per_meter=PEDESTRIANS_PER_METER):
+    """
+    Пропускная способность рёбер
+
+    Args:
+        edges: iterable - словари атрибутов рёбер в порядке G.edges (номера рёбер RoutingGraph)
+        per_meter: float - человек на метр ширины пешеходной части
+
+    Returns:
+        np.ndarray[float64]: по номеру ребра; inf - без ограничения
+    """
+    return np.array([walkway_width(attrs) for attrs in edges], dtype=np.float64) * per_meter
+
+
+def bpr_costs(free_flow, flows, capacities, alpha=BPR_ALPHA, beta=BPR_BETA):
+    """Время прохода рёбер при потоках flows (функция BPR); рёбра с inf пропускной способностью не тормозят"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(np.isinf(capacities), 0.0, flows / capacities)
+    return free_flow * (1 + alpha * ratio ** beta)
+
+
+def building_demand(graph, population_data, facilities, params=None):
+    """
+    Спрос: сколько жителей каждого здания идут к ближайшему объекту каждой цели
+
+    Число жителей - математическое ожидание розыгрыша Main_alko: население,
+    умноженное на вероятность цели (purpose_probabilities). Все 70/20/10
+    маршрутов заменяет равновесное распределение, поэтому здесь только цели.
+
+    Returns:
+        tuple: (origins, destinations, flows) - номера узлов зданий и объектов и число жителей
+    """
+    if params is None:
+        params = Main_alko.simulation_params()
+    buildings = np.array([graph.index[b] for b in graph.typed_nodes()], dtype=np.int64)
+    population = np.array([float(population_data.get(graph.node_ids[b], 0)) for b in buildings])
+    near = Main_alko.purpose_probabilities(0.0, params)
+    far = Main_alko.purpose_probabilities(np.inf, params)
+    metro_near = facilities["metro"].distances[buildings] < params["metro_distance"]
+    probabilities = np.where(metro_near[:, None], near, far)
+
+    origins, destinations, flows = [], [], []
+    for k, purpose in enumerate(Main_alko.PURPOSES):
+        nearest = facilities[purpose].nearest[buildings]
+        valid = (nearest >= 0) & (population > 0) & (nearest != buildings)
+        origins.append(buildings[valid])
+        destinations.append(nearest[valid].astype(np.int64))
+        flows.append(population[valid] * probabilities[valid, k])
+    return np.concatenate(origins), np.concatenate(destinations), np.concatenate(flows)
+
+
+class AssignmentGraph:
+    """
+    RoutingGraph в виде матрицы CSR для scipy.sparse.csgraph и таблица полуребро -> ребро
+
+    Граф неориентированный, и время ребра одинаково в обе стороны, поэтому
+    кратчайшие пути ищутся деревьями от объектов (их мало), а не от зданий.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.num_nodes = graph.num_nodes
+        self.sources = np.repeat(np.arange(graph.num_nodes, dtype=np.int64), np.diff(graph.offsets))
+        self.targets = graph.targets.astype(np.int64)
+        keys = self.sources * self.num_nodes + self.targets
+        self.key_order = np.argsort(keys)
+        self.sorted_keys = keys[self.key_order]
+        halves = graph.half_edges(np.arange(graph.num_edges))
+        self.free_flow = graph.weights[halves[:, 0]].astype(np.float64)
+
+    def edges_between(self, u, v):
+        """Номера рёбер для массивов концов u, v"""
+        keys = np.asarray(u, dtype=np.int64) * self.num_nodes + np.asarray(v, dtype=np.int64)
+        position = np.searchsorted(self.sorted_keys, keys)
+        return self.graph.edge_index[self.key_order[position]]
+
+    def all_or_nothing(self, costs, origins, destinations, flows, batch=64):
+        """
+        Весь спрос по кратчайшим путям при временах рёбер costs
+
+        Деревья кратчайших путей строятся пачками по batch объектов одним вызовом
+        csgraph.dijkstra, затем все пары (здание, объект) пачки одновременно
+        идут по указателям предков к корню, и поток добавляется к рёбрам
+        пачки одним bincount.
+
+        Returns:
+            np.ndarray[float64]: поток по номеру ребра
+        """
+        matrix = csr_matrix((np.maximum(costs[self.graph.edge_index], MIN_COST), self.graph.targets,
+                             self.graph.offsets), shape=(self.num_nodes, self.num_nodes))
+        loads = np.zeros(self.graph.num_edges)
+        roots, pair_roots = np.unique(destinations, return_inverse=True)
+        for start in range(0, len(roots), batch):
+            chunk = roots[start:start + batch]
+            _, predecessors = dijkstra(matrix, directed=True, indices=chunk, return_predecessors=True)
+            in_chunk = (pair_roots >= start) & (pair_roots < start + len(chunk))
+            rows = pair_roots[in_chunk] - start
+            current = origins[in_chunk]
+            flow = flows[in_chunk]
+            edges, edge_flows = [], []
+            while len(current):
+                previous = predecessors[rows, current]
+                moving = previous >= 0
+                rows, current, previous, flow = rows[moving], current[moving], previous[moving], flow[moving]
+                edges.append(self.edges_between(previous, current))
+                edge_flows.append(flow)
+                current = previous
+            if edges:
+                loads += np.bincount(np.concatenate(edges), weights=np.concatenate(edge_flows),
+                                     minlength=self.graph.num_edges)
+        return loads
+
+
+def frank_wolfe(graph, capacities, origins, destinations, flows, method="fw", max_iterations=50, gap=1e-3,
+                alpha=BPR_ALPHA, beta=BPR_BETA, batch=64):
+    """
+    Равновесное распределение потоков (по Вардропу) с задержкой BPR
+
+    Каждая итерация: времена рёбер при текущих потоках, распределение всего
+    спроса по кратчайшим путям (all_or_nothing), шаг к нему. Шаг - линейный
+    поиск Франка-Вульфа (method="fw") или 1 / (k + 1) метода последовательных
+    средних (method="msa"). Остановка - когда относительный разрыв
+    (t·x - t·y) / t·x меньше gap.
+
+    Args:
+        graph: RoutingGraph
+        capacities: np.ndarray - пропускная способность по номеру ребра (edge_capacities)
+        origins, destinations, flows: результат building_demand
+
+    Returns:
+        dict: loads - поток по номеру ребра, costs - времена рёбер, gaps - разрыв по итерациям
+    """
+    network = AssignmentGraph(graph)
+    free_flow = network.free_flow
+    loads = network.all_or_nothing(free_flow, origins, destinations, flows, batch)
+    gaps = []
+    for iteration in range(1, max_iterations + 1):
+        costs = bpr_costs(free_flow, loads, capacities, alpha, beta)
+        target = network.all_or_nothing(costs, origins, destinations, flows, batch)
+        total = float(costs @ loads)
+        relative_gap = (total - float(costs @ target)) / total if total > 0 else 0.0
+        gaps.append(relative_gap)
+        if relative_gap < gap:
+            break
+        direction = target - loads
+        if method == "msa":
+            step = 1.0 / (iteration + 1)
+        else:
+            step = _line_search(free_flow, loads, direction, capacities, alpha, beta)
+        loads = loads + step * direction
+    return {
+        "loads": loads,
+        "costs": bpr_costs(free_flow, loads, capacities, alpha, beta),
+        "gaps": gaps,
+        "iterations": len(gaps),
+    }
+
+
+def _line_search(free_flow, loads, direction, capacities, alpha, beta, steps=30):
+    # Минимум целевой функции Бекмана на отрезке: корень её производной по шагу, бисекцией
+    low, high = 0.0, 1.0
+    for _ in range(steps):
+        middle = (low + high) / 2
+        if bpr_costs(free_flow, loads + middle * direction, capacities, alpha, beta) @ direction > 0:
+            high = middle
+        else:
+            low = middle
+    return (low + high) / 2
+
+
+def equilibrium_loads(G, population_data=None, params=None, **kwargs):
+    """
+    Равновесная нагрузка для графа networkx: пропускная способность из атрибутов
+    рёбер, объекты - ближайшие по длине (FacilityIndex)
+
+    Args:
+        population_data: dict - id здания -> население (None - Main_alko.load_population)
+
+    Returns:
+        tuple: (RoutingGraph, результат frank_wolfe)
+    """
+    graph = RoutingGraph.from_networkx(G)
+    if population_data is None:
+        population_data = Main_alko.load_population(graph)
+    capacities = edge_capacities(attrs for _, _, attrs in G.edges(data=True))
+    facilities = FacilityIndex.label_nearest_facilities(graph)
+    origins, destinations, flows = building_demand(graph, population_data, facilities, params)
+    return graph, frank_wolfe(graph, capacities, origins, destinations, flows, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Равновесное распределение жителей по дорогам с учётом пропускной способности")
+    parser.add_argument("--method", choices=["fw", "msa"], default="fw")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--gap", type=float, default=1e-3)
+    parser.add_argument("--output", default="trafic_equilibrium.json")
+    args = parser.parse_args()
+
+    R, result = equilibrium_loads(GraphSnapshot.load_networkx(), method=args.method,
+                                  max_iterations=args.iterations, gap=args.gap)
+    print(f"Итераций: {result['iterations']}, относительный разрыв: {result['gaps'][-1]:.2e}")
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(R.loads_by_id(np.rint(result["loads"]).astype(np.int64)), file, ensure_ascii=False, indent=4)
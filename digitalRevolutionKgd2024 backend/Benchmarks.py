@@ -0,0 +1,455 @@
+import argparse
+import json
+import pickle
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource  # есть только на Unix: пиковый RSS процесса
+except ImportError:
+    resource = None
+
+import networkx as nx
+import numpy as np
+import shapely
+import shapely.geometry
+
+import AStar_GOD
+import FacilityIndex
+import Graph
+import GraphSnapshot
+import Main_alko
+import SyntheticCity
+import parse_geo
+from GeojsonService import GeojsonService
+from IncrementalGraph import GraphState
+from RoutingGraph import RoutingGraph
+
+# Этапы обработки загрузки в порядке выполнения (benchmark_pipeline)
+PIPELINE_STAGES = ("ingest", "filter", "graph", "routing", "simulation", "classification")
+
+
+def facility_pairs(graph, count, seed=0):
+    """
+    Пары (здание, ближайший объект) - такие запросы делает find_alternative_paths
+
+    Returns:
+        list[tuple]: пары строковых id
+    """
+    rng = random.Random(seed)
+    labels = FacilityIndex.label_nearest_facilities(graph)
+    buildings = graph.typed_nodes()
+    pairs = []
+    while buildings and len(pairs) < count:
+        building = rng.choice(buildings)
+        facility, distance = labels[rng.choice(FacilityIndex.FACILITY_TYPES)].lookup(building)
+        if facility is not None:
+            pairs.append((building, facility))
+    return pairs
+
+
+def benchmark_point_to_point(graph, pairs):
+    """
+    Сравнивает dijkstra, astar и bidirectional_dijkstra на одних и тех же запросах
+
+    Returns:
+        dict: алгоритм -> {settled_mean, latency_ms_mean, latency_ms_p95, mismatches}.
+            mismatches - число запросов, где длина пути разошлась с dijkstra
+    """
+    algorithms = {
+        "dijkstra": AStar_GOD.dijkstra,
+        "astar": AStar_GOD.astar,
+        "bidirectional": AStar_GOD.bidirectional_dijkstra,
+    }
+    results = {}
+    reference = {}
+    for name, search in algorithms.items():
+        settled = []
+        latency = []
+        mismatches = 0
+        for pair in pairs:
+            stats = {}
+            started = time.perf_counter()
+            distance, path = search(graph, pair[0], pair[1], stats=stats)
+            latency.append((time.perf_counter() - started) * 1000)
+            settled.append(stats["settled"])
+            if name == "dijkstra":
+                reference[pair] = distance
+            elif abs(distance - reference[pair]) > 1e-6 * max(1.0, distance):
+                mismatches += 1
+        results[name] = {
+            "settled_mean": float(np.mean(settled)),
+            "latency_ms_mean": float(np.mean(latency)),
+            "latency_ms_p95": float(np.percentile(latency, 95)),
+            "mismatches": mismatches,
+        }
+    return results
+
+
+def tile_layers(buildings_geojson, roads_geojson, copies):
+    """
+    Размножает слои сеткой сдвинутых копий, чтобы получить город нужного размера
+
+    Копии не пересекаются, id объектов перенумерованы.
+
+    Returns:
+        tuple: (buildings_geojson, roads_geojson)
+    """
+    geometries = Graph.layer_geometries(buildings_geojson)
+    bounds = np.array([0.0, 0.0, 0.0, 0.0])
+    if len(geometries):
+        xmin, ymin, xmax, ymax = shapely.total_bounds(np.concatenate([geometries,
+                                                      Graph.layer_geometries(roads_geojson)]))
+        bounds = np.array([xmin, ymin, xmax, ymax])
+    step = max(bounds[2] - bounds[0], bounds[3] - bounds[1]) + 1000
+    side = int(np.ceil(np.sqrt(copies)))
+
+    def tile(layer):
+        features = []
+        source = Graph.layer_features(layer)
+        geometries = Graph.layer_geometries(layer)
+        for copy in range(copies):
+            offset = np.array([copy % side, copy // side]) * step
+            shifted = shapely.transform(geometries, lambda coords: coords + offset)
+            for feature, geometry in zip(source, shifted):
+                features.append({
+                    "type": "Feature",
+                    "id": str(len(features)),
+                    "properties": feature["properties"],
+                    "geometry": shapely.geometry.mapping(geometry),
+                })
+        return {"type": "FeatureCollection", "features": features}
+
+    return tile(buildings_geojson), tile(roads_geojson)
+
+
+def _legacy_build_stages(buildings_geojson, roads_geojson):
+    # Прежние этапы create_road_network_graph: центроиды и cdist по одному зданию, попарный перебор точек дорог
+    timings = {}
+    road_points = {}
+    for feature in Graph.layer_features(roads_geojson):
+        road_points.update(Graph.add_road(nx.Graph(), feature))
+
+    started = time.perf_counter()
+    centroids = []
+    for feature in Graph.layer_features(buildings_geojson):
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            centroids.append(Graph.calculate_polygon_centroid(geometry["coordinates"]))
+        elif geometry["type"] == "MultiPolygon":
+            centroids.append(Graph.calculate_multipolygon_centroid(geometry["coordinates"]))
+        elif geometry["type"] == "Point":
+            centroids.append(tuple(geometry["coordinates"][:2]))
+    timings["centroids"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for centroid in centroids:
+        Graph.find_nearest_road_point(centroid, road_points)
+    timings["snapping"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    road_nodes = list(road_points.keys())
+    for i in range(len(road_nodes)):
+        for j in range(i + 1, len(road_nodes)):
+            np.linalg.norm(np.array(road_points[road_nodes[i]]) - np.array(road_points[road_nodes[j]]))
+    timings["merging"] = time.perf_counter() - started
+    return timings
+
+
+def benchmark_graph_build(buildings_geojson, roads_geojson, sizes=(1, 4, 16, 43), legacy=False):
+    """
+    Время Graph.create_road_network_graph на городах разного размера
+
+    Args:
+        sizes: число копий исходных слоёв (tile_layers); 43 копии graph_geojson - около 100 тыс. дорог
+        legacy: замерить прежние этапы на самом маленьком размере (перебор пар точек - квадратичный)
+
+    Returns:
+        list: для каждого размера {copies, roads, buildings, nodes, edges, seconds} и legacy_seconds
+    """
+    results = []
+    for copies in sizes:
+        buildings, roads = tile_layers(buildings_geojson, roads_geojson, copies)
+        started = time.perf_counter()
+        G = Graph.create_road_network_graph(buildings, roads)
+        result = {
+            "copies": copies,
+            "roads": len(roads["features"]),
+            "buildings": len(buildings["features"]),
+            "nodes": G.number_of_nodes(),
+            "edges": G.number_of_edges(),
+            "seconds": time.perf_counter() - started,
+        }
+        if legacy and copies == min(sizes):
+            result["legacy_seconds"] = _legacy_build_stages(buildings, roads)
+        results.append(result)
+    return results
+
+
+def _best_time(load, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        load()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def benchmark_graph_load(buildings_geojson, roads_geojson, sizes=(1, 16), repeats=3):
+    """
+    Время загрузки графа: pickle.load против снимка GraphSnapshot
+
+    Для каждого размера города замеряются pickle.load графа networkx, он же с
+    RoutingGraph.from_networkx (так граф раньше открывали Main_alko и Ensemble),
+    load_routing_graph и load_networkx из снимка. Берётся лучшее из repeats.
+
+    Returns:
+        list: для каждого размера {copies, nodes, edges, pickle_bytes, snapshot_bytes, seconds}
+    """
+    results = []
+    for copies in sizes:
+        G = Graph.create_road_network_graph(*tile_layers(buildings_geojson, roads_geojson, copies))
+        with tempfile.TemporaryDirectory() as directory:
+            pickle_path = os.path.join(directory, "graph.pkl")
+            snapshot_path = os.path.join(directory, "graph_snapshot")
+            with open(pickle_path, "wb") as f:
+                pickle.dump(G, f)
+            GraphSnapshot.save_snapshot(G, snapshot_path)
+
+            def load_pickle():
+                with open(pickle_path, "rb") as f:
+                    return pickle.load(f)
+
+            results.append({
+                "copies": copies,
+                "nodes": G.number_of_nodes(),
+                "edges": G.number_of_edges(),
+                "pickle_bytes": os.path.getsize(pickle_path),
+                "snapshot_bytes": sum(entry.stat().st_size for entry in os.scandir(snapshot_path)),
+                "seconds": {
+                    "pickle": _best_time(load_pickle, repeats),
+                    "pickle_routing_graph": _best_time(lambda: RoutingGraph.from_networkx(load_pickle()), repeats),
+                    "snapshot_routing_graph": _best_time(
+                        lambda: GraphSnapshot.load_routing_graph(snapshot_path), repeats),
+                    "snapshot_networkx": _best_time(lambda: GraphSnapshot.load_networkx(snapshot_path), repeats),
+                },
+            })
+    return results
+
+
+def _max_rss():
+    # Пиковый RSS процесса в байтах (ru_maxrss в Linux - в килобайтах); None, если не узнать
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _measure(stages, stage, run):
+    # Время этапа, пик памяти (tracemalloc) сверх занятой до начала этапа и пиковый RSS после него
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    result = run()
+    stages[stage] = {
+        "seconds": time.perf_counter() - started,
+        "peak_bytes": tracemalloc.get_traced_memory()[1] - before if tracing else None,
+        "max_rss_bytes": _max_rss(),
+    }
+    return result
+
+
+def benchmark_pipeline(sizes=(5, 10), seed=0, memory=False):
+    """
+    Время и пик памяти каждого этапа обработки загрузки на синтетических городах
+
+    Для каждого размера SyntheticCity.generate_city даёт наборы shapefile,
+    которые проходят те же этапы, что загрузка в /upload и симуляция:
+      - ingest - разбор наборов shapefile (GeojsonService.layers_from_uploads);
+      - filter - объединение ЖК и отбор объектов рядом с ними;
+      - graph - построение графа (IncrementalGraph.GraphState.build);
+      - routing - RoutingGraph, разметка ближайших объектов и маршруты от жилых зданий;
+      - simulation - розыгрыш нагрузки по маршрутам (Main_alko.process_building);
+      - classification - классы нагрузки дорог (parse_geo.parse_geo без записи файлов).
+    Всё выполняется в одном процессе. После каждого этапа записывается пиковый
+    RSS процесса (max_rss_bytes) - он только растёт, зато ничего не стоит. Пик
+    памяти самого этапа (peak_bytes) считает tracemalloc, если memory=True; он
+    учитывает и массивы numpy, но замедляет этапы на Python-циклах (routing) в
+    10-20 раз, поэтому время сравнимо только между отчётами с одинаковым memory.
+
+    Args:
+        sizes: кварталов по стороне города (SyntheticCity.generate_city)
+        seed: int - зерно генератора города и симуляции
+        memory: bool - замерять пик памяти этапов (иначе peak_bytes - None)
+
+    Returns:
+        list: для каждого размера {size, counts, stages: этап -> {seconds, peak_bytes, max_rss_bytes}}
+    """
+    results = []
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        for size in sizes:
+            uploads = SyntheticCity.to_uploads(SyntheticCity.generate_city(size, seed))
+            service = GeojsonService()
+            stages = {}
+
+            layers = _measure(stages, "ingest", lambda: service.layers_from_uploads(uploads))
+
+            def filter_layers():
+                houses = service.merge_houses(layers)
+                return service.add_base_objects(houses, layers), service.add_roads(houses, layers)
+
+            buildings, roads = _measure(stages, "filter", filter_layers)
+            state = _measure(stages, "graph", lambda: GraphState.build(buildings, roads))
+            G = state.graph()
+
+            def route():
+                R = RoutingGraph.from_networkx(G)
+                facilities = FacilityIndex.label_nearest_facilities(R)
+                population_data = Main_alko.load_population(R)
+                routes = {building: Main_alko.building_routes(R, building, facilities)
+                          for building in R.typed_nodes() if population_data.get(building, 0) > 0}
+                return R, facilities, population_data, routes
+
+            R, facilities, population_data, routes = _measure(stages, "routing", route)
+
+            def simulate():
+                entropy = np.random.SeedSequence(seed).entropy
+                loads = np.zeros(R.num_edges, dtype=np.int64)
+                for building, building_routes in routes.items():
+                    edges, counts = Main_alko.process_building(R, building, population_data, facilities,
+                                                               Main_alko.building_rng(entropy, R, building),
+                                                               routes=building_routes)
+                    loads[edges] += counts
+                return loads
+
+            loads = _measure(stages, "simulation", simulate)
+            _measure(stages, "classification",
+                     lambda: parse_geo.parse_geo(state.roads_frame(), R.loads_by_id(loads), write=False))
+
+            results.append({
+                "size": size,
+                "counts": {
+                    "buildings": len(buildings),
+                    "roads": len(roads),
+                    "nodes": G.number_of_nodes(),
+                    "edges": G.number_of_edges(),
+                    "residential": len(routes),
+                    "residents": float(sum(population_data.values())),
+                    "loaded_edges": int((loads > 0).sum()),
+                },
+                "stages": stages,
+            })
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+    return results
+
+
+def compare_pipeline(baseline, current, tolerance=0.2):
+    """
+    Этапы, ставшие медленнее или прожорливее baseline больше чем на tolerance
+
+    Args:
+        baseline, current: результаты benchmark_pipeline (или раздел "pipeline" отчёта)
+        tolerance: float - допустимый относительный рост
+
+    Returns:
+        list: {size, stage, metric, baseline, current, ratio} для каждого ухудшения
+    """
+    previous = {result["size"]: result["stages"] for result in baseline}
+    regressions = []
+    for result in current:
+        for stage, metrics in result["stages"].items():
+            old = previous.get(result["size"], {}).get(stage)
+            if old is None:
+                continue
+            for metric in ("seconds", "peak_bytes", "max_rss_bytes"):
+                if not old.get(metric) or metrics.get(metric) is None:
+                    continue
+                if metrics[metric] > old[metric] * (1 + tolerance):
+                    regressions.append({
+                        "size": result["size"],
+                        "stage": stage,
+                        "metric": metric,
+                        "baseline": old[metric],
+                        "current": metrics[metric],
+                        "ratio": metrics[metric] / old[metric],
+                    })
+    return regressions
+
+
+def environment():
+    """Версии Python и numpy и платформа - чтобы сравнивать отчёты одной машины"""
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры производительности маршрутизации")
+    parser.add_argument("--graph", default="graph.pkl")
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--buildings", default="graph_geojson/buildings.geojson")
+    parser.add_argument("--roads", default="graph_geojson/roads.geojson")
+    parser.add_argument("--build-sizes", type=int, nargs="*", default=[1, 4, 16, 43],
+                        help="размеры города для замера построения графа, в копиях исходных слоёв")
+    parser.add_argument("--legacy", action="store_true",
+                        help="замерить прежние этапы построения графа на самом маленьком размере")
+    parser.add_argument("--load-sizes", type=int, nargs="*", default=[1, 16],
+                        help="размеры города для замера загрузки графа, в копиях исходных слоёв")
+    parser.add_argument("--pipeline-sizes", type=int, nargs="*", default=[5, 10],
+                        help="размеры синтетического города (кварталов по стороне) для замера этапов")
+    parser.add_argument("--pipeline-only", action="store_true",
+                        help="только замер этапов на синтетическом городе - без graph.pkl и graph_geojson")
+    parser.add_argument("--memory", action="store_true",
+                        help="замерять пик памяти этапов через tracemalloc (замедляет этапы на Python-циклах)")
+    parser.add_argument("--output", default=None, help="записать отчёт в JSON-файл")
+    parser.add_argument("--baseline", default=None,
+                        help="прежний отчёт: вывести этапы, ставшие медленнее или прожорливее")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = {
+        "environment": environment(),
+        "seed": args.seed,
+        "memory": args.memory,
+        "pipeline": benchmark_pipeline(args.pipeline_sizes, args.seed, args.memory),
+    }
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["regressions"] = compare_pipeline(json.load(f)["pipeline"], report["pipeline"], args.tolerance)
+
+    if not args.pipeline_only:
+        with open(args.graph, "rb") as f:
+            R = RoutingGraph.from_networkx(pickle.load(f))
+
+        with open(args.buildings, "r", encoding="utf-8") as f:
+            buildings_data = json.load(f)
+        with open(args.roads, "r", encoding="utf-8") as f:
+            roads_data = json.load(f)
+
+        report.update({
+            "nodes": R.num_nodes,
+            "edges": R.num_edges,
+            "point_to_point": benchmark_point_to_point(R, facility_pairs(R, args.pairs, args.seed)),
+            "graph_build": benchmark_graph_build(buildings_data, roads_data, args.build_sizes, args.legacy),
+            "graph_load": benchmark_graph_load(buildings_data, roads_data, args.load_sizes),
+        })
+    output = json.dumps(report, ensure_ascii=False, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    print(output)
@@ -1,44 +1,78 @@
+import numpy as np
 import pandas as pd
 
+# Доля поездок жителей, приходящаяся на часы пик (см. TimeOfDay.departure_profiles)
+PEAK_RATIO = 0.7
 
-# Функция для расчета населения зданий
-def calculate_population(building):
-    building_type = building['Type']
-    apartments = building.get('Apartments', 0)
-    if building_type == "Жилые дома":
-        purpose = building.get('Purpose', 0)
-        if purpose == "Таунхаус" and pd.isna(apartments):
-            return 4
-        elif purpose == "Малоэтажный жилой дом" and pd.isna(apartments):
-            return 4
-        elif purpose == "Общежитие" and pd.isna(apartments):
-            return 4
-        elif pd.isna(apartments):
-            return 0
-        else:
-            return apartments * 3
-    elif building_type == "Частные дома":
-        return 4
+# Правила оценки населения. Проверяются по порядку, здание получает первое подошедшее:
+#   type, purpose - значения столбцов Type и Purpose (purpose None - любое);
+#   per_apartment - жителей на квартиру (None - число квартир не учитывается);
+#   default - жителей, если число квартир неизвестно.
+# Здания, к которым не подошло ни одно правило, - нежилые (0 жителей)
+POPULATION_RULES = [
+    {"type": "Жилые дома", "purpose": "Таунхаус", "per_apartment": 3, "default": 4},
+    {"type": "Жилые дома", "purpose": "Малоэтажный жилой дом", "per_apartment": 3, "default": 4},
+    {"type": "Жилые дома", "purpose": "Общежитие", "per_apartment": 3, "default": 4},
+    {"type": "Жилые дома", "purpose": None, "per_apartment": 3, "default": 0},
+    {"type": "Частные дома", "purpose": None, "per_apartment": None, "default": 4},
+]
 
 
-    return 0  # Для прочих типов
+def estimate_population(buildings, rules=POPULATION_RULES):
+    """
+    Население всех зданий таблицы по правилам rules
 
+    Правила применяются к столбцам целиком, а не к строкам по одной.
 
-def get_population(buildings):
+    Args:
+        buildings: DataFrame или GeoDataFrame со столбцами Type, Purpose, Apartments
+            (отсутствующий Type или Purpose - пустой, отсутствующий Apartments - 0 квартир)
+        rules: list - правила в формате POPULATION_RULES
 
-    population_dict = {}
+    Returns:
+        np.ndarray[float64]: население в порядке строк таблицы
+    """
+    count = len(buildings)
+    empty = np.full(count, None, dtype=object)
+    types = buildings["Type"].to_numpy(dtype=object) if "Type" in buildings else empty
+    purposes = buildings["Purpose"].to_numpy(dtype=object) if "Purpose" in buildings else empty
+    if "Apartments" in buildings:
+        apartments = pd.to_numeric(buildings["Apartments"], errors="coerce").to_numpy(dtype=np.float64)
+    else:
+        apartments = np.zeros(count)
+    known = ~np.isnan(apartments)
 
-    # Расчет населения для всех зданий и логирование
-    for key, bldg in buildings.items():
-        for idx, building in bldg.iterrows():
-            # Определение HouseId
-            house_id = building.get('HouseId', f"{key}_{idx}")
-            population = calculate_population(building)
-            bldg.at[idx, 'Population'] = population
-            population_dict[house_id] = population
+    population = np.zeros(count)
+    assigned = np.zeros(count, dtype=bool)
+    for rule in rules:
+        match = ~assigned & (types == rule["type"])
+        if rule["purpose"] is not None:
+            match &= purposes == rule["purpose"]
+        if rule["per_apartment"] is None:
+            population[match] = rule["default"]
+        else:
+            population[match] = np.where(known[match], apartments[match] * rule["per_apartment"], rule["default"])
+        assigned |= match
+    return population
 
 
-    # Определяем процент людей в час пик
-    peak_ratio = 0.7
+def get_population(buildings):
+    """
+    Население зданий всех слоёв; столбец Population дописывается в сами слои
+
+    Args:
+        buildings: dict - имя слоя -> DataFrame зданий
 
-    return population_dict
\ No newline at end of file
+    Returns:
+        dict: HouseId (или <слой>_<индекс>, если столбца нет) -> население
+    """
+    population_dict = {}
+    for key, bldg in buildings.items():
+        population = estimate_population(bldg)
+        bldg['Population'] = population
+        if 'HouseId' in bldg:
+            house_ids = bldg['HouseId'].tolist()
+        else:
+            house_ids = [f"{key}_{idx}" for idx in bldg.index]
+        population_dict.update(zip(house_ids, population.tolist()))
+    return population_dict
@@ -1,28 +1,288 @@
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
-from GeojsonService import GeojsonService
-import Graph
-import pickle
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+from fastapi import FastAPI, File, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel
+from GeojsonService import GeojsonService, NEAR_HOUSES_RADIUS
+from HeatmapTiles import HeatmapCache
+from Scenarios import EngineNotReady, Scenarios, road_changes
+from IncrementalGraph import load_state
+from UploadJobs import UploadJobs, QueueFull, GRAPH_STATE_PATH
+from SimulationService import SimulationRuns, TooManyRuns, load_updates, format_event
+import Main_alko
+import Metrics
+import parse_geo
 
-app = FastAPI()
+# Обработка загрузок идёт в фоне: одна задача за раз, ещё до семи ждут в очереди
+upload_jobs = UploadJobs(workers=1, max_jobs=8)
+# Прогон симуляции сам занимает все ядра, поэтому одновременно выполняется один
+simulation_runs = SimulationRuns(max_runs=1)
+# Тайлы тепловой карты: по ключу прогона, в памяти и в каталоге tiles
+heatmap_cache = HeatmapCache("tiles")
+# Сценарии «что если»: движок с обратным индексом маршрутов по зерну базовой нагрузки
+scenarios = Scenarios()
+# Нагрузка последнего запуска Main_alko из командной строки
+TRAFIC_PATH = "trafic.json"
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    upload_jobs.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 geojson_service = GeojsonService()
 
+
+def _get_job(job_id):
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
 @app.post("/upload")
 async def upload_multiple_shapefiles(
     shp_files: list[UploadFile] = File(...),
     shx_files: list[UploadFile] = File(...),
     dbf_files: list[UploadFile] = File(...),
     prj_files: list[UploadFile] = File(...),
-    cpg_files: list[UploadFile] = File(...)
+    cpg_files: list[UploadFile] = File(...),
+    full: bool = False,
+    radius: float = NEAR_HOUSES_RADIUS,
+    simulate: bool = False,
+    seed: Optional[int] = None
 ):
-    response = await geojson_service.shp_to_geojson(shp_files, shx_files, dbf_files, prj_files, cpg_files)
-    houses = geojson_service.merge_houses(response)
-    buildings = geojson_service.add_base_objects(houses, response)
-    roads = geojson_service.add_roads(houses, response)
-    G = Graph.get_graph(buildings, roads)
-    with open("graph.pkl", "wb") as f:
-        pickle.dump(G, f)
-    return JSONResponse(content={"geojson_files": G})
+    # Здесь только читаем файлы; разбор слоёв, граф и симуляция - в задаче UploadJobs
+    uploads = await geojson_service.read_uploads(shp_files, shx_files, dbf_files, prj_files, cpg_files)
+    try:
+        job = upload_jobs.submit(uploads, {"full": full, "radius": radius, "simulate": simulate,
+                                              "seed": seed})
+    except QueueFull:
+        raise HTTPException(status_code=429, detail="Too many upload jobs, try again later")
+    return JSONResponse(status_code=202, content=upload_jobs.status(job))
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return JSONResponse(content=upload_jobs.status(_get_job(job_id)))
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = _get_job(job_id)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    return JSONResponse(content=job.result)
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = _get_job(job_id)
+    if not upload_jobs.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    return JSONResponse(content=upload_jobs.status(job))
+
+
+class SimulationRequest(BaseModel):
+    # Параметры модели жителя (см. Main_alko.simulation_params); не заданные - по умолчанию
+    choice_probabilities: Optional[dict[str, float]] = None
+    route_probabilities: Optional[list[float]] = None
+    stay_home_probability: Optional[float] = None
+    metro_distance: Optional[float] = None
+    default_to_metro_near: Optional[float] = None
+    default_to_metro_far: Optional[float] = None
+    seed: Optional[int] = None
+
+
+def _get_run(run_id):
+    run = simulation_runs.get(run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Simulation {run_id} not found")
+    return run
+
+
+@app.post("/simulations")
+async def start_simulation(request: SimulationRequest):
+    options = request.model_dump()
+    seed = options.pop("seed")
+    try:
+        params = Main_alko.simulation_params(**options)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    try:
+        run = simulation_runs.start(params, seed)
+    except TooManyRuns:
+        raise HTTPException(status_code=429, detail="Another simulation is running, try again later")
+    return JSONResponse(status_code=202, content=run.status_dict())
+
+
+@app.get("/simulations/{run_id}")
+async def simulation_status(run_id: str):
+    return JSONResponse(content=_get_run(run_id).status_dict())
+
+
+@app.get("/simulations/{run_id}/stream")
+async def stream_simulation(run_id: str, format: Literal["ndjson", "sse"] = "ndjson", interval: float = 0.5):
+    """
+    Накопленная нагрузка по id дорог по мере обработки зданий
+
+    Каждое событие loads несёт ход прогона и только те дороги, нагрузка которых
+    изменилась с прошлого события, так что клиент собирает полную картину,
+    накладывая события по порядку. Последнее событие end - итоговый статус.
+    """
+    run = _get_run(run_id)
+    interval = max(interval, 0.05)
+
+    async def events():
+        previous = {}
+        sent = None
+        while True:
+            version, changed, status = load_updates(run, previous)
+            if version != sent:
+                sent = version
+                yield format_event("loads", {
+                    "status": status["status"],
+                    "buildings_done": status["buildings_done"],
+                    "buildings_total": status["buildings_total"],
+                    "loads": changed,
+                }, format)
+            if status["status"] not in ("queued", "running"):
+                yield format_event("end", status, format)
+                return
+            await asyncio.sleep(interval)
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type)
+
+
+@app.get("/simulations/{run_id}/result")
+async def simulation_result(run_id: str):
+    run = _get_run(run_id)
+    if run.status != "done":
+        raise HTTPException(status_code=409, detail=f"Simulation {run_id} is {run.status}")
+    return JSONResponse(content=run.loads_by_id())
+
+
+@app.get("/simulations/{run_id}/classes")
+def classify_simulation(run_id: str, low: float = parse_geo.LOW_LOAD, high: float = parse_geo.HIGH_LOAD,
+                        write: bool = False):
+    """Дороги текущего графа по классам нагрузки прогона (parse_geo); write - ещё и в GeoJSON-файлы"""
+    run = _get_run(run_id)
+    if run.status != "done":
+        raise HTTPException(status_code=409, detail=f"Simulation {run_id} is {run.status}")
+    classes = parse_geo.parse_geo(_roads_frame(), run.loads_by_id(), low, high, write)
+    return JSONResponse(content={name: roads.to_geo_dict(na="null") for name, roads in classes.items()})
+
+
+def _roads_frame():
+    state = load_state(GRAPH_STATE_PATH)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Graph state not found, upload layers first")
+    return state.roads_frame()
+
+
+@app.get("/tiles/{run_id}/{z}/{x}/{y}.png")
+def heatmap_tile(run_id: str, z: int, x: int, y: int):
+    """
+    Тайл тепловой карты нагрузки прогона в EPSG:3857 (XYZ)
+
+    run_id "trafic" - нагрузка из trafic.json; новый файл получает новый ключ кэша.
+    """
+    if run_id == "trafic":
+        if not os.path.exists(TRAFIC_PATH):
+            raise HTTPException(status_code=404, detail=f"{TRAFIC_PATH} not found")
+        key = f"trafic-{os.stat(TRAFIC_PATH).st_mtime_ns}"
+
+        def loads():
+            with open(TRAFIC_PATH, "r", encoding="utf-8") as f:
+                return json.load(f)
+    else:
+        run = _get_run(run_id)
+        if run.status != "done":
+            raise HTTPException(status_code=409, detail=f"Simulation {run_id} is {run.status}")
+        key, loads = run.id, run.loads_by_id
+    tiles = heatmap_cache.get(key, _roads_frame, loads)
+    try:
+        png = tiles.tile(z, x, y)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return Response(content=png, media_type="image/png", headers={"Cache-Control": "public, max-age=3600"})
+
+
+@app.delete("/simulations/{run_id}")
+async def cancel_simulation(run_id: str):
+    run = _get_run(run_id)
+    if not simulation_runs.cancel(run):
+        raise HTTPException(status_code=409, detail=f"Simulation {run_id} is {run.status}")
+    return JSONResponse(content=run.status_dict())
+
+
+class ScenarioEdit(BaseModel):
+    # Правка сценария (см. Scenarios.ScenarioEngine.apply)
+    kind: Literal["close_road", "close_edge", "population"]
+    road: Optional[str] = None
+    nodes: Optional[list[str]] = None
+    building: Optional[str] = None
+    population: Optional[float] = None
+    delta: Optional[float] = None
+
+
+class ScenarioRequest(BaseModel):
+    edits: list[ScenarioEdit]
+    # База - завершённый прогон (его зерно и параметры) или нагрузка с зерном seed
+    run_id: Optional[str] = None
+    seed: int = 0
+    # Маршруты затронутых целей ищутся заново со штрафами, как при полном прогоне (медленно)
+    search_alternatives: bool = False
+
+
+@app.post("/scenarios")
+def run_scenario(request: ScenarioRequest):
+    """
+    Нагрузка при правках относительно базовой: только дороги, где она изменилась.
+    Пока движок сценариев для графа и зерна строится в фоне - 202, запрос нужно повторить
+    """
+    seed, params = request.seed, None
+    if request.run_id is not None:
+        run = _get_run(request.run_id)
+        if run.status != "done":
+            raise HTTPException(status_code=409, detail=f"Simulation {request.run_id} is {run.status}")
+        seed, params = run.seed, run.params
+    try:
+        engine = scenarios.engine(seed, params)
+    except EngineNotReady:
+        return JSONResponse(status_code=202, content={"status": "building"}, headers={"Retry-After": "5"})
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Graph not found, upload layers first")
+    try:
+        result = engine.apply([edit.model_dump() for edit in request.edits], request.search_alternatives)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return JSONResponse(content={
+        "roads": road_changes(engine.graph, engine.baseline, result["loads"]),
+        "rerouted": result["rerouted"],
+        "resampled": result["resampled"],
+        "seconds": result["seconds"],
+    })
+
+
+@app.get("/metrics")
+def metrics():
+    # Метрики в формате Prometheus; задачи и прогоны считаются по состояниям в момент запроса
+    if not Metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    for name, registry in (("tsodd_upload_jobs", upload_jobs.jobs), ("tsodd_simulation_runs", simulation_runs.runs)):
+        counts = dict.fromkeys(("queued", "running", "done", "cancelled", "failed"), 0)
+        for item in list(registry.values()):
+            counts[item.status] = counts.get(item.status, 0) + 1
+        for status, count in counts.items():
+            Metrics.set_gauge(name, count, status=status)
+    return PlainTextResponse(Metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+import argparse
+
+import numpy as np
+
+import FacilityIndex
+import GraphSnapshot
+import Main_alko
+import ParallelSimulation
+from RouteCache import RouteCache
+from RoutingGraph import encode_strings, decode_strings
+
+PERCENTILES = (5, 50, 95)
+
+
+def run_ensemble(G, buildings, population_data, replications=20, seed=0, workers=None, chunksize=16,
+                 cache_path="route_cache.pkl"):
+    """
+    Ансамбль из replications независимых прогонов симуляции с общим зерном
+
+    Маршруты от здания не зависят от случайности, поэтому они ищутся один раз,
+    а все повторы разыгрываются сразу одним вызовом multinomial(size=replications)
+    с генератором здания (Main_alko.building_rng). Работа делится по зданиям
+    между процессами ParallelSimulation, так что результат не зависит от
+    числа процессов: при одном и том же seed он совпадает побитно.
+
+    Args:
+        G: RoutingGraph
+        buildings: list - id зданий
+        population_data: dict - id здания -> население
+        replications: int - число повторов
+        seed: int - зерно ансамбля
+        cache_path: str - файл RouteCache (None - без кэша)
+
+    Returns:
+        np.ndarray[int32]: нагрузка (replications, число рёбер)
+    """
+    cache = RouteCache(cache_path).load(G) if cache_path else None
+    facilities = None
+    if cache is None or any(cache.get(b) is None and int(population_data.get(b, 0)) > 0 for b in buildings):
+        facilities = FacilityIndex.label_nearest_facilities(G)
+    population = [population_data.get(node, 0) for node in G.node_ids]
+    entropy = np.random.SeedSequence(seed).entropy
+    samples = ParallelSimulation.run_processes(G, buildings, population, facilities, workers, chunksize, entropy,
+                                               replications, cache)
+    if cache is not None:
+        cache.save()
+    return samples
+
+
+def summarize(samples, percentiles=PERCENTILES):
+    """
+    Статистика нагрузки по каждому ребру
+
+    Returns:
+        dict: mean, std - float32 по рёбрам; percentiles - float32 (len(percentiles), число рёбер);
+            percentile_levels - уровни процентилей
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        "mean": samples.mean(axis=0).astype(np.float32),
+        "std": samples.std(axis=0).astype(np.float32),
+        "percentiles": np.percentile(samples, percentiles, axis=0).astype(np.float32),
+        "percentile_levels": np.asarray(percentiles, dtype=np.float32),
+    }
+
+
+def save_summary(path, G, summary, seed, replications):
+    """Сохраняет статистику в сжатый .npz вместе с id дорог для каждого ребра"""
+    np.savez_compressed(path, seed=np.int64(seed), replications=np.int64(replications),
+                        **summary, **encode_strings("edge_ids", G.edge_ids))
+
+
+def load_summary(path):
+    """Читает .npz из save_summary; edge_ids возвращаются списком"""
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    arrays["edge_ids"] = decode_strings(arrays, "edge_ids")
+    for name in ("edge_ids_data", "edge_ids_offsets", "edge_ids_mask"):
+        del arrays[name]
+    return arrays
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ансамбль прогонов симуляции нагрузки")
+    parser.add_argument("--replications", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", default="trafic_ensemble.npz")
+    args = parser.parse_args()
+
+    R = GraphSnapshot.load_routing_graph()
+    population_data = Main_alko.load_population(R)
+
+    samples = run_ensemble(R, R.typed_nodes(), population_data, args.replications, args.seed, args.workers)
+    save_summary(args.output, R, summarize(samples), args.seed, args.replications)
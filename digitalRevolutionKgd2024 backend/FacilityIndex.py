@@ -0,0 +1,88 @@
+import AStar_GOD
+import Metrics
+from RoutingGraph import RoutingGraph
+
+# Типы объектов, к которым ходят жители (building_type узлов графа)
+FACILITY_TYPES = ("school", "sad", "ot", "metro")
+
+
+class FacilityLabels:
+    """
+    Разметка графа ближайшими объектами одного типа
+
+    Атрибуты:
+        type: str - тип объектов (school, sad, ot, metro)
+        distances: np.ndarray[float64] - расстояние от узла до ближайшего объекта
+        nearest: np.ndarray[int32] - номер узла ближайшего объекта (-1 - недостижим)
+        predecessors: np.ndarray[int32] - следующий узел на пути к объекту
+    """
+
+    def __init__(self, graph, type, distances, nearest, predecessors):
+        self.graph = graph
+        self.type = type
+        self.distances = distances
+        self.nearest = nearest
+        self.predecessors = predecessors
+
+    def lookup(self, node):
+        """
+        Ближайший объект нужного типа для узла и расстояние до него по графу
+
+        Returns:
+            tuple: (id объекта, расстояние); (None, inf), если объект недостижим
+        """
+        i = self.graph.index[node]
+        facility = self.nearest[i]
+        if facility < 0:
+            return None, float('inf')
+        return self.graph.node_ids[facility], float(self.distances[i])
+
+    def path(self, node):
+        """Кратчайший путь от узла до ближайшего объекта по указателям предков"""
+        i = self.graph.index[node]
+        if self.nearest[i] < 0:
+            return []
+        path = [i]
+        while self.predecessors[path[-1]] >= 0:
+            path.append(self.predecessors[path[-1]])
+        return [self.graph.node_ids[j] for j in path]
+
+
+@Metrics.timed("facility_labels")
+def label_nearest_facilities(graph, types=FACILITY_TYPES, weights=None):
+    """
+    Для каждого типа объектов делает один проход Дейкстры от всех объектов сразу
+
+    Args:
+        graph: RoutingGraph или nx.Graph
+        types: tuple - типы объектов (building_type)
+        weights: веса полурёбер вместо graph.weights (inf - закрытое ребро, см. Scenarios)
+
+    Returns:
+        dict: тип -> FacilityLabels
+    """
+    graph = RoutingGraph.ensure(graph)
+    labels = {}
+    for type in types:
+        facilities = graph.typed_nodes(type)
+        distances, nearest, predecessors = AStar_GOD.multi_source_dijkstra(graph, facilities, weights)
+        labels[type] = FacilityLabels(graph, type, distances, nearest, predecessors)
+    return labels
+
+
+
+def labels_to_arrays(labels):
+    """Разметка в виде плоских массивов <тип>_distances, <тип>_nearest, <тип>_predecessors"""
+    arrays = {}
+    for type, facility_labels in labels.items():
+        arrays[f"{type}_distances"] = facility_labels.distances
+        arrays[f"{type}_nearest"] = facility_labels.nearest
+        arrays[f"{type}_predecessors"] = facility_labels.predecessors
+    return arrays
+
+
+def labels_from_arrays(graph, arrays, types=FACILITY_TYPES):
+    """Обратное к labels_to_arrays"""
+    return {type: FacilityLabels(graph, type, arrays[f"{type}_distances"], arrays[f"{type}_nearest"],
+                                 arrays[f"{type}_predecessors"])
+            for type in types}
@@ -3,60 +3,124 @@ from fastapi import UploadFile, HTTPException
 from io import BytesIO
 import zipfile
 import os
-import tempfile
 import json
 from datetime import datetime
-from shapely.geometry import Point, LineString
+from shapely import STRtree, get_parts
 from shapely.ops import unary_union
+import numpy as np
 import pandas as pd
 
+import Metrics
+
+try:
+    import pyarrow  # noqa: F401 - pyogrio читает слои в Arrow, если он установлен
+    USE_ARROW = True
+except ImportError:
+    USE_ARROW = False
+
+
+# Радиус (в метрах), в котором остановки, дома и дороги считаются рядом с ЖК
+NEAR_HOUSES_RADIUS = 1000
+
+
+def _as_3857(gdf):
+    """Слои приходят в EPSG:3857; CRS проставляется без перепроецирования"""
+    return gdf.set_crs("EPSG:3857", allow_override=True)
+
+
+def _within(geometries, tree, radius):
+    """
+    Маска объектов, до которых от какого-либо объекта дерева не больше radius
+
+    Один запрос ближайшего соседа с max_distance на весь слой - то же, что
+    any(geom.distance(other) <= radius), но без перебора пар в Python
+    """
+    mask = np.zeros(len(geometries), dtype=bool)
+    if len(tree.geometries):
+        mask[tree.query_nearest(np.asarray(geometries), max_distance=radius)[0]] = True
+    return mask
+
+
+def _intersects(geometries, tree):
+    """Маска объектов, пересекающихся хотя бы с одним объектом дерева"""
+    mask = np.zeros(len(geometries), dtype=bool)
+    mask[tree.query(np.asarray(geometries), predicate="intersects")[0]] = True
+    return mask
+
+
 class GeojsonService:
-    async def shp_to_geojson(
+    def __init__(self, radius=NEAR_HOUSES_RADIUS):
+        self.radius = radius
+
+    async def read_uploads(
             self,
             shp_files: list[UploadFile],
             shx_files: list[UploadFile],
             dbf_files: list[UploadFile],
             prj_files: list[UploadFile],
             cpg_files: list[UploadFile]
-    ) -> list[str]:
+    ) -> list[tuple[str, dict]]:
+        """
+        Читает содержимое загруженных наборов shapefile; разбор - в layers_from_uploads
+
+        Returns:
+            list: пары (имя слоя по имени .shp, расширение -> байты файла)
+        """
         if not (len(shp_files) == len(shx_files) == len(dbf_files) == len(prj_files) == len(cpg_files)):
             raise HTTPException(status_code=400, detail="Error: Each shapefile dataset must include .shp, .shx, .dbf, .prj, and .cpg files.")
 
-        # Массив для хранения всех GeoJSON-данных
-        geojson_list = []
-
-        # Обрабатываем каждый набор файлов
+        uploads = []
         for i in range(len(shp_files)):
+            files = {}
+            for ext, file in {"shp": shp_files[i], "shx": shx_files[i], "dbf": dbf_files[i], "prj": prj_files[i],
+                              "cpg": cpg_files[i]}.items():
+                files[ext] = await file.read()
+            uploads.append((os.path.splitext(shp_files[i].filename)[0], files))
+        return uploads
+
+    @Metrics.timed("ingest")
+    def layers_from_uploads(self, uploads) -> list[tuple[str, gpd.GeoDataFrame]]:
+        """
+        Читает наборы shapefile в GeoDataFrame без промежуточного GeoJSON
+
+        Файлы набора складываются в zip в памяти, который pyogrio читает
+        напрямую (через pyarrow, если он установлен), без временных файлов.
+
+        Args:
+            uploads: list - результат read_uploads
+
+        Returns:
+            list: пары (имя слоя, GeoDataFrame)
+        """
+        layers = []
+        for i, (name, files) in enumerate(uploads):
             # Создаем zip-архив в памяти
             zip_buffer = BytesIO()
             with zipfile.ZipFile(zip_buffer, "w") as zip_archive:
                 # Записываем каждый файл в архив
-                for ext, file in {"shp": shp_files[i], "shx": shx_files[i], "dbf": dbf_files[i], "prj": prj_files[i],
-                                  "cpg": cpg_files[i]}.items():
-                    zip_archive.writestr(f"upload.{ext}", await file.read())
+                for ext, data in files.items():
+                    zip_archive.writestr(f"upload.{ext}", data)
             zip_buffer.seek(0)
 
-            # Создаем временный файл для zip-архива
-            with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as temp_zip_file:
-                temp_zip_file.write(zip_buffer.getvalue())
-                temp_zip_file_path = temp_zip_file.name
-
-            # Читаем zip-архив с помощью GeoPandas
             try:
-                gdf = gpd.read_file(f"zip://{temp_zip_file_path}")
-                geojson_data = json.loads(gdf.to_json())
-
-                geojson_data["name"] = os.path.splitext(shp_files[i].filename)[0]  # Добавляем название файла
-                geojson_list.append(geojson_data)
-
+                gdf = gpd.read_file(zip_buffer, engine="pyogrio", use_arrow=USE_ARROW)
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Error processing shapefile set {i + 1}: {str(e)}")
-            finally:
-                # Удаляем временный файл после чтения
-                os.remove(temp_zip_file_path)
+            layers.append((name, gdf))
+            Metrics.inc("tsodd_ingested_features_total", len(gdf))
 
-        # Возвращаем все GeoJSON-файлы в виде JSON-ответа
-        return geojson_list
+        return layers
+
+    async def read_layers(
+            self,
+            shp_files: list[UploadFile],
+            shx_files: list[UploadFile],
+            dbf_files: list[UploadFile],
+            prj_files: list[UploadFile],
+            cpg_files: list[UploadFile]
+    ) -> list[tuple[str, gpd.GeoDataFrame]]:
+        """Читает и разбирает загруженные наборы shapefile (read_uploads + layers_from_uploads)"""
+        return self.layers_from_uploads(await self.read_uploads(shp_files, shx_files, dbf_files, prj_files, cpg_files))
 
     def save_geojson(self, geojson_data):
         if isinstance(geojson_data, str):
@@ -66,34 +130,21 @@ class GeojsonService:
         with open(filename, "w", encoding="utf-8") as f:
             json.dump(geojson_data, f, ensure_ascii=False, indent=4)
 
-    def merge_houses(self, geojson_list):
+    @Metrics.timed("merge_houses")
+    def merge_houses(self, layers):
         # Регулярное выражение для поиска нужных названий
         pattern = r"House_\d+очередь_ЖК"
 
-        # Массив для всех уникальных feature
-        all_features = []
-        seen_features = set()  # Для отслеживания уникальных объектов
-
-        # Проходим по всем geojson в списке
-        for geojson_data in geojson_list:
-            # Проверяем, что имя файла соответствует паттерну
-            if geojson_data.get("name", "").startswith("House_") and "очередь_ЖК" in geojson_data["name"]:
-                # Добавляем все features из этого geojson, избегая дубли
-                for feature in geojson_data["features"]:
-                    feature_id = json.dumps(feature["geometry"])  # Используем геометрию для уникальности
-                    if feature_id not in seen_features:
-                        seen_features.add(feature_id)
-                        all_features.append(feature)
-
-        # Формируем новый GeoJSON с уникальными features
-        merged_geojson = {
-            "type": "FeatureCollection",
-            "name": "Houses_ЖК",  # Название для объединенного GeoJSON
-            "crs": geojson_list[0]["crs"],  # Копируем CRS из первого GeoJSON
-            "features": all_features
-        }
-
-        return merged_geojson
+        # Слои домов ЖК в порядке загрузки
+        house_layers = [gdf for name, gdf in layers if name.startswith("House_") and "очередь_ЖК" in name]
+        if not house_layers:
+            return gpd.GeoDataFrame(geometry=[], crs=layers[0][1].crs if layers else None)
+
+        # Объединяем, избегая дублей по геометрии
+        merged_gdf = pd.concat(house_layers, ignore_index=True)
+        merged_gdf = merged_gdf[~merged_gdf.geometry.to_wkb().duplicated()].reset_index(drop=True)
+        # CRS берём из первого загруженного слоя
+        return merged_gdf.set_crs(layers[0][1].crs, allow_override=True)
 
     def correct_shapefile_order(self, shapefile_path):
         # Загружаем shapefile
@@ -104,24 +155,20 @@ class GeojsonService:
 
         return gdf
 
-    def add_base_objects(self, merged_geojson, geojson_list):
-        # Преобразуем объединенный GeoJSON в GeoDataFrame
-        merged_gdf = gpd.GeoDataFrame.from_features(merged_geojson["features"], crs="EPSG:3857")
-
-        # Множество для хранения всех домов из объединенного geojson
-        merged_houses = unary_union(merged_gdf.geometry)
+    @Metrics.timed("add_base_objects")
+    def add_base_objects(self, merged_houses_gdf, layers, radius=None):
+        radius = self.radius if radius is None else radius
+        merged_gdf = _as_3857(merged_houses_gdf)
 
-        # Функция для проверки расстояния (1 км)
-        def within_1km(geom, reference_geom):
-            return geom.distance(reference_geom) <= 1000
+        # Дома ЖК после объединения, в пространственном индексе
+        merged_houses = STRtree(get_parts(unary_union(merged_gdf.geometry)))
 
         # 1. Добавляем выходы метро (если есть)
         metro_gdf = None
-        for geojson_data in geojson_list:
-            if geojson_data.get("name", "").startswith("Выходы_метро"):
-                metro_gdf = gpd.GeoDataFrame.from_features(geojson_data["features"], crs="EPSG:3857")
-                metro_gdf = metro_gdf[
-                    metro_gdf.geometry.apply(lambda x: isinstance(x, Point))]  # Оставляем только точки
+        for name, gdf in layers:
+            if name.startswith("Выходы_метро"):
+                metro_gdf = _as_3857(gdf)
+                metro_gdf = metro_gdf[metro_gdf.geom_type == "Point"]  # Оставляем только точки
                 break
 
         if metro_gdf is not None:
@@ -129,78 +176,62 @@ class GeojsonService:
 
         # 2. Добавляем остановки общественного транспорта (если есть)
         ot_gdf = None
-        for geojson_data in geojson_list:
-            if geojson_data.get("name", "").startswith("Остановки_ОТ"):
-                ot_gdf = gpd.GeoDataFrame.from_features(geojson_data["features"], crs="EPSG:3857")
-                ot_gdf = ot_gdf[ot_gdf.geometry.apply(lambda x: isinstance(x, Point))]  # Оставляем только точки
+        for name, gdf in layers:
+            if name.startswith("Остановки_ОТ"):
+                ot_gdf = _as_3857(gdf)
+                ot_gdf = ot_gdf[ot_gdf.geom_type == "Point"]  # Оставляем только точки
                 break
 
         if ot_gdf is not None:
-            # Фильтруем только те остановки, которые находятся в радиусе 1 км от любого дома
-            ot_gdf = ot_gdf[ot_gdf.geometry.apply(lambda x: any(within_1km(x, house) for house in merged_houses.geoms))]
+            # Фильтруем только те остановки, которые находятся в радиусе от любого дома
+            ot_gdf = ot_gdf[_within(ot_gdf.geometry, merged_houses, radius)]
             merged_gdf = pd.concat([merged_gdf, ot_gdf], ignore_index=True)
 
         # 3. Добавляем дома из "Дома_исходные" (если есть)
         houses_gdf = None
-        for geojson_data in geojson_list:
-            if geojson_data.get("name", "").startswith("Дома_исходные"):
-                houses_gdf = gpd.GeoDataFrame.from_features(geojson_data["features"], crs="EPSG:3857")
+        for name, gdf in layers:
+            if name.startswith("Дома_исходные"):
+                houses_gdf = _as_3857(gdf)
                 break
 
         if houses_gdf is not None:
-            valid_houses = []
-            for _, house in houses_gdf.iterrows():
-                house_geom = house.geometry
-                # Проверяем, что дом не пересекается с уже добавленными
-                if not any(house_geom.intersects(existing_house) for existing_house in merged_houses.geoms):
-                    # Проверяем, что дом находится не дальше 1 км от любого дома из объединенного GeoJSON
-                    if any(within_1km(house_geom, existing_house) for existing_house in merged_houses.geoms):
-                        valid_houses.append(house)
+            # Дом не пересекается с домами ЖК и находится не дальше радиуса хотя бы от одного из них
+            valid = ~_intersects(houses_gdf.geometry, merged_houses)
+            valid &= _within(houses_gdf.geometry, merged_houses, radius)
 
             # Добавляем валидные дома
-            if valid_houses:
-                valid_houses_gdf = gpd.GeoDataFrame(valid_houses, crs=houses_gdf.crs)
-                merged_gdf = pd.concat([merged_gdf, valid_houses_gdf], ignore_index=True)
-
-        # Формируем итоговый GeoJSON
-        merged_geojson = merged_gdf.to_json()
-        merged_geojson = json.loads(merged_geojson)
-        return merged_geojson
+            if valid.any():
+                merged_gdf = pd.concat([merged_gdf, houses_gdf[valid]], ignore_index=True)
 
-    def add_roads(self, merged_geojson, geojson_list):
-        # Преобразуем объединенный GeoJSON в GeoDataFrame
-        merged_gdf = gpd.GeoDataFrame.from_features(merged_geojson["features"], crs="EPSG:3857")
+        return merged_gdf
 
-        # Множество для хранения всех домов из объединенного geojson
-        merged_houses = unary_union(merged_gdf.geometry)
+    @Metrics.timed("add_roads")
+    def add_roads(self, merged_houses_gdf, layers, radius=None):
+        radius = self.radius if radius is None else radius
+        merged_gdf = _as_3857(merged_houses_gdf)
 
-        # Функция для проверки расстояния (1 км)
-        def within_1km(geom, reference_geom):
-            return geom.distance(reference_geom) <= 1000
+        # Дома ЖК после объединения, в пространственном индексе
+        merged_houses = STRtree(get_parts(unary_union(merged_gdf.geometry)))
 
         # Найдем все файлы с дорогами
         roads_gdf_list = []
-        for geojson_data in geojson_list:
-            if geojson_data.get("name", "").startswith("Streets_"):
-                roads_gdf = gpd.GeoDataFrame.from_features(geojson_data["features"], crs="EPSG:3857")
-                roads_gdf = roads_gdf[
-                    roads_gdf.geometry.apply(lambda x: isinstance(x, LineString))]  # Оставляем только линии
+        for name, gdf in layers:
+            if name.startswith("Streets_"):
+                roads_gdf = _as_3857(gdf)
+                roads_gdf = roads_gdf[roads_gdf.geom_type == "LineString"]  # Оставляем только линии
                 roads_gdf_list.append(roads_gdf)
 
         # Объединяем все дороги в один GeoDataFrame
         all_roads_gdf = pd.concat(roads_gdf_list, ignore_index=True) if roads_gdf_list else None
 
         if all_roads_gdf is not None:
-            # Фильтруем только те дороги, которые находятся в радиусе 1 км от любого дома
-            valid_roads = all_roads_gdf[
-                all_roads_gdf.geometry.apply(lambda x: any(within_1km(x, house) for house in merged_houses.geoms))]
+            # Фильтруем только те дороги, которые находятся в радиусе от любого дома
+            valid_roads = all_roads_gdf[_within(all_roads_gdf.geometry, merged_houses, radius)]
 
             # Убираем дубликаты дорог (если дороги повторяются в разных файлах)
             valid_roads = valid_roads.drop_duplicates(subset=["geometry"])
 
-            # Формируем итоговый GeoJSON с только дорогами
-            roads_geojson = valid_roads.to_json()
-            roads_geojson = json.loads(roads_geojson)
-            return roads_geojson
+            # Индекс не сбрасываем: по нему дороги получают id в графе
+            return valid_roads
         else:
             return None
\ No newline at end of file
@@ -2,8 +2,14 @@ import json
 import networkx as nx
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+import shapely
+from shapely import STRtree
+from shapely.geometry import shape
 from scipy.spatial.distance import cdist, euclidean
 import AStar_GOD
+import Citizen
+import Metrics
 
 from scipy.spatial import KDTree
 
@@ -98,137 +104,544 @@ def merge_road_points(road_points):
 # Порог для соединения точек
 DIST_THRESHOLD = 0.01  # Пороговое расстояние, которое определяет, что точки можно считать близкими
 
-def create_road_network_graph(buildings_geojson, roads_geojson):
-    # Создаем направленный граф
-    G = nx.Graph()
+def layer_features(layer):
+    """
+    Объекты слоя в виде feature geojson
 
-    # Словарь для хранения точек дорог
-    road_points = {}
+    Args:
+        layer: GeoDataFrame, dict geojson или None
 
-    # Сначала добавляем все дороги и их точки
-    for feature in roads_geojson['features']:
-        if feature['geometry']['type'] == 'LineString':
-            coords = feature['geometry']['coordinates']
-            id = feature['id']
-            road_id = f"r_{id}"
+    Returns:
+        list: feature с id по индексу GeoDataFrame; геометрия не проходит через текст GeoJSON
+    """
+    if layer is None:
+        return []
+    if isinstance(layer, dict):
+        return layer['features']
+    return list(layer.iterfeatures(na="null", show_bbox=False))
 
-            # Добавляем узлы для начала и конца дороги
-            start_point = f"{road_id}_start"
-            end_point = f"{road_id}_end"
 
-            start_coords = (coords[0][0], coords[0][1])
-            end_coords = (coords[-1][0], coords[-1][1])
+def layer_population(layer):
+    """
+    Население объектов слоя (Citizen.estimate_population) в порядке layer_features
 
-            # Сохраняем координаты точек дорог
-            road_points[start_point] = start_coords
-            road_points[end_point] = end_coords
+    Args:
+        layer: GeoDataFrame, dict geojson или None
 
-            G.add_node(start_point,
-                       pos=start_coords,
-                       node_type='junction',
-                       node_color='blue',
-                       node_size=50)
-            G.add_node(end_point,
-                       pos=end_coords,
+    Returns:
+        np.ndarray[float64]
+    """
+    if layer is None:
+        return np.zeros(0)
+    if isinstance(layer, dict):
+        layer = pd.DataFrame([feature['properties'] for feature in layer['features']])
+    return Citizen.estimate_population(layer)
+
+
+def feature_geometries(features):
+    """Геометрии списка feature geojson в массиве shapely (None для пустой геометрии)"""
+    geometries = np.empty(len(features), dtype=object)
+    for i, feature in enumerate(features):
+        geometries[i] = shape(feature['geometry']) if feature['geometry'] else None
+    return geometries
+
+
+def layer_geometries(layer):
+    """Геометрии слоя (GeoDataFrame, dict geojson или None) в порядке layer_features"""
+    if layer is None:
+        return np.empty(0, dtype=object)
+    if isinstance(layer, dict):
+        return feature_geometries(layer['features'])
+    return layer.geometry.to_numpy()
+
+
+def _ring_means(rings):
+    # Среднее координат каждого кольца (или точки), включая замыкающую точку
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    counts = np.bincount(index, minlength=len(rings))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.stack([np.bincount(index, weights=coords[:, axis], minlength=len(rings)) / counts
+                         for axis in (0, 1)], axis=1)
+
+
+def building_centroids(geometries):
+    """
+    Центроиды для всего слоя одним проходом, как calculate_polygon_centroid
+
+    Polygon - среднее точек внешнего кольца (с замыкающей точкой),
+    MultiPolygon - среднее центроидов частей, Point - сама точка.
+
+    Args:
+        geometries: массив shapely
+
+    Returns:
+        np.ndarray: (n, 2); NaN для остальных типов геометрии
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    centroids = np.full((len(geometries), 2), np.nan)
+    types = shapely.get_type_id(geometries)
+
+    points = np.flatnonzero(types == 0)
+    centroids[points] = _ring_means(geometries[points])
+
+    polygons = np.flatnonzero(types == 3)
+    centroids[polygons] = _ring_means(shapely.get_exterior_ring(geometries[polygons]))
+
+    multi = np.flatnonzero(types == 6)
+    if len(multi):
+        parts, owner = shapely.get_parts(geometries[multi], return_index=True)
+        part_centroids = _ring_means(shapely.get_exterior_ring(parts))
+        counts = np.bincount(owner, minlength=len(multi))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroids[multi] = np.stack([np.bincount(owner, weights=part_centroids[:, axis], minlength=len(multi))
+                                         for axis in (0, 1)], axis=1) / counts[:, None]
+    return centroids
+
+
+def project_to_roads(tree, points):
+    """
+    Проекции точек на ближайшие линии дорог одним запросом к STRtree
+
+    Из нескольких линий на одинаковом расстоянии берётся линия с меньшим номером.
+
+    Args:
+        tree: STRtree по линиям дорог
+        points: np.ndarray (n, 2)
+
+    Returns:
+        tuple: номер ближайшей линии, расстояние от начала линии до проекции и
+            расстояние от точки до линии - массивы длины n
+    """
+    points = shapely.points(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    if not len(points) or not len(tree.geometries):
+        return np.empty(0, dtype=np.intp), np.empty(0), np.empty(0)
+    (point_index, line_index), distances = tree.query_nearest(points, all_matches=True, return_distance=True)
+    order = np.lexsort((line_index, point_index))
+    first = order[np.r_[True, point_index[order][1:] != point_index[order][:-1]]]
+    nearest = np.empty(len(points), dtype=np.intp)
+    nearest[point_index[first]] = line_index[first]
+    distance = np.empty(len(points))
+    distance[point_index[first]] = distances[first]
+    offsets = shapely.line_locate_point(tree.geometries[nearest], points)
+    return nearest, offsets, distance
+
+
+def road_junction(road_id, offset):
+    """Id узла на дороге r_<id> в offset метрах от её начала вдоль линии"""
+    return f"r_{road_id}_at_{offset:.2f}"
+
+
+def snap_offset(offset, length):
+    """
+    Куда привязать здание, проекция которого лежит в offset от начала дороги длины length
+
+    Returns:
+        'start' или 'end', если проекция ближе DIST_THRESHOLD к концу дороги,
+        иначе offset, округлённый до сантиметра (проекции в пределах сантиметра делят один узел)
+    """
+    if offset <= DIST_THRESHOLD:
+        return 'start'
+    if offset >= length - DIST_THRESHOLD:
+        return 'end'
+    return round(float(offset), 2)
+
+
+def crossing_node(x, y):
+    """Id узла пересечения дорог - по координатам, чтобы все дороги через точку делили один узел"""
+    return f"x_{x:.2f}_{y:.2f}"
+
+
+def building_cuts(road_id, offsets):
+    """Узлы привязки зданий на дороге: id узла -> расстояние от начала дороги"""
+    return {road_junction(road_id, offset): offset for offset in offsets}
+
+
+def road_contacts(lines, road_ids, query=None):
+    """
+    Точки, в которых дороги пересекаются или касаются друг друга вне своих концов
+
+    Пары дорог ищутся одним запросом к STRtree (ближе DIST_THRESHOLD), точки
+    считаются векторно для всех пар сразу:
+      - конец одной дороги лежит на середине другой (примыкание) - другая
+        дорога делится в этой точке узлом r_<id>_start/_end первой;
+      - дороги пересекаются вне концов обеих - обе делятся общим узлом crossing_node.
+    Касания концами остаются склейкам точек дорог (connect_road_points).
+
+    Args:
+        lines: массив LineString
+        road_ids: list - id дороги для каждой линии
+        query: номера линий, для которых искать пары (None - все); пары из двух
+            линий вне query не рассматриваются
+
+    Returns:
+        tuple: (dict id дороги -> {id узла: расстояние от начала дороги},
+                dict новый узел пересечения -> координаты)
+    """
+    lines = np.asarray(lines, dtype=object)
+    cuts = {}
+    crossings = {}
+    if not len(lines):
+        return cuts, crossings
+    query = np.arange(len(lines)) if query is None else np.asarray(query, dtype=np.intp)
+    in_query = np.zeros(len(lines), dtype=bool)
+    in_query[query] = True
+
+    tree = STRtree(lines)
+    source, target = tree.query(lines[query], predicate='dwithin', distance=DIST_THRESHOLD)
+    i, j = query[source], target
+    # Каждую пару берём один раз
+    keep = (i != j) & (~in_query[j] | (i < j))
+    i, j = i[keep], j[keep]
+    if not len(i):
+        return cuts, crossings
+
+    lengths = shapely.length(lines)
+    ends = {'start': shapely.get_point(lines, 0), 'end': shapely.get_point(lines, -1)}
+
+    def add(road, node, offset):
+        cuts.setdefault(road_ids[road], {})[node] = offset
+
+    def interior(line, offset):
+        return (offset > DIST_THRESHOLD) & (offset < lengths[line] - DIST_THRESHOLD)
+
+    # Примыкания: конец одной дороги на середине другой
+    for this, other in ((i, j), (j, i)):
+        for end, points in ends.items():
+            point = points[this]
+            offsets = shapely.line_locate_point(lines[other], point)
+            touching = (shapely.distance(point, lines[other]) <= DIST_THRESHOLD) & interior(other, offsets)
+            for road, line, offset in zip(this[touching].tolist(), other[touching].tolist(),
+                                          offsets[touching].tolist()):
+                add(line, f"r_{road_ids[road]}_{end}", offset)
+
+    # Пересечения вне концов обеих дорог
+    coords, owner = shapely.get_coordinates(shapely.intersection(lines[i], lines[j]), return_index=True)
+    points = shapely.points(coords)
+    a, b = i[owner], j[owner]
+    offsets_a = shapely.line_locate_point(lines[a], points)
+    offsets_b = shapely.line_locate_point(lines[b], points)
+    crossing = interior(a, offsets_a) & interior(b, offsets_b)
+    for (x, y), road_a, road_b, offset_a, offset_b in zip(coords[crossing].tolist(), a[crossing].tolist(),
+                                                           b[crossing].tolist(), offsets_a[crossing].tolist(),
+                                                           offsets_b[crossing].tolist()):
+        node = crossing_node(x, y)
+        crossings.setdefault(node, (x, y))
+        add(road_a, node, offset_a)
+        add(road_b, node, offset_b)
+    return cuts, crossings
+
+
+def add_crossing(G, node, coords):
+    """Добавляет узел пересечения дорог"""
+    G.add_node(node,
+               pos=coords,
+               node_type='junction',
+               node_color='blue',
+               node_size=50)
+
+
+def split_road(G, road_id, line, attributes, old_cuts, new_cuts):
+    """
+    Делит дорогу r_<id> на участки узлами new_cuts вместо old_cuts
+
+    Участок между соседними узлами получает вес, равный длине линии между
+    ними; id, road_type и is_footpath дороги сохраняются на каждом участке,
+    так что нагрузка участков сводится к исходной дороге. Недостающие узлы
+    привязки зданий создаются в точке на линии, остальные узлы (концы
+    других дорог, пересечения) должны уже быть в графе.
+
+    Args:
+        G: nx.Graph
+        road_id: str - id дороги
+        line: LineString дороги
+        attributes: dict - id, road_type, is_footpath дороги (road_attributes)
+        old_cuts, new_cuts: dict - id узла -> расстояние от начала линии
+
+    Returns:
+        tuple: (узлы, ушедшие из цепочки, добавленные узлы, новые рёбра цепочки)
+    """
+    start_point, end_point = f"r_{road_id}_start", f"r_{road_id}_end"
+
+    def chain(cuts):
+        ordered = sorted(cuts.items(), key=lambda item: (item[1], item[0]))
+        return [(start_point, 0.0)] + ordered + [(end_point, line.length)]
+
+    old_chain = [node for node, _ in chain(old_cuts)]
+    for u, v in zip(old_chain, old_chain[1:]):
+        if not G.has_edge(u, v):
+            continue
+        data = G.edges[u, v]
+        if 'ids' in data:
+            # Точки склеены - склейка остаётся отдельным ребром
+            ids = data['ids']
+            data.clear()
+            data.update(ids=ids, weight=np.linalg.norm(np.array(G.nodes[u]['pos']) - np.array(G.nodes[v]['pos'])))
+        else:
+            G.remove_edge(u, v)
+
+    added = []
+    for node, offset in new_cuts.items():
+        if node not in G:
+            point = shapely.line_interpolate_point(line, offset)
+            G.add_node(node,
+                       pos=(point.x, point.y),
                        node_type='junction',
                        node_color='blue',
                        node_size=50)
+            added.append(node)
 
-            # Добавляем ребро для дороги
-            distance = np.linalg.norm(np.array(start_coords) - np.array(end_coords))
-            road_type = feature['properties'].get('ROAD_CATEG', 'Unknown')
-            is_footpath = feature['properties'].get('Foot', 0) == 1
+    new_chain = chain(new_cuts)
+    edges = []
+    for (u, a), (v, b) in zip(new_chain, new_chain[1:]):
+        if u == v:
+            continue
+        G.add_edge(u, v, weight=b - a, **attributes)
+        edges.append((u, v))
+    return [node for node in old_cuts if node not in new_cuts], added, edges
+
+
+def road_point_pairs(tree):
+    """Пары номеров (i < j) точек дорог ближе DIST_THRESHOLD в порядке перебора i, j"""
+    pairs = tree.query_pairs(DIST_THRESHOLD, output_type='ndarray')
+    if not len(pairs):
+        return pairs.reshape(0, 2)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    distances = np.linalg.norm(tree.data[pairs[:, 0]] - tree.data[pairs[:, 1]], axis=1)
+    return pairs[distances < DIST_THRESHOLD]
+
+
+def road_length(coords):
+    """Длина ломаной дороги по её координатам"""
+    coords = np.asarray(coords, dtype=np.float64)[:, :2]
+    return float(np.hypot(*np.diff(coords, axis=0).T).sum())
+
+
+def road_attributes(feature, id):
+    """Атрибуты рёбер дороги, общие для всех её участков; width - ширина из слоя (None, если не задана)"""
+    width = feature['properties'].get('Width')
+    return {
+        'id': id,
+        'road_type': feature['properties'].get('ROAD_CATEG', 'Unknown'),
+        'is_footpath': feature['properties'].get('Foot', 0) == 1,
+        'width': float(width) if width is not None else None,
+    }
 
-            G.add_edge(start_point, end_point,
-                       id=id,
-                       weight=distance,
-                       road_type=road_type,
-                       is_footpath=is_footpath)
 
-    # Теперь добавляем здания и связываем их с ближайшими точками дорог
-    for feature in buildings_geojson['features']:
-        geom_type = feature['geometry']['type']
+def add_road(G, feature, id=None):
+    """
+    Добавляет дорогу: узлы начала и конца и ребро между ними
+
+    Args:
+        G: nx.Graph
+        feature: dict - feature дороги из geojson
+        id: str - id дороги (по умолчанию feature['id'])
+
+    Returns:
+        dict: id точки дороги -> координаты; пустой, если геометрия не LineString
+    """
+    if feature['geometry']['type'] != 'LineString':
+        return {}
+    coords = feature['geometry']['coordinates']
+    if id is None:
+        id = feature['id']
+    road_id = f"r_{id}"
+
+    # Добавляем узлы для начала и конца дороги
+    start_point = f"{road_id}_start"
+    end_point = f"{road_id}_end"
+
+    start_coords = (coords[0][0], coords[0][1])
+    end_coords = (coords[-1][0], coords[-1][1])
+
+    G.add_node(start_point,
+               pos=start_coords,
+               node_type='junction',
+               node_color='blue',
+               node_size=50)
+    G.add_node(end_point,
+               pos=end_coords,
+               node_type='junction',
+               node_color='blue',
+               node_size=50)
+
+    # Добавляем ребро для дороги длиной с её линию; развилки на ней делит split_road
+    G.add_edge(start_point, end_point,
+               weight=road_length(coords),
+               **road_attributes(feature, id))
+
+    return {start_point: start_coords, end_point: end_coords}
+
+
+def add_building(G, feature, feature_id, centroid, population=0.0):
+    """
+    Добавляет узел здания (остановки, выхода метро) в центроиде геометрии
+
+    Args:
+        G: nx.Graph
+        feature: dict - feature объекта из geojson
+        feature_id: str - id узла (None - b_<feature['id']>)
+        centroid: координаты центроида из building_centroids
+        population: float - число жителей из layer_population (атрибут population узла)
+
+    Returns:
+        tuple: координаты узла; None, если геометрия не поддерживается
+    """
+    if np.isnan(centroid).any():
+        return None
+    centroid_x, centroid_y = float(centroid[0]), float(centroid[1])
+    if feature_id is None:
         feature_id = f"b_{feature['id']}"
 
-        # Определяем тип объекта и его параметры
-        if feature['properties'].get('TrType'):
-            building_type = "ot"
-            node_type = 'transport_stop'
-            node_color = 'yellow'
-            node_size = 200
-        elif feature['properties'].get('Text') and feature['properties'].get('Number'):
-            building_type = "metro"
-            node_type = 'metro'
-            node_color = 'purple'
-            node_size = 300
-        elif feature['properties'].get('Type') == "Школы":
-            building_type = "school"
-            node_type = 'building'
-            node_color = 'red'
-            apartments = feature['properties'].get('Apartments')
-            node_size = 200
-        elif feature['properties'].get('Type') == "Дошкольные":
-            building_type = "sad"
-            node_type = 'building'
-            node_color = 'red'
-            apartments = feature['properties'].get('Apartments')
-            node_size = 200
-        else:
-            node_type = 'building'
-            building_type = "building"
-            node_color = 'red'
-            apartments = feature['properties'].get('Apartments')
-            apartments = 0 if apartments is None else float(apartments)
-            node_size = apartments / 10 + 100 if apartments else 100
-
-        # Вычисляем координаты центроида
-        if geom_type == 'Polygon':
-            centroid_x, centroid_y = calculate_polygon_centroid(feature['geometry']['coordinates'])
-        elif geom_type == 'MultiPolygon':
-            centroid_x, centroid_y = calculate_multipolygon_centroid(feature['geometry']['coordinates'])
-        elif geom_type == 'Point':
-            coords = feature['geometry']['coordinates']
-            centroid_x, centroid_y = coords[0], coords[1]
-        else:
-            continue
+    # Определяем тип объекта и его параметры
+    if feature['properties'].get('TrType'):
+        building_type = "ot"
+        node_type = 'transport_stop'
+        node_color = 'yellow'
+        node_size = 200
+    elif feature['properties'].get('Text') and feature['properties'].get('Number'):
+        building_type = "metro"
+        node_type = 'metro'
+        node_color = 'purple'
+        node_size = 300
+    elif feature['properties'].get('Type') == "Школы":
+        building_type = "school"
+        node_type = 'building'
+        node_color = 'red'
+        node_size = 200
+    elif feature['properties'].get('Type') == "Дошкольные":
+        building_type = "sad"
+        node_type = 'building'
+        node_color = 'red'
+        node_size = 200
+    else:
+        node_type = 'building'
+        building_type = "building"
+        node_color = 'red'
+        apartments = feature['properties'].get('Apartments')
+        apartments = 0 if apartments is None else float(apartments)
+        node_size = apartments / 10 + 100 if apartments else 100
+
+    # Добавляем узел здания в граф
+    G.add_node(feature_id,
+               pos=(centroid_x, centroid_y),
+               node_type=node_type,
+               building_type = building_type,
+               node_color=node_color,
+               node_size=node_size,
+               population=float(population))
+    return centroid_x, centroid_y
+
+
+def connect_building(G, feature_id, road_point):
+    """Связывает здание с точкой дороги ребром с весом, равным расстоянию между ними"""
+    distance = np.linalg.norm(np.array(G.nodes[feature_id]['pos']) - np.array(G.nodes[road_point]['pos']))
+    G.add_edge(feature_id, road_point,
+               id=None,
+               weight=distance,
+               road_type='building_connection',
+               is_footpath=True)
+
+
+def connect_road_points(G, node1, coords1, node2, coords2):
+    """Соединяет точки дорог, если расстояние между ними меньше DIST_THRESHOLD"""
+    distance = np.linalg.norm(np.array(coords1) - np.array(coords2))
+    if distance < DIST_THRESHOLD:
+        road_id = f"{node1}_{node2}"
+        G.add_edge(node1, node2, ids=[road_id], weight=distance)
+        return True
+    return False
+
 
+def snap_buildings(G, feature_ids, tree, road_ids):
+    """
+    Привязывает здания к ближайшим точкам на линиях дорог
+
+    Здание проецируется на ближайшую линию; если проекция не у конца дороги,
+    ребро дороги делится в этой точке новым узлом (split_road).
+
+    Args:
+        G: nx.Graph
+        feature_ids: list - id узлов зданий
+        tree: STRtree по линиям дорог
+        road_ids: list - id дороги для каждой линии дерева
+
+    Returns:
+        dict: id здания -> (id дороги, 'start' / 'end' / расстояние от начала дороги, расстояние до дороги)
+    """
+    positions = [G.nodes[feature_id]['pos'] for feature_id in feature_ids]
+    nearest, offsets, distances = project_to_roads(tree, positions)
+    lengths = shapely.length(tree.geometries)
+    return {feature_id: (road_ids[line], snap_offset(offset, lengths[line]), distance)
+            for feature_id, line, offset, distance in zip(feature_ids, nearest.tolist(), offsets.tolist(),
+                                                          distances.tolist())}
 
-        # Добавляем узел здания в граф
-        G.add_node(feature_id,
-                   pos=(centroid_x, centroid_y),
-                   node_type=node_type,
-                   building_type = building_type,
-                   node_color=node_color,
-                   node_size=node_size)
-
-        # Находим ближайшую точку дороги и создаем связь
-        nearest_road_point = find_nearest_road_point((centroid_x, centroid_y), road_points)
-        if nearest_road_point:
-            # Добавляем ребро между зданием и ближайшей точкой дороги
-            G.add_edge(feature_id, nearest_road_point,
-                       id=None,
-                       weight=1.0,
-                       road_type='building_connection',
-                       is_footpath=True)
-            G.add_edge(nearest_road_point, feature_id,
-                       id=None,
-                       weight=1.0,
-                       road_type='building_connection',
-                       is_footpath=True)
-
-    # Соединяем точки дорог, если они достаточно близки
-    road_nodes = list(road_points.keys())
-    for i in range(len(road_nodes)):
-        for j in range(i + 1, len(road_nodes)):
+
+def snap_node(road_id, target):
+    """Узел графа для привязки из snap_buildings"""
+    if target in ('start', 'end'):
+        return f"r_{road_id}_{target}"
+    return road_junction(road_id, target)
+
+
+@Metrics.timed("graph_build")
+def create_road_network_graph(buildings_geojson, roads_geojson):
+    # Создаем направленный граф
+    G = nx.Graph()
+
+    # Словарь для хранения точек дорог
+    road_points = {}
+    road_ids = []
+    lines = []
+    attributes = {}
+
+    # Сначала добавляем все дороги и их точки
+    for feature, line in zip(layer_features(roads_geojson), layer_geometries(roads_geojson)):
+        id = feature['id']
+        points = add_road(G, feature, id)
+        if points:
+            road_points.update(points)
+            road_ids.append(id)
+            lines.append(line)
+            attributes[id] = road_attributes(feature, id)
+
+    # Пересечения и примыкания дорог
+    cuts, crossings = road_contacts(lines, road_ids)
+    for node, coords in crossings.items():
+        add_crossing(G, node, coords)
+
+    # Теперь добавляем здания
+    features = layer_features(buildings_geojson)
+    centroids = building_centroids(layer_geometries(buildings_geojson))
+    population = layer_population(buildings_geojson)
+    feature_ids = []
+    for feature, centroid, residents in zip(features, centroids, population):
+        feature_id = f"b_{feature['id']}"
+        if add_building(G, feature, feature_id, centroid, residents) is not None:
+            feature_ids.append(feature_id)
+
+    # Привязываем здания к ближайшим точкам на линиях дорог одним запросом к STRtree
+    snaps = {}
+    if lines:
+        snaps = snap_buildings(G, feature_ids, STRtree(lines), road_ids)
+        for road_id, target, _ in snaps.values():
+            if target not in ('start', 'end'):
+                cuts.setdefault(road_id, {}).update(building_cuts(road_id, [target]))
+
+    # Делим дороги на участки в точках пересечений и привязки зданий
+    line_of = dict(zip(road_ids, lines))
+    for road_id, road_cuts in cuts.items():
+        split_road(G, road_id, line_of[road_id], attributes[road_id], {}, road_cuts)
+    for feature_id, (road_id, target, _) in snaps.items():
+        connect_building(G, feature_id, snap_node(road_id, target))
+
+    # Соединяем концы дорог, если они достаточно близки
+    if road_points:
+        road_nodes = list(road_points.keys())
+        tree = KDTree(np.array(list(road_points.values())).reshape(-1, 2))
+        for i, j in road_point_pairs(tree).tolist():
             node1 = road_nodes[i]
             node2 = road_nodes[j]
-            coords1 = np.array(road_points[node1])
-            coords2 = np.array(road_points[node2])
-
-            # Если расстояние между точками меньше порога, соединяем их
-            if np.linalg.norm(coords1 - coords2) < DIST_THRESHOLD:
-                road_id = f"{node1}_{node2}"
-                G.add_edge(node1, node2, ids=[road_id], weight=np.linalg.norm(coords1 - coords2))
+            connect_road_points(G, node1, road_points[node1], node2, road_points[node2])
 
     return G
 
@@ -316,8 +729,9 @@ def get_typed_nodes(G, type = "building"):
 
 
 def get_graph(buildings, roads):
-    G = create_road_network_graph(buildings, roads)
-    return get_largest_connected_component(G)
+    G = get_largest_connected_component(create_road_network_graph(buildings, roads))
+    Metrics.record_graph(G)
+    return G
 
 
 def clean_graph_attributes(G):
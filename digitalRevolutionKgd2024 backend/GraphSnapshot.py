@@ -0,0 +1,213 @@
+import json
+import os
+import pickle
+import shutil
+
+import networkx as nx
+import numpy as np
+
+from ParallelSimulation import load_arrays, save_arrays
+from RoutingGraph import RoutingGraph, encode_strings, decode_strings
+
+# Меняется при изменении формата снимка - снимок другой версии не читается
+SNAPSHOT_VERSION = 1
+SNAPSHOT_PATH = "graph_snapshot"
+META_FILE = "meta.json"
+
+
+def graph_to_arrays(G):
+    """
+    Раскладывает граф networkx в плоские массивы без потерь
+
+    Топология, веса и id рёбер хранятся массивами RoutingGraph.to_arrays, так что
+    граф для маршрутизации открывается из снимка без конвертации. Атрибуты узлов
+    и рёбер хранятся столбцами по номеру узла (ребра) RoutingGraph. Тип столбца
+    выбирается по значениям:
+      - bool, int, float - массив своего типа;
+      - str (и None) - таблица строк;
+      - point - кортежи из двух чисел (pos), массив (n, 2);
+      - json - всё остальное (списки, смешанные типы) - таблица строк JSON.
+    Маска <столбец>_present отмечает узлы (рёбра), у которых атрибут задан.
+
+    Args:
+        G: nx.Graph - граф дорожной сети
+
+    Returns:
+        tuple: (arrays, meta) - словарь массивов и описание столбцов для meta.json
+    """
+    routing = RoutingGraph.from_networkx(G)
+    arrays = routing.to_arrays()
+
+    index = routing.index
+    node_attrs = [None] * routing.num_nodes
+    for node, attrs in G.nodes(data=True):
+        node_attrs[index[node]] = attrs
+    # Номера рёбер RoutingGraph идут в порядке G.edges
+    edge_attrs = [attrs for _, _, attrs in G.edges(data=True)]
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "nodes": routing.num_nodes,
+        "edges": routing.num_edges,
+        "graph": dict(G.graph),
+        "node_columns": _encode_columns(arrays, "node", node_attrs),
+        "edge_columns": _encode_columns(arrays, "edge", edge_attrs),
+    }
+    return arrays, meta
+
+
+def graph_from_arrays(arrays, meta):
+    """
+    Обратное к graph_to_arrays: граф networkx с тем же порядком узлов, соседей и рёбер
+
+    Returns:
+        nx.Graph
+    """
+    node_ids = decode_strings(arrays, "node_ids")
+    node_attrs = _decode_columns(arrays, "node", meta["node_columns"], meta["nodes"])
+    edge_attrs = _decode_columns(arrays, "edge", meta["edge_columns"], meta["edges"])
+
+    G = nx.Graph()
+    G.graph.update(meta["graph"])
+    order = arrays["order"].tolist()
+    G.add_nodes_from((node_ids[i], node_attrs[i]) for i in order)
+
+    # Списки соседей заполняются напрямую: add_edge добавлял бы соседа сразу к обоим концам
+    # и менял порядок обхода, от которого зависит выбор среди равных по длине маршрутов
+    offsets = arrays["offsets"].tolist()
+    targets = arrays["targets"].tolist()
+    edge_index = arrays["edge_index"].tolist()
+    adj = G._adj
+    for i in order:
+        neighbors = adj[node_ids[i]]
+        for k in range(offsets[i], offsets[i + 1]):
+            neighbors[node_ids[targets[k]]] = edge_attrs[edge_index[k]]
+    return G
+
+
+def save_snapshot(G, path=SNAPSHOT_PATH):
+    """
+    Записывает снимок графа в каталог path: <массив>.npy и meta.json
+
+    Каталог заменяется целиком, читатели не видят наполовину записанный снимок.
+    """
+    arrays, meta = graph_to_arrays(G)
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    save_arrays(tmp_path, arrays)
+    with open(os.path.join(tmp_path, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    old_path = f"{path}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def open_snapshot(path=SNAPSHOT_PATH, mmap_mode="r"):
+    """
+    Открывает массивы снимка; с mmap_mode="r" они не читаются в память, а
+    отображаются, и страницы файлов делят все процессы, открывшие снимок
+
+    Returns:
+        tuple: (arrays, meta)
+
+    Raises:
+        ValueError: снимок записан другой версией формата
+    """
+    with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Версия снимка {meta.get('version')} не поддерживается (нужна {SNAPSHOT_VERSION})")
+    return load_arrays(path, mmap_mode), meta
+
+
+def load_routing_graph(path=SNAPSHOT_PATH, pickle_path="graph.pkl"):
+    """
+    RoutingGraph из снимка; если снимка нет - из графа networkx в pickle_path
+
+    Returns:
+        RoutingGraph
+    """
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        with open(pickle_path, "rb") as f:
+            return RoutingGraph.from_networkx(pickle.load(f))
+    arrays, _ = open_snapshot(path)
+    return RoutingGraph.from_arrays(arrays)
+
+
+def load_networkx(path=SNAPSHOT_PATH):
+    """Граф networkx из снимка (см. graph_from_arrays)"""
+    arrays, meta = open_snapshot(path)
+    return graph_from_arrays(arrays, meta)
+
+
+def _column_kind(values):
+    if all(isinstance(value, (bool, np.bool_)) for value in values):
+        return "bool"
+    if all(isinstance(value, (int, np.integer)) and not isinstance(value, (bool, np.bool_)) for value in values):
+        return "int"
+    if all(isinstance(value, (float, np.floating)) for value in values):
+        return "float"
+    if all(value is None or isinstance(value, str) for value in values) and any(values):
+        return "str"
+    if all(type(value) is tuple and len(value) == 2 and all(isinstance(x, (float, np.floating)) for x in value)
+           for value in values):
+        return "point"
+    return "json"
+
+
+def _encode_columns(arrays, prefix, records):
+    names = list(dict.fromkeys(name for attrs in records for name in attrs))
+    columns = []
+    for number, name in enumerate(names):
+        key = f"{prefix}_attr_{number}"
+        present = np.array([name in attrs for attrs in records], dtype=bool)
+        values = [attrs[name] for attrs in records if name in attrs]
+        kind = _column_kind(values)
+        # Значения лежат по номеру узла (ребра); где атрибута нет - заполнитель
+        if kind == "bool":
+            column = np.zeros(len(records), dtype=bool)
+            column[present] = values
+        elif kind == "int":
+            column = np.zeros(len(records), dtype=np.int64)
+            column[present] = values
+        elif kind == "float":
+            column = np.full(len(records), np.nan)
+            column[present] = values
+        elif kind == "point":
+            column = np.full((len(records), 2), np.nan)
+            column[present] = values
+        if kind in ("str", "json"):
+            if kind == "json":
+                values = [json.dumps(value, ensure_ascii=False) for value in values]
+            padded = [None] * len(records)
+            for i, value in zip(np.flatnonzero(present).tolist(), values):
+                padded[i] = value
+            arrays.update(encode_strings(key, padded))
+        else:
+            arrays[key] = column
+        arrays[f"{key}_present"] = present
+        columns.append({"name": name, "kind": kind})
+    return columns
+
+
+def _decode_columns(arrays, prefix, columns, count):
+    records = [{} for _ in range(count)]
+    for number, column in enumerate(columns):
+        key = f"{prefix}_attr_{number}"
+        name, kind = column["name"], column["kind"]
+        present = np.flatnonzero(arrays[f"{key}_present"]).tolist()
+        if kind in ("str", "json"):
+            values = decode_strings(arrays, key)
+            if kind == "json":
+                values = [None if value is None else json.loads(value) for value in values]
+        elif kind == "point":
+            values = [tuple(point) for point in arrays[key].tolist()]
+        else:
+            values = arrays[key].tolist()
+        for i in present:
+            records[i][name] = values[i]
+    return records
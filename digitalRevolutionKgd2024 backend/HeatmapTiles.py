@@ -0,0 +1,203 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import shapely
+from PIL import Image, ImageDraw
+from shapely import STRtree
+
+TILE_SIZE = 256
+# Половина ширины мира в EPSG:3857 (метры)
+WORLD_HALF = 20037508.342789244
+MAX_ZOOM = 22
+
+# Цвет дороги от малой нагрузки к большой: зелёный -> жёлтый -> красный
+RAMP = np.array([
+    [26, 152, 80],
+    [254, 224, 60],
+    [215, 25, 28],
+], dtype=np.float64)
+
+
+def tile_bounds(z, x, y):
+    """Границы тайла z/x/y (схема XYZ, y сверху вниз) в EPSG:3857: (xmin, ymin, xmax, ymax)"""
+    size = 2 * WORLD_HALF / 2 ** z
+    xmin = -WORLD_HALF + x * size
+    ymax = WORLD_HALF - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def line_width(z):
+    """Толщина линии дороги в пикселях на уровне z"""
+    return int(np.clip(round(1 + (z - 12) * 0.75), 1, 8))
+
+
+def load_colors(loads, scale):
+    """
+    Цвета RGBA для нагрузок: положение на шкале RAMP - доля от scale
+
+    Returns:
+        np.ndarray[uint8]: (len(loads), 4)
+    """
+    share = np.clip(np.asarray(loads, dtype=np.float64) / scale, 0, 1) * (len(RAMP) - 1)
+    lower = np.minimum(share.astype(np.int64), len(RAMP) - 2)
+    fraction = (share - lower)[:, None]
+    rgb = RAMP[lower] * (1 - fraction) + RAMP[lower + 1] * fraction
+    alpha = np.full((len(rgb), 1), 255.0)
+    return np.hstack([rgb, alpha]).round().astype(np.uint8)
+
+
+def _png(image):
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", optimize=False)
+    return buffer.getvalue()
+
+
+EMPTY_TILE = _png(Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)))
+
+
+class HeatmapTiles:
+    """
+    Растровые тайлы z/x/y (EPSG:3857) с нагрузкой на дороги одного прогона
+
+    Нагрузка присоединяется к линиям дорог по id один раз, линии с нагрузкой
+    кладутся в STRtree. Тайл рисуется при первом запросе: дороги, попавшие в
+    тайл, рисуются линиями по возрастанию нагрузки (загруженные - сверху).
+    Готовые тайлы хранятся в LRU в памяти на memory_tiles штук и на диске в
+    cache_dir/<key>/z/x/y.png.
+    """
+
+    def __init__(self, key, roads, loads, cache_dir=None, memory_tiles=512):
+        """
+        Args:
+            key: str - ключ кэша (id прогона)
+            roads: GeoDataFrame - дороги со столбцом id в EPSG:3857 (GraphState.roads_frame)
+            loads: dict - id дороги -> нагрузка (формат trafic.json)
+            cache_dir: str - каталог дискового кэша (None - только память)
+            memory_tiles: int - число тайлов в памяти
+        """
+        self.key = key
+        self.directory = os.path.join(cache_dir, key) if cache_dir else None
+        self.memory_tiles = memory_tiles
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+        road_loads = roads["id"].map({road: load for road, load in loads.items() if road is not None})
+        road_loads = road_loads.fillna(0).to_numpy(dtype=np.float64)
+        loaded = road_loads > 0
+        order = np.argsort(road_loads[loaded], kind="stable")
+        self.lines = np.asarray(roads.geometry)[loaded][order]
+        self.loads = road_loads[loaded][order]
+        # Шкала - 95-й процентиль, чтобы единичные пики не делали остальную сеть зелёной
+        self.scale = float(np.percentile(self.loads, 95)) if len(self.loads) else 1.0
+        self.colors = load_colors(self.loads, max(self.scale, 1.0))
+        self.tree = STRtree(self.lines)
+
+    def tile(self, z, x, y):
+        """
+        PNG тайла z/x/y: из памяти, с диска или отрисованный заново
+
+        Raises:
+            ValueError: тайла с такими номерами нет
+
+        Returns:
+            bytes
+        """
+        if not (0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise ValueError(f"Нет тайла {z}/{x}/{y}")
+        with self._lock:
+            png = self._tiles.get((z, x, y))
+            if png is not None:
+                self._tiles.move_to_end((z, x, y))
+                return png
+
+        path = os.path.join(self.directory, str(z), str(x), f"{y}.png") if self.directory else None
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                png = f.read()
+        else:
+            png = self.render(z, x, y)
+            if path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(png)
+                os.replace(tmp_path, path)
+
+        with self._lock:
+            self._tiles[(z, x, y)] = png
+            while len(self._tiles) > self.memory_tiles:
+                self._tiles.popitem(last=False)
+        return png
+
+    def render(self, z, x, y):
+        """Рисует тайл z/x/y; тайл без дорог - общий прозрачный EMPTY_TILE"""
+        xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+        resolution = (xmax - xmin) / TILE_SIZE
+        width = line_width(z)
+        # Линии у края тайла тоже задевают его своей толщиной
+        margin = width * resolution
+        hits = self.tree.query(shapely.box(xmin - margin, ymin - margin, xmax + margin, ymax + margin))
+        if not len(hits):
+            return EMPTY_TILE
+        hits.sort()  # порядок по возрастанию нагрузки
+
+        coords, index = shapely.get_coordinates(self.lines[hits], return_index=True)
+        pixels = np.empty_like(coords)
+        pixels[:, 0] = (coords[:, 0] - xmin) / resolution
+        pixels[:, 1] = (ymax - coords[:, 1]) / resolution
+        starts = np.searchsorted(index, np.arange(len(hits) + 1))
+
+        image = Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        for k, hit in enumerate(hits.tolist()):
+            points = pixels[starts[k]:starts[k + 1]].ravel().tolist()
+            if len(points) >= 4:
+                draw.line(points, fill=tuple(self.colors[hit].tolist()), width=width, joint="curve")
+        return _png(image)
+
+    def clear(self):
+        """Удаляет тайлы из памяти и с диска"""
+        with self._lock:
+            self._tiles.clear()
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class HeatmapCache:
+    """
+    Наборы тайлов по ключу прогона
+
+    Набор создаётся при первом запросе тайла прогона. Новый прогон даёт новый
+    ключ, и тайлы прежних прогонов сверх keep_runs удаляются из памяти и с
+    диска, так что устаревшие тайлы не отдаются и не копятся.
+    """
+
+    def __init__(self, cache_dir="tiles", keep_runs=2, memory_tiles=512):
+        self.cache_dir = cache_dir
+        self.keep_runs = keep_runs
+        self.memory_tiles = memory_tiles
+        self._sets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, make_roads, make_loads):
+        """
+        Набор тайлов прогона key; make_roads() и make_loads() вызываются, только если его ещё нет
+
+        Returns:
+            HeatmapTiles
+        """
+        with self._lock:
+            tiles = self._sets.get(key)
+            if tiles is not None:
+                self._sets.move_to_end(key)
+                return tiles
+            tiles = HeatmapTiles(key, make_roads(), make_loads(), self.cache_dir, self.memory_tiles)
+            self._sets[key] = tiles
+            while len(self._sets) > self.keep_runs:
+                _, stale = self._sets.popitem(last=False)
+                stale.clear()
+            return tiles
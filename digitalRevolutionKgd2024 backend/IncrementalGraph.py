@@ -0,0 +1,416 @@
+import hashlib
+import json
+import os
+import pickle
+
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+import shapely
+from scipy.spatial import KDTree
+from shapely import STRtree
+
+import Graph
+import Metrics
+
+# Меняется при изменении формата состояния или правил его обновления - старое состояние тогда не читается
+STATE_VERSION = 6
+
+
+def feature_keys(features):
+    """
+    Ключи объектов geojson, не зависящие от их порядка в слое
+
+    Ключ - SHA-1 от геометрии и свойств; одинаковые объекты различаются
+    номером повтора. Id из to_json() для этого не годятся: это номер строки,
+    и после добавления одного ЖК номера остальных объектов сдвигаются.
+
+    Returns:
+        dict: ключ -> feature
+    """
+    keyed = {}
+    seen = {}
+    for feature in features:
+        content = json.dumps({"geometry": feature["geometry"], "properties": feature["properties"]},
+                             sort_keys=True, ensure_ascii=False, default=str)
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        repeat = seen.get(digest, 0)
+        seen[digest] = repeat + 1
+        keyed[f"{digest}:{repeat}"] = feature
+    return keyed
+
+
+class ComponentIndex:
+    """
+    Компоненты связности графа, которые обновляются вместе с графом
+
+    Каждый узел помечен меткой компоненты, для метки хранится множество узлов.
+    Добавление ребра сливает меньшую компоненту в большую. Удаление узла
+    степени больше 1 может разбить компоненту - она помечается и при refresh()
+    заново разбирается обходом только по своим узлам. Удаление висячих узлов
+    (зданий) компоненту не разбивает и обхода не требует.
+    """
+
+    def __init__(self):
+        self.labels = {}
+        self.members = {}
+        self.dirty = set()
+
+    def add_node(self, node):
+        self.labels[node] = node
+        self.members[node] = {node}
+
+    def add_edge(self, u, v):
+        a, b = self.labels[u], self.labels[v]
+        if a == b:
+            return
+        if len(self.members[a]) < len(self.members[b]):
+            a, b = b, a
+        for node in self.members[b]:
+            self.labels[node] = a
+        self.members[a] |= self.members.pop(b)
+        if b in self.dirty:
+            self.dirty.discard(b)
+            self.dirty.add(a)
+
+    def remove_node(self, node, may_split=True):
+        label = self.labels.pop(node)
+        members = self.members[label]
+        members.discard(node)
+        if not members:
+            del self.members[label]
+            self.dirty.discard(label)
+        elif may_split:
+            self.dirty.add(label)
+
+    def mark(self, node):
+        """Помечает компоненту узла для пересчёта, например после удаления рёбер"""
+        self.dirty.add(self.labels[node])
+
+    def detach(self, node):
+        """Выделяет висячий узел, у которого удалили единственное ребро, в отдельную компоненту"""
+        self.remove_node(node, may_split=False)
+        self.add_node(node)
+
+    def refresh(self, G):
+        """Пересчитывает компоненты, которые могли разбиться после удалений"""
+        for label in self.dirty:
+            for component in nx.connected_components(G.subgraph(self.members.pop(label))):
+                new_label = next(iter(component))
+                self.members[new_label] = component
+                for node in component:
+                    self.labels[node] = new_label
+        self.dirty = set()
+
+    def largest(self):
+        if not self.members:
+            return set()
+        return max(self.members.values(), key=len)
+
+
+class GraphState:
+    """
+    Полный граф дорожной сети (до выделения наибольшей компоненты) и слои, из которых он собран
+
+    Хранится между загрузками. update() сравнивает новые слои с прошлыми по
+    feature_keys и меняет в графе только затронутое: узлы удалённых и новых
+    дорог и зданий, склейки концов дорог рядом с новыми концами, пересечения
+    и примыкания новых дорог, привязки зданий, для которых изменилась
+    ближайшая дорога, и деление на участки тех дорог, у которых изменился
+    набор узлов на линии. Узлы, оставшиеся
+    в графе, сохраняют свои id, новые получают id, которые ещё не выдавались.
+    """
+
+    def __init__(self):
+        self.G = nx.Graph()
+        self.roads = {}
+        self.buildings = {}
+        self.road_points = {}
+        self.lines = {}
+        self.attributes = {}
+        self.offsets = {}
+        self.contacts = {}
+        self.contact_roads = {}
+        self.chains = {}
+        self.snaps = {}
+        self.road_buildings = {}
+        self.components = ComponentIndex()
+        self.issued_roads = set()
+        self.issued_buildings = set()
+        self.next_id = 0
+
+    @classmethod
+    def build(cls, buildings_geojson, roads_geojson):
+        """Собирает состояние с нуля; id узлов берутся из слоёв, как в Graph.create_road_network_graph"""
+        state = cls()
+        state.update(buildings_geojson, roads_geojson)
+        return state
+
+    def graph(self):
+        """Наибольшая компонента связности, как в Graph.get_graph"""
+        return self.G.subgraph(self.components.largest()).copy()
+
+    @Metrics.timed("graph_update")
+    def update(self, buildings_geojson, roads_geojson):
+        """
+        Приводит граф к новым слоям
+
+        Args:
+            buildings_geojson: GeoDataFrame или dict geojson - результат GeojsonService.add_base_objects
+            roads_geojson: GeoDataFrame или dict geojson - результат GeojsonService.add_roads (None - дорог нет)
+
+        Returns:
+            dict: число добавленных и удалённых дорог и зданий и перепривязанных зданий
+        """
+        new_roads = feature_keys(Graph.layer_features(roads_geojson))
+        new_buildings = feature_keys(Graph.layer_features(buildings_geojson))
+        population = dict(zip(new_buildings, Graph.layer_population(buildings_geojson)))
+        removed_roads = [key for key in self.roads if key not in new_roads]
+        added_roads = [key for key in new_roads if key not in self.roads]
+        removed_buildings = [key for key in self.buildings if key not in new_buildings]
+        added_buildings = [key for key in new_buildings if key not in self.buildings]
+
+        # Удаляем дороги вместе с их участками и узлами; здания, привязанные к ним, нужно привязать заново
+        orphans = set()
+        touched = set()
+        for key in removed_roads:
+            road_id = self.roads.pop(key)
+            if road_id is None:
+                continue
+            for node in self.road_buildings.pop(road_id, ()):
+                del self.snaps[node]
+                orphans.add(node)
+            touched.update(self._remove_road(road_id))
+
+        for key in removed_buildings:
+            node = self.buildings.pop(key)
+            orphans.discard(node)
+            if node is not None:
+                touched.update(self._unsnap(node))
+                self._remove_node(node)
+
+        # Новые дороги и связи их концов с близкими концами дорог
+        added_points = {}
+        added_lines = []
+        features = [new_roads[key] for key in added_roads]
+        for key, feature, line in zip(added_roads, features, Graph.feature_geometries(features)):
+            road_id = self._issue(feature['id'], self.issued_roads)
+            points = Graph.add_road(self.G, feature, road_id)
+            self.roads[key] = road_id if points else None
+            if points:
+                for point in points:
+                    self.components.add_node(point)
+                self.components.add_edge(*points)
+                self.lines[road_id] = line
+                self.attributes[road_id] = Graph.road_attributes(feature, road_id)
+                added_lines.append(line)
+            added_points.update(points)
+        self.road_points.update(added_points)
+
+        # Пересечения и примыкания новых дорог - с любыми дорогами
+        if added_lines:
+            road_ids = list(self.lines)
+            query = np.arange(len(road_ids) - len(added_lines), len(road_ids))
+            cuts, crossings = Graph.road_contacts([self.lines[road_id] for road_id in road_ids], road_ids, query)
+            for node, coords in crossings.items():
+                if node not in self.G:
+                    Graph.add_crossing(self.G, node, coords)
+                    self.components.add_node(node)
+            for road_id, road_cuts in cuts.items():
+                self.contacts.setdefault(road_id, {}).update(road_cuts)
+                for node in road_cuts:
+                    self.contact_roads.setdefault(node, set()).add(road_id)
+                touched.add(road_id)
+
+        if added_points:
+            road_nodes = list(self.road_points)
+            tree = KDTree(np.array([self.road_points[node] for node in road_nodes]))
+            position = {node: i for i, node in enumerate(road_nodes)}
+            added_coords = np.array(list(added_points.values()))
+            for node1, close in zip(added_points, tree.query_ball_point(added_coords, Graph.DIST_THRESHOLD)):
+                i = position[node1]
+                for j in close:
+                    node2 = road_nodes[j]
+                    # Пару из двух новых точек соединяем один раз; порядок id как в полном построении
+                    if j == i or (node2 in added_points and j < i):
+                        continue
+                    first, second = (node2, node1) if j < i else (node1, node2)
+                    if Graph.connect_road_points(self.G, first, self.road_points[first],
+                                                 second, self.road_points[second]):
+                        self.components.add_edge(first, second)
+
+        # Перепривязываем здания: осиротевшие и те, к которым новая дорога ближе прежней
+        rebound = set(orphans)
+        if added_lines and self.snaps:
+            existing = list(self.snaps)
+            positions = shapely.points(np.array([self.G.nodes[node]['pos'] for node in existing]))
+            (index, _), distances = STRtree(added_lines).query_nearest(positions, return_distance=True)
+            nearest_added = np.full(len(existing), np.inf)
+            np.minimum.at(nearest_added, index, distances)
+            current = np.array([self.snaps[node][2] for node in existing])
+            rebound.update(node for node, closer in zip(existing, nearest_added < current) if closer)
+        for node in rebound:
+            if node not in orphans:
+                touched.update(self._unsnap(node))
+                for road_point in list(self.G.neighbors(node)):
+                    self.G.remove_edge(node, road_point)
+            self.components.detach(node)
+
+        # Новые здания
+        features = [new_buildings[key] for key in added_buildings]
+        centroids = Graph.building_centroids(Graph.feature_geometries(features))
+        added_nodes = []
+        for key, feature, centroid in zip(added_buildings, features, centroids):
+            node = f"b_{self._issue(feature['id'], self.issued_buildings)}"
+            if Graph.add_building(self.G, feature, node, centroid, population[key]) is None:
+                self.buildings[key] = None
+                continue
+            self.buildings[key] = node
+            self.components.add_node(node)
+            added_nodes.append(node)
+
+        # Проекции на ближайшие линии дорог одним запросом к STRtree
+        snaps = {}
+        if self.lines:
+            road_ids = list(self.lines)
+            tree = STRtree([self.lines[road_id] for road_id in road_ids])
+            snaps = Graph.snap_buildings(self.G, list(rebound) + added_nodes, tree, road_ids)
+        for node, snap in snaps.items():
+            self.snaps[node] = snap
+            self.road_buildings.setdefault(snap[0], set()).add(node)
+            touched.add(snap[0])
+
+        # Заново делим на участки дороги, у которых изменились узлы на линии
+        for road_id in touched:
+            if road_id not in self.lines:
+                continue
+            self.offsets[road_id] = ({self.snaps[node][1] for node in self.road_buildings.get(road_id, ())}
+                                     - {'start', 'end'})
+            old = self.chains.get(road_id, {})
+            new = dict(self.contacts.get(road_id, {}))
+            new.update(Graph.building_cuts(road_id, self.offsets[road_id]))
+            if new == old:
+                continue
+            dropped, added, edges = Graph.split_road(self.G, road_id, self.lines[road_id],
+                                                     self.attributes[road_id], old, new)
+            for node in dropped:
+                # Узел привязки зданий больше не нужен; цепочка участков заново соединяет дорогу,
+                # так что компонента не разбивается
+                if node in self.G and node.startswith(f"r_{road_id}_at_"):
+                    self.G.remove_node(node)
+                    self.components.remove_node(node, may_split=False)
+            for node in added:
+                self.components.add_node(node)
+            for u, v in edges:
+                self.components.add_edge(u, v)
+            self.chains[road_id] = new
+
+        for node, (road_id, target, _) in snaps.items():
+            road_point = Graph.snap_node(road_id, target)
+            Graph.connect_building(self.G, node, road_point)
+            self.components.add_edge(node, road_point)
+
+        self.components.refresh(self.G)
+        return {
+            "roads_added": len(added_roads),
+            "roads_removed": len(removed_roads),
+            "buildings_added": len(added_buildings),
+            "buildings_removed": len(removed_buildings),
+            "buildings_rebound": len(rebound),
+        }
+
+    def roads_frame(self):
+        """Дороги графа в EPSG:3857: GeoDataFrame с id, road_type, is_footpath и линией дороги"""
+        road_ids = list(self.lines)
+        return gpd.GeoDataFrame({
+            "id": road_ids,
+            "road_type": [self.attributes[road_id]["road_type"] for road_id in road_ids],
+            "is_footpath": [self.attributes[road_id]["is_footpath"] for road_id in road_ids],
+        }, geometry=[self.lines[road_id] for road_id in road_ids], crs="EPSG:3857")
+
+    def save(self, path="graph_state.pkl"):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"version": STATE_VERSION, "state": self}, f)
+        os.replace(tmp_path, path)
+
+    def _issue(self, feature_id, issued):
+        # Id из слоя, если он ещё не выдавался, иначе следующий свободный номер
+        id = str(feature_id) if feature_id is not None else None
+        if id is None or id in issued:
+            id = str(self.next_id)
+            while id in self.issued_roads or id in self.issued_buildings:
+                self.next_id += 1
+                id = str(self.next_id)
+        issued.add(id)
+        if id.isdigit():
+            self.next_id = max(self.next_id, int(id) + 1)
+        return id
+
+    def _remove_node(self, node):
+        degree = self.G.degree(node)
+        self.G.remove_node(node)
+        self.components.remove_node(node, may_split=degree > 1)
+
+    def _remove_road(self, road_id):
+        # Удаляет участки и узлы дороги; возвращает дороги, которые нужно заново поделить на участки
+        touched = set()
+        start_point, end_point = f"r_{road_id}_start", f"r_{road_id}_end"
+        chain = self.chains.pop(road_id, {})
+        nodes = [start_point] + sorted(chain, key=chain.get) + [end_point]
+        for u, v in zip(nodes, nodes[1:]):
+            if not self.G.has_edge(u, v) or self.G.edges[u, v].get('id') != road_id:
+                continue
+            data = self.G.edges[u, v]
+            if 'ids' in data:
+                # Участок совпал со склейкой концов других дорог - склейка остаётся, как в Graph.split_road
+                ids = data['ids']
+                data.clear()
+                data.update(ids=ids, weight=np.linalg.norm(np.array(self.G.nodes[u]['pos'])
+                                                           - np.array(self.G.nodes[v]['pos'])))
+            else:
+                self.G.remove_edge(u, v)
+        # Участки удалены без учёта компонент - компоненту дороги нужно пересчитать
+        self.components.mark(start_point)
+
+        # Пересечения, на которых осталась одна дорога, и примыкания концов этой дороги к другим
+        for node in self.contacts.pop(road_id, {}):
+            roads = self.contact_roads[node]
+            roads.discard(road_id)
+            if node.startswith("x_") and len(roads) < 2:
+                for other in roads:
+                    self.contacts[other].pop(node)
+                    touched.add(other)
+                del self.contact_roads[node]
+                self._remove_node(node)
+        for point in (start_point, end_point):
+            for other in self.contact_roads.pop(point, ()):
+                self.contacts[other].pop(point)
+                touched.add(other)
+
+        junctions = [Graph.road_junction(road_id, offset) for offset in self.offsets.pop(road_id, ())]
+        for node in [start_point, end_point] + junctions:
+            self._remove_node(node)
+            self.road_points.pop(node, None)
+        del self.lines[road_id]
+        del self.attributes[road_id]
+        return touched
+
+    def _unsnap(self, node):
+        # Снимает привязку здания; возвращает дорогу, набор точек которой мог измениться
+        snap = self.snaps.pop(node, None)
+        if snap is None:
+            return ()
+        self.road_buildings[snap[0]].discard(node)
+        return (snap[0],)
+
+
+def load_state(path="graph_state.pkl"):
+    """Читает состояние, сохранённое GraphState.save; None, если его нет или формат устарел"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        stored = pickle.load(f)
+    if stored.get("version") != STATE_VERSION:
+        return None
+    return stored["state"]
@@ -1,156 +1,413 @@
-import random
 import json
-import pickle
-from collections import Counter
-import networkx as nx
-import Graph
-from collections import Counter
+import time
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import AStar_GOD as Astar
-
-
-def assign_choice():
-    choices = ['school', 'sad', 'metro', 'ot', 'skip', 'default']
-    probabilities = [0.05, 0.05, 0.05, 0.05, 0.35, 0.45]
-    return random.choices(choices, probabilities)[0]
-
-
-def choose_route():
-    # Генерация случайного числа от 0 до 1
-    rand_value = random.random()
-    if rand_value < 0.7:
-        return 1  # 70% вероятность — по 1 маршруту
-    elif rand_value < 0.9:
-        return 2  # 20% вероятность — по 2 маршруту
+import AlternativeRoutes
+import FacilityIndex
+import GraphSnapshot
+import Metrics
+import ParallelSimulation
+from RouteCache import RouteCache
+
+# Модель поведения жителя
+STAY_HOME_PROBABILITY = 0.3  # доля жителей, которые никуда не идут
+CHOICES = ['school', 'sad', 'metro', 'ot', 'skip', 'default']
+CHOICE_PROBABILITIES = [0.05, 0.05, 0.05, 0.05, 0.35, 0.45]
+ROUTE_PROBABILITIES = [0.7, 0.2, 0.1]  # вероятности 1, 2 и 3 маршрута
+METRO_DISTANCE = 1000  # при 'default' до метро ближе этого идут в метро
+DEFAULT_TO_METRO_NEAR = 0.9  # доля 'default', идущих в близкое метро
+DEFAULT_TO_METRO_FAR = 0.1  # доля 'default', идущих в далёкое метро
+
+# Цели поездок в порядке, в котором они стоят в таблице исходов
+PURPOSES = ['school', 'sad', 'metro', 'ot']
+
+
+def simulation_params(choice_probabilities=None, route_probabilities=None, stay_home_probability=None,
+                      metro_distance=None, default_to_metro_near=None, default_to_metro_far=None):
+    """
+    Параметры модели поведения жителя; не заданные берутся из констант модуля
+
+    Args:
+        choice_probabilities: dict - выбор из CHOICES -> вероятность (все CHOICES, сумма 1)
+        route_probabilities: list - вероятности 1, 2 и 3 маршрута (сумма 1)
+        stay_home_probability: float - доля жителей, которые никуда не идут
+        metro_distance: float - при 'default' до метро ближе этого идут в метро
+        default_to_metro_near, default_to_metro_far: float - доля 'default', идущих в метро
+
+    Raises:
+        ValueError: вероятности вне [0, 1] или не дают в сумме 1
+
+    Returns:
+        dict: параметры по именам аргументов
+    """
+    params = {
+        "choice_probabilities": dict(zip(CHOICES, CHOICE_PROBABILITIES)),
+        "route_probabilities": list(ROUTE_PROBABILITIES),
+        "stay_home_probability": STAY_HOME_PROBABILITY,
+        "metro_distance": METRO_DISTANCE,
+        "default_to_metro_near": DEFAULT_TO_METRO_NEAR,
+        "default_to_metro_far": DEFAULT_TO_METRO_FAR,
+    }
+    if choice_probabilities is not None:
+        if set(choice_probabilities) != set(CHOICES):
+            raise ValueError(f"choice_probabilities: нужны вероятности для {CHOICES}")
+        params["choice_probabilities"] = {choice: float(choice_probabilities[choice]) for choice in CHOICES}
+    if route_probabilities is not None:
+        if len(route_probabilities) != len(ROUTE_PROBABILITIES):
+            raise ValueError(f"route_probabilities: нужно {len(ROUTE_PROBABILITIES)} значения")
+        params["route_probabilities"] = [float(p) for p in route_probabilities]
+    for name, value in (("stay_home_probability", stay_home_probability), ("metro_distance", metro_distance),
+                        ("default_to_metro_near", default_to_metro_near),
+                        ("default_to_metro_far", default_to_metro_far)):
+        if value is not None:
+            params[name] = float(value)
+
+    probabilities = (list(params["choice_probabilities"].values()) + params["route_probabilities"]
+                     + [params["stay_home_probability"], params["default_to_metro_near"],
+                        params["default_to_metro_far"]])
+    if not all(0 <= p <= 1 for p in probabilities):
+        raise ValueError("Вероятности должны быть в [0, 1]")
+    for name in ("choice_probabilities", "route_probabilities"):
+        values = params[name].values() if isinstance(params[name], dict) else params[name]
+        if abs(sum(values) - 1) > 1e-9:
+            raise ValueError(f"{name}: сумма вероятностей должна быть 1")
+    if params["metro_distance"] < 0:
+        raise ValueError("metro_distance не может быть отрицательным")
+    return params
+
+
+def purpose_probabilities(metro_distance, params=None):
+    """
+    Вероятность, что житель здания пойдёт к школе, детсаду, метро или остановке
+
+    Сводит вместе пропуск (STAY_HOME_PROBABILITY), выбор из CHOICES и выбор между
+    метро и остановкой для 'default'. Остаток до 1 - жители, которые никуда не идут.
+
+    Args:
+        params: dict - результат simulation_params (None - параметры по умолчанию)
+
+    Returns:
+        np.ndarray: вероятности в порядке PURPOSES
+    """
+    if params is None:
+        params = simulation_params()
+    go = 1 - params["stay_home_probability"]
+    choice = params["choice_probabilities"]
+    if metro_distance < params["metro_distance"]:
+        to_metro = params["default_to_metro_near"]
     else:
-        return 3  # 10% вероятность — по 3 маршруту
-
-
-def process_building(G, root_building, population_data):
-    print(f"Обработка здания {root_building}" )
-    final_map = Counter()
-    house_id = root_building  # Получить из ноды значение HouseId TODO
-    schools = Graph.get_typed_nodes(G, "school")
-    nearest_school, tmp = nearest_object(G, root_building, schools)
-    school_routes = Astar.find_alternative_paths(G, root_building, nearest_school)
-
-    # Получить список детсадов
-    sads = Graph.get_typed_nodes(G, "sad")
-    nearest_sad, tmp = nearest_object(G, root_building, sads)
-    sad_routes = Astar.find_alternative_paths(G, root_building, nearest_sad)
-
-    # Получить список остановок
-    oTs = Graph.get_typed_nodes(G, "ot")
-    nearest_oT, tmp = nearest_object(G, root_building, oTs)
-    oT_routes = Astar.find_alternative_paths(G, root_building, nearest_oT)
-
-    # Получить список входов в метро
-    metros = Graph.get_typed_nodes(G, "metro")
-    nearest_metro, distance = nearest_object(G, root_building, metros)
-    metro_routes = Astar.find_alternative_paths(G, root_building, nearest_metro)
-
-    population = population_data.get(str(house_id), 0)
-
-    for _ in range(population):
-        my_map = {}
-        if random.random() < 0.3:
+        to_metro = params["default_to_metro_far"]
+    return go * np.array([
+        choice['school'],
+        choice['sad'],
+        choice['metro'] + choice['default'] * to_metro,
+        choice['ot'] + choice['default'] * (1 - to_metro),
+    ])
+
+
+def route_probabilities(route_count, params=None):
+    """Вероятности маршрутов; если маршрутов меньше трёх, остаток приходится на последний"""
+    route_choice = ROUTE_PROBABILITIES if params is None else params["route_probabilities"]
+    probabilities = np.array(route_choice[:route_count], dtype=np.float64)
+    if route_count:
+        probabilities[-1] += sum(route_choice[route_count:])
+    return probabilities
+
+
+def load_population(G, path='population_data.json'):
+    """
+    Население зданий: id узла -> число жителей
+
+    Берётся из атрибута population узлов графа - его при загрузке слоёв
+    заполняет Citizen.estimate_population. Для графа, построенного без оценки
+    населения, читается прежний файл path.
+
+    Args:
+        G: RoutingGraph
+
+    Returns:
+        dict: id узла -> население
+    """
+    if G.population is not None:
+        return {G.node_ids[i]: float(G.population[i]) for i in np.flatnonzero(G.population)}
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def building_rng(entropy, G, building):
+    """Генератор случайных чисел здания: зависит только от entropy и номера узла здания"""
+    return np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(G.index[building],)))
+
+
+def building_routes(G, root_building, facilities, searches=None):
+    """
+    Ближайшие объекты каждого типа и маршруты до них
+
+    Args:
+        searches: dict - если передан, в searches[цель] пишется stats поиска
+            k_alternative_paths (рёбра всех найденных путей и reach) для RouteCache.put
+
+    Returns:
+        dict: цель -> (id объекта, расстояние, маршруты списками id узлов)
+    """
+    if Metrics.enabled:
+        searches_before = Metrics.searches()
+    # Ближайшие объекты берутся из заранее размеченного графа (FacilityIndex)
+    routes = {}
+    for purpose in PURPOSES:
+        facility, distance = facilities[purpose].lookup(root_building)
+        stats = None if searches is None else searches.setdefault(purpose, {"edges": set(), "reach": 0.0})
+        routes[purpose] = (facility, distance, find_routes(G, root_building, facility, stats))
+    if Metrics.enabled:
+        Metrics.observe("tsodd_searches_per_building", Metrics.searches() - searches_before)
+    return routes
+
+
+def load_routes(G, buildings, population_data, cache_path="route_cache.pkl"):
+    """
+    Маршруты зданий с жителями: из RouteCache, недостающие ищутся один раз и дописываются в кэш
+
+    Args:
+        G: RoutingGraph
+        buildings: list - id зданий
+        population_data: dict - id здания -> население
+        cache_path: str - файл RouteCache (None - без кэша)
+
+    Returns:
+        dict: id здания -> маршруты (building_routes); здания без жителей пропускаются
+    """
+    cache = RouteCache(cache_path).load(G) if cache_path else None
+    routes = {}
+    missing = []
+    for building in buildings:
+        if int(population_data.get(building, 0)) <= 0:
             continue
-        choice = assign_choice()
-        if choice == 'skip':
-            continue  # Пропускаем текущую итерацию
-
-        elif choice == 'school':
-            my_map = add_increment_for_edges(G, root_building, nearest_school, school_routes)
-
-        elif choice == 'sad':
-            my_map = add_increment_for_edges(G, root_building, nearest_sad, sad_routes)
-
-        elif choice == 'metro':
-            my_map = add_increment_for_edges(G, root_building, nearest_metro, metro_routes)
-
-        elif choice == 'ot':
-            my_map = add_increment_for_edges(G, root_building, nearest_oT, oT_routes)
-
-        elif choice == 'default':
-            if distance < 1000:
-                default_choice = "metro"
-            else:
-                default_choice = "ot"
-            fin_ans = 0
-            if default_choice == "metro":
-                fin_ans = 1 if random.random() < 0.9 else 2
-            else:
-                fin_ans = 1 if random.random() < 0.1 else 2
-
-            if fin_ans == 1:
-                my_map = add_increment_for_edges(G, root_building, nearest_metro, metro_routes)
-            else:
-                my_map = add_increment_for_edges(G, root_building, nearest_oT, oT_routes)
-
-        final_map += Counter(my_map)
-
-    return final_map
-
-
-def process_buildings(G, root_buildings):
-    with open('population_data.json', 'r') as file:
-        population_data = json.load(file)
-
-    # Создаем словарь для хранения общего счётчика
-    final_map = Counter()
-
-    # Устанавливаем количество потоков
-    with ThreadPoolExecutor(max_workers=12) as executor:
-        # Запускаем выполнение process_building для каждого root_building параллельно
-        future_to_building = {executor.submit(process_building, G, b, population_data): b for b in root_buildings}
-
-        # Собираем результаты
-        for future in as_completed(future_to_building):
-            result = future.result()
-            final_map += result  # Суммируем результат в общий счётчик
+        routes[building] = cache.get(building) if cache is not None else None
+        if routes[building] is None:
+            missing.append(building)
+    if missing:
+        facilities = FacilityIndex.label_nearest_facilities(G)
+        for building in missing:
+            searches = {}
+            routes[building] = building_routes(G, building, facilities, searches)
+            if cache is not None:
+                cache.put(building, routes[building], searches)
+    if cache is not None:
+        cache.save()
+    return routes
+
+
+def building_outcomes(G, routes, params=None, path_edges=None):
+    """
+    Таблица исходов для жителя здания
+
+    Args:
+        routes: dict - результат building_routes
+        params: dict - результат simulation_params (None - параметры по умолчанию)
+        path_edges: function - маршрут -> номера рёбер (None - G.path_edges), например с памятью
+
+    Returns:
+        tuple: (probabilities, route_edges) - вероятность каждой пары (цель, маршрут)
+            и номера рёбер этого маршрута. Сумма вероятностей не больше 1, остаток -
+            житель никуда не идёт (или у цели нет маршрута)
+    """
+    if path_edges is None:
+        path_edges = G.path_edges
+    metro_distance = routes['metro'][1]
+    probabilities = []
+    route_edges = []
+    for purpose, purpose_probability in zip(PURPOSES, purpose_probabilities(metro_distance, params)):
+        purpose_routes = routes[purpose][2]
+        for route, route_probability in zip(purpose_routes, route_probabilities(len(purpose_routes), params)):
+            probabilities.append(purpose_probability * route_probability)
+            route_edges.append(path_edges(route))
+    return probabilities, route_edges
+
+
+def outcome_counts(probabilities, population, rng, size=None):
+    """
+    Число жителей на каждый исход таблицы building_outcomes одним мультиномиальным розыгрышем
+
+    Общий розыгрыш для process_buildings, TimeOfDay и Scenarios: при одном генераторе
+    здания (building_rng) все они получают одни и те же числа.
+
+    Args:
+        probabilities: list - вероятности исходов (сумма не больше 1)
+        population: int - число жителей
+        rng: np.random.Generator
+        size: int - число независимых повторов розыгрыша (None - один)
+
+    Returns:
+        np.ndarray[int64]: длины len(probabilities) или (size, len(probabilities))
+    """
+    # Последний исход - житель никуда не идёт
+    probabilities = list(probabilities) + [max(0.0, 1 - sum(probabilities))]
+    return rng.multinomial(population, probabilities, size=size)[..., :-1]
+
+
+def sample_loads(probabilities, route_edges, population, rng, size=None):
+    """
+    Разыгрывает число жителей на каждый исход одним мультиномиальным розыгрышем
+    и умножает его на матрицу инцидентности маршрут -> ребро
+
+    Args:
+        size: int - число независимых повторов розыгрыша (None - один)
+
+    Returns:
+        tuple: (номера рёбер, нагрузка) - нагрузка длины len(edges) или (size, len(edges))
+    """
+    if population <= 0 or not probabilities:
+        shape = (0,) if size is None else (size, 0)
+        return np.zeros(0, dtype=np.int64), np.zeros(shape, dtype=np.int64)
+
+    edges = np.unique(np.concatenate([np.asarray(e, dtype=np.int64) for e in route_edges]))
+    incidence = np.zeros((len(route_edges), len(edges)), dtype=np.int64)
+    for k, route in enumerate(route_edges):
+        np.add.at(incidence[k], np.searchsorted(edges, route), 1)
+
+    counts = outcome_counts(probabilities, population, rng, size=size)
+    return edges, counts @ incidence
+
+
+def process_building(G, root_building, population_data, facilities, rng=None, size=None, routes=None,
+                     params=None):
+    """
+    Нагрузка на рёбра от жителей одного здания
+
+    Вместо розыгрыша для каждого жителя делается один мультиномиальный розыгрыш
+    числа жителей на каждый исход (цель, номер маршрута), после чего числа
+    умножаются на рёбра маршрутов.
+
+    Args:
+        size: int - число независимых повторов розыгрыша для ансамбля (None - один)
+        routes: dict - маршруты здания (building_routes), например из RouteCache;
+            если не заданы, ищутся заново
+        params: dict - результат simulation_params (None - параметры по умолчанию)
+
+    Returns:
+        tuple: (номера рёбер, число проходов по ним); при size - (size, len(edges))
+    """
+    Metrics.inc("tsodd_buildings_processed_total")
+    if rng is None:
+        rng = np.random.default_rng()
+    house_id = root_building  # Получить из ноды значение HouseId TODO
+    population = int(population_data.get(str(house_id), 0))
+    if population <= 0:
+        return sample_loads([], [], 0, rng, size)
+    if routes is None:
+        routes = building_routes(G, root_building, facilities)
+    probabilities, route_edges = building_outcomes(G, routes, params)
+    return sample_loads(probabilities, route_edges, population, rng, size)
+
+
+@Metrics.timed("simulation")
+def process_buildings(G, root_buildings, mode="processes", workers=None, chunksize=16, seed=None,
+                      cache_path="route_cache.pkl", params=None, cancelled=None):
+    """
+    Считает нагрузку на рёбра от всех зданий и сохраняет её в trafic.json
+
+    Args:
+        G: RoutingGraph
+        root_buildings: list - id зданий
+        mode: "processes" - пул процессов с графом через mmap (ParallelSimulation),
+            "threads" - пул потоков в текущем процессе
+        workers: int - число процессов или потоков (по умолчанию по числу ядер / 12 потоков)
+        chunksize: int - число зданий в одной задаче для пула процессов
+        seed: int - зерно; с одним и тем же зерном результат повторяется независимо
+            от режима и числа процессов
+        cache_path: str - файл RouteCache; при неизменном графе маршруты не ищутся
+            заново. None - без кэша
+        params: dict - результат simulation_params (None - параметры по умолчанию)
+        cancelled: function без аргументов - проверяется после каждого здания (пачки для
+            пула процессов); если вернула True, оставшиеся здания не считаются
+
+    Returns:
+        np.ndarray: число проходов по каждому ребру (по номеру ребра RoutingGraph);
+            None, если расчёт прерван через cancelled (найденные маршруты всё равно
+            сохраняются в кэш, trafic.json не пишется)
+    """
+    population_data = load_population(G)
+
+    # Зерно каждого здания выводится из общего, поэтому порядок обработки не важен
+    entropy = np.random.SeedSequence(seed).entropy
+
+    cache = RouteCache(cache_path).load(G) if cache_path else None
+
+    # Один проход Дейкстры на тип объектов вместо поиска от каждого здания;
+    # не нужен, если маршруты всех жилых зданий уже есть в кэше
+    facilities = None
+    if cache is None or any(cache.get(b) is None and int(population_data.get(b, 0)) > 0 for b in root_buildings):
+        facilities = FacilityIndex.label_nearest_facilities(G)
+
+    if mode == "processes":
+        population = [population_data.get(node, 0) for node in G.node_ids]
+        loads = np.zeros(G.num_edges, dtype=np.int64)
+        chunks = ParallelSimulation.iter_processes(G, root_buildings, population, facilities, workers, chunksize,
+                                                   entropy, cache=cache, params=params)
+        try:
+            for _, chunk_loads in chunks:
+                loads += chunk_loads
+                if cancelled is not None and cancelled():
+                    loads = None
+                    break
+        finally:
+            chunks.close()
+    else:
+        loads = np.zeros(G.num_edges, dtype=np.int64)
+        busy = []
+
+        def simulate(b):
+            started = time.perf_counter()
+            routes = cache.get(b) if cache is not None else None
+            if routes is None and int(population_data.get(b, 0)) > 0:
+                searches = {}
+                routes = building_routes(G, b, facilities, searches)
+                if cache is not None:
+                    cache.put(b, routes, searches)
+            result = process_building(G, b, population_data, facilities, building_rng(entropy, G, b), routes=routes,
+                                      params=params)
+            busy.append(time.perf_counter() - started)
+            return result
+
+        # Устанавливаем количество потоков
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers or 12) as executor:
+            # Запускаем выполнение process_building для каждого root_building параллельно
+            future_to_building = {executor.submit(simulate, b): b for b in root_buildings}
+
+            # Собираем результаты
+            for future in as_completed(future_to_building):
+                edges, counts = future.result()
+                loads[edges] += counts  # Суммируем результат в общий счётчик
+                if cancelled is not None and cancelled():
+                    # Ещё не начатые здания отменяются, начатые дорабатываются при выходе из with
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    loads = None
+                    break
+        Metrics.inc("tsodd_worker_busy_seconds_total", sum(busy), pool="threads")
+        Metrics.set_gauge("tsodd_worker_utilization",
+                          sum(busy) / ((workers or 12) * max(time.perf_counter() - started, 1e-9)), pool="threads")
+
+    if cache is not None:
+        cache.save()
+    if loads is None:
+        return None
 
     # Сохраняем результат
     with open("trafic.json", "w", encoding="utf-8") as file:
-        json.dump(dict(final_map), file, ensure_ascii=False, indent=4)
+        json.dump(G.loads_by_id(loads), file, ensure_ascii=False, indent=4)
+    return loads
 
 
-def add_increment_for_edges(G, startId, purpose, routes):
-    route = choose_route()
-    if route == 1:
-        cur_route = routes[0]
+def find_routes(G, startId, target, stats=None):
+    if target is None:
+        return []
+    return AlternativeRoutes.k_alternative_paths(G, startId, target, stats=stats)
 
-    elif route == 2:
-        cur_route = routes[1]
-    else:
-        cur_route = routes[2]
-    previous_node = "Init"
-    answer = {}
-    for node in cur_route:
-        if previous_node == "Init":
-            previous_node = node
-            continue
-        else:
-            edge = G[previous_node][node]
-            cur_id = edge.get("id")
-            if cur_id in answer:
-                answer[cur_id] += 1
-            else:
-                answer[cur_id] = 1
-    return answer
-
-
-def nearest_object(G, startId, objects):
-    min_distance = float('inf')
-    answer = ""
-    for object in objects:
-        distance, route = Astar.dijkstra(G, startId, object)
-        if distance < min_distance:
-            min_distance = distance
-            answer = object
-    return answer, min_distance
-
-with open("graph.pkl", "rb") as f:
-    G = pickle.load(f)
-buildings = Graph.get_typed_nodes(G)
-process_buildings(G, buildings)
\ No newline at end of file
+
+if __name__ == "__main__":
+    # Компактный граф для маршрутизации открывается из снимка один раз на весь прогон
+    R = GraphSnapshot.load_routing_graph()
+    buildings = R.typed_nodes()
+    process_buildings(R, buildings)
@@ -0,0 +1,192 @@
+import functools
+import os
+import threading
+import time
+
+# Метрики собираются, если переменная окружения TSODD_METRICS не равна "0".
+# Выключенные метрики стоят одной проверки флага на вызов - на поиск, здание или этап, не на итерацию
+enabled = os.environ.get("TSODD_METRICS", "1") != "0"
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+SETTLED_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+SEARCHES_BUCKETS = (1, 2, 4, 8, 12, 16, 24, 36, 48)
+
+# Имя -> (тип, описание, границы корзин гистограммы)
+METRICS = {
+    "tsodd_stage_seconds": ("histogram", "Время этапа обработки (функции с Metrics.timed)", SECONDS_BUCKETS),
+    "tsodd_upload_stage_seconds": ("histogram", "Время этапа задачи /upload", SECONDS_BUCKETS),
+    "tsodd_ingested_features_total": ("counter", "Объектов прочитано из загруженных слоёв", None),
+    "tsodd_graph_nodes": ("gauge", "Узлов в последнем построенном графе", None),
+    "tsodd_graph_edges": ("gauge", "Рёбер в последнем построенном графе", None),
+    "tsodd_searches_total": ("counter", "Поисков пути", None),
+    "tsodd_search_settled_nodes": ("histogram", "Раскрыто узлов за один поиск пути", SETTLED_BUCKETS),
+    "tsodd_searches_per_building": ("histogram", "Поисков пути на маршруты одного здания", SEARCHES_BUCKETS),
+    "tsodd_buildings_processed_total": ("counter", "Зданий обработано симуляцией", None),
+    "tsodd_worker_busy_seconds_total": ("counter", "Время работы обработчиков пула", None),
+    "tsodd_worker_utilization": ("gauge", "Доля времени, занятая обработчиками, за последний прогон пула", None),
+    "tsodd_upload_jobs": ("gauge", "Задач /upload по состоянию", None),
+    "tsodd_simulation_runs": ("gauge", "Прогонов симуляции по состоянию", None),
+}
+
+_samples = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Увеличивает счётчик name с метками labels"""
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _samples[key] = _samples.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    if not enabled:
+        return
+    with _lock:
+        _samples[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Добавляет значение в гистограмму name: [число в каждой корзине, сумма, количество]"""
+    if not enabled:
+        return
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        sample = _samples.get(key)
+        if sample is None:
+            sample = _samples[key] = [[0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                sample[0][i] += 1
+                break
+        sample[1] += value
+        sample[2] += 1
+
+
+def record_search(algorithm, settled):
+    """Поиск пути: счётчик поисков, раскрытые узлы и счётчик поисков потока для searches()"""
+    inc("tsodd_searches_total", algorithm=algorithm)
+    observe("tsodd_search_settled_nodes", settled, algorithm=algorithm)
+    _local.searches = getattr(_local, "searches", 0) + 1
+
+
+def searches():
+    """Число поисков пути, выполненных текущим потоком (разность до и после - поиски на здание)"""
+    return getattr(_local, "searches", 0)
+
+
+def record_graph(G):
+    """Размер построенного графа networkx"""
+    set_gauge("tsodd_graph_nodes", G.number_of_nodes())
+    set_gauge("tsodd_graph_edges", G.number_of_edges())
+
+
+def timed(stage):
+    """Декоратор: время вызова функции в tsodd_stage_seconds{stage=...}"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe("tsodd_stage_seconds", time.perf_counter() - started, stage=stage)
+        return wrapper
+    return decorate
+
+
+def reset():
+    """
+    Обнуляет значения процесса - вызывается при старте процесса пула: при fork
+    он получает копию значений родителя, и collect() вернул бы их родителю повторно
+    """
+    global _samples, _lock, _local
+    # Блокировка тоже новая: при fork её мог держать другой поток родителя
+    _lock = threading.Lock()
+    _local = threading.local()
+    _samples = {}
+
+
+def collect():
+    """
+    Забирает накопленные значения и обнуляет их - так процесс пула передаёт
+    метрики серверу вместе с результатом задачи (см. merge)
+
+    Returns:
+        dict: (имя, метки) -> значение; None, если метрики выключены
+    """
+    if not enabled:
+        return None
+    global _samples
+    with _lock:
+        samples, _samples = _samples, {}
+    return samples
+
+
+def merge(samples):
+    """Добавляет значения из collect() другого процесса: счётчики и гистограммы суммируются, gauge заменяется"""
+    if not enabled or not samples:
+        return
+    with _lock:
+        for key, value in samples.items():
+            kind = METRICS[key[0]][0]
+            current = _samples.get(key)
+            if current is None or kind == "gauge":
+                _samples[key] = value
+            elif kind == "counter":
+                _samples[key] = current + value
+            else:
+                current[0] = [a + b for a, b in zip(current[0], value[0])]
+                current[1] += value[1]
+                current[2] += value[2]
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus (version 0.0.4)"""
+    with _lock:
+        samples = {key: (value if not isinstance(value, list) else [list(value[0]), value[1], value[2]])
+                   for key, value in _samples.items()}
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        keys = sorted(key for key in samples if key[0] == name)
+        if not keys:
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key in keys:
+            labels, value = key[1], samples[key]
+            if kind != "histogram":
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket in zip(list(buckets) + [float("inf")], counts + [count - sum(counts)]):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_labels(labels, [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
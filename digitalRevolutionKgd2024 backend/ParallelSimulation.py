@@ -0,0 +1,159 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import FacilityIndex
+import Metrics
+from RoutingGraph import RoutingGraph
+
+# Состояние процесса-обработчика: граф и таблицы, открытые через mmap
+_worker = {}
+
+
+def save_arrays(directory, arrays):
+    """Сохраняет массивы в directory/<имя>.npy"""
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+
+def load_arrays(directory, mmap_mode="r"):
+    """Открывает все directory/*.npy; с mmap_mode="r" данные не копируются в память процесса"""
+    arrays = {}
+    for filename in os.listdir(directory):
+        if filename.endswith(".npy"):
+            arrays[filename[:-4]] = np.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+    return arrays
+
+
+def _init_worker(directory):
+    Metrics.reset()
+    arrays = load_arrays(directory)
+    graph = RoutingGraph.from_arrays(arrays)
+    _worker["graph"] = graph
+    # Разметки нет, если все маршруты взяты из кэша
+    if "school_nearest" in arrays:
+        _worker["facilities"] = FacilityIndex.labels_from_arrays(graph, arrays)
+    else:
+        _worker["facilities"] = None
+    _worker["population"] = arrays["population"]
+
+
+def _process_chunk(buildings, entropy, replications, cached_routes, params):
+    # Импорт здесь, а не в начале модуля: Main_alko сам импортирует ParallelSimulation
+    import Main_alko
+
+    started = time.perf_counter()
+    graph = _worker["graph"]
+    population = _worker["population"]
+    population_data = {building: population[graph.index[building]] for building in buildings}
+
+    if replications is None:
+        loads = np.zeros(graph.num_edges, dtype=np.int64)
+    else:
+        loads = np.zeros((replications, graph.num_edges), dtype=np.int32)
+    computed_routes = {}
+    for building in buildings:
+        routes = cached_routes.get(building)
+        if routes is None and population_data[building] > 0:
+            searches = {}
+            routes = Main_alko.building_routes(graph, building, _worker["facilities"], searches)
+            computed_routes[building] = (routes, searches)
+        rng = Main_alko.building_rng(entropy, graph, building)
+        edges, counts = Main_alko.process_building(graph, building, population_data, _worker["facilities"], rng,
+                                                   replications, routes, params)
+        loads[..., edges] += counts.astype(loads.dtype)
+    busy = time.perf_counter() - started
+    # Метрики процесса-обработчика уходят к родителю вместе с результатом (Metrics.merge)
+    Metrics.inc("tsodd_worker_busy_seconds_total", busy, pool="processes")
+    return loads, computed_routes, busy, Metrics.collect()
+
+
+def run_processes(graph, buildings, population, facilities, workers=None, chunksize=16, entropy=None,
+                  replications=None, cache=None, params=None):
+    """
+    Считает нагрузку на рёбра для зданий в пуле процессов
+
+    Граф, разметка ближайших объектов и население записываются один раз во
+    временный каталог .npy-файлов, процессы открывают их через mmap и не
+    загружают graph.pkl. Здания раздаются пачками по chunksize, нагрузки рёбер
+    от каждой пачки суммируются.
+
+    Args:
+        graph: RoutingGraph
+        buildings: list - id зданий
+        population: np.ndarray - население для каждого узла графа (по номеру узла)
+        facilities: dict - результат FacilityIndex.label_nearest_facilities
+        workers: int - число процессов (по умолчанию os.cpu_count())
+        chunksize: int - число зданий в одной задаче
+        entropy: int - общее зерно (см. Main_alko.building_rng); None - случайное
+        replications: int - число независимых повторов для ансамбля (None - один прогон)
+        cache: RouteCache - маршруты из кэша отправляются вместе с пачкой зданий,
+            найденные процессами маршруты записываются обратно в кэш.
+            facilities может быть None, если в кэше есть все нужные маршруты
+        params: dict - параметры модели жителя (Main_alko.simulation_params)
+
+    Returns:
+        np.ndarray: число проходов по каждому ребру (по номеру ребра);
+            при replications - массив int32 (replications, число рёбер)
+    """
+    if replications is None:
+        loads = np.zeros(graph.num_edges, dtype=np.int64)
+    else:
+        loads = np.zeros((replications, graph.num_edges), dtype=np.int32)
+    for _, chunk_loads in iter_processes(graph, buildings, population, facilities, workers, chunksize, entropy,
+                                         replications, cache, params):
+        loads += chunk_loads
+    return loads
+
+
+def iter_processes(graph, buildings, population, facilities, workers=None, chunksize=16, entropy=None,
+                   replications=None, cache=None, params=None):
+    """
+    То же, что run_processes, но отдаёт нагрузку каждой пачки зданий по мере готовности
+
+    Если перестать читать генератор (close), ещё не начатые пачки отменяются.
+
+    Yields:
+        tuple: (здания пачки, нагрузка от них по номеру ребра)
+    """
+    if entropy is None:
+        entropy = np.random.SeedSequence().entropy
+    directory = tempfile.mkdtemp(prefix="routing_graph_")
+    try:
+        arrays = graph.to_arrays()
+        if facilities is not None:
+            arrays.update(FacilityIndex.labels_to_arrays(facilities))
+        arrays["population"] = np.asarray(population, dtype=np.float64)
+        save_arrays(directory, arrays)
+
+        chunks = [buildings[i:i + chunksize] for i in range(0, len(buildings), chunksize)]
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(directory,))
+        started = time.perf_counter()
+        busy = 0.0
+        try:
+            futures = {}
+            for chunk in chunks:
+                cached_routes = {}
+                if cache is not None:
+                    cached_routes = {building: cache.get(building) for building in chunk}
+                futures[executor.submit(_process_chunk, chunk, entropy, replications, cached_routes, params)] = chunk
+            for future in as_completed(futures):
+                chunk_loads, computed_routes, chunk_busy, samples = future.result()
+                busy += chunk_busy
+                Metrics.merge(samples)
+                if cache is not None:
+                    for building, (routes, searches) in computed_routes.items():
+                        cache.put(building, routes, searches)
+                yield futures[future], chunk_loads
+        finally:
+            executor.shutdown(cancel_futures=True)
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            Metrics.set_gauge("tsodd_worker_utilization", busy / ((workers or os.cpu_count()) * elapsed),
+                              pool="processes")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,256 @@
+import contextlib
+import hashlib
+import os
+import pickle
+import tempfile
+
+try:
+    import fcntl  # есть только на Unix: блокировка файла кэша на время сохранения
+except ImportError:
+    fcntl = None
+
+import numpy as np
+from scipy.spatial import KDTree
+
+import AlternativeRoutes
+import FacilityIndex
+
+# Меняется при изменении формата или алгоритма поиска маршрутов - старый кэш тогда сбрасывается
+CACHE_VERSION = 3
+
+# Параметры k_alternative_paths, с которыми найдены маршруты кэша; при других кэш сбрасывается
+ROUTE_SETTINGS = {
+    "k": AlternativeRoutes.K_ROUTES,
+    "max_overlap": AlternativeRoutes.MAX_OVERLAP,
+    "max_detour": AlternativeRoutes.MAX_DETOUR,
+    "penalty": AlternativeRoutes.PENALTY,
+}
+
+
+def graph_fingerprint(graph):
+    """SHA-256 от всех массивов RoutingGraph: топология, веса, координаты, типы узлов"""
+    digest = hashlib.sha256()
+    for name, array in sorted(graph.to_arrays().items()):
+        array = np.ascontiguousarray(array)
+        digest.update(f"{name}:{array.dtype.str}:{array.shape}".encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def edge_table(graph):
+    """Рёбра графа по паре строковых id концов: (u, v) с u <= v -> вес"""
+    halves = graph.half_edges(np.arange(graph.num_edges))
+    weights = graph.weights[halves[:, 0]].tolist()
+    table = {}
+    for (u, v), weight in zip(graph.edge_nodes.tolist(), weights):
+        table[_edge_key(graph.node_ids[u], graph.node_ids[v])] = weight
+    return table
+
+
+def _edge_key(u, v):
+    return (u, v) if u <= v else (v, u)
+
+
+class RouteCache:
+    """
+    Кэш маршрутов от зданий до ближайших объектов на диске
+
+    Запись для здания: цель (school, sad, ot, metro) -> (id объекта, расстояние,
+    маршруты списками id узлов). Рядом с записью хранятся рёбра всех путей,
+    найденных поисками k_alternative_paths (и отклонённых тоже), и reach каждой
+    цели - наибольшая длина найденного пути со штрафами. Кэш привязан к отпечатку
+    графа. Если граф изменился, при загрузке сбрасываются только записи, которые
+    могли измениться:
+      - один из найденных поисками путей проходит по удалённому или удлинившемуся ребру;
+      - путь через новое или укоротившееся ребро по оценке расстоянием по прямой
+        не длиннее reach - его мог бы найти один из поисков;
+      - путь через такое ребро к любому объекту того же типа может оказаться
+        короче сохранённого расстояния;
+      - новый объект того же типа по той же оценке может оказаться ближе;
+      - объект удалён или сменил тип.
+
+    Кэш пишут одновременно несколько потоков и процессов. save() под блокировкой
+    файла дописывает к своим записям записи с диска для того же графа, так что
+    маршруты, найденные другим прогоном, не теряются. Без fcntl (Windows)
+    блокировки нет - тогда остаются записи последнего сохранения.
+    """
+
+    def __init__(self, path="route_cache.pkl"):
+        self.path = path
+        self.entries = {}
+        self.searches = {}
+        self.fingerprint = None
+        self.facilities = {}
+        self.invalidated = 0
+        self.dirty = False
+
+    def load(self, graph):
+        """Читает кэш с диска и согласует его с текущим графом"""
+        fingerprint = graph_fingerprint(graph)
+        stored = self._read()
+        if stored is not None:
+            self.entries = stored["entries"]
+            self.searches = stored["searches"]
+            if stored["fingerprint"] != fingerprint:
+                self._invalidate(graph, stored)
+                self.dirty = True
+
+        self.fingerprint = fingerprint
+        self.facilities = {type: graph.typed_nodes(type) for type in FacilityIndex.FACILITY_TYPES}
+        self._graph = graph
+        return self
+
+    def get(self, building):
+        return self.entries.get(building)
+
+    def put(self, building, routes, searches=None):
+        """
+        Args:
+            routes: dict - результат Main_alko.building_routes
+            searches: dict - цель -> stats поиска k_alternative_paths (Main_alko.building_routes
+                с searches); без них запись сбрасывается при любом изменении графа
+        """
+        self.entries[building] = routes
+        if searches is None:
+            self.searches.pop(building, None)
+        else:
+            edges = sorted(set().union(*(stats["edges"] for stats in searches.values())))
+            node_ids = self._graph.node_ids
+            self.searches[building] = (
+                {_edge_key(node_ids[u], node_ids[v]) for u, v in self._graph.edge_nodes[edges].tolist()},
+                {purpose: stats["reach"] for purpose, stats in searches.items()},
+            )
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        # Кэш пишут одновременно потоки SimulationService, процессы UploadJobs, /scenarios
+        # и TimeOfDay: записи с диска для того же графа дописываются под блокировкой,
+        # у каждого сохранения свой временный файл
+        with _locked(self.path):
+            stored = self._read()
+            if stored is not None and stored["fingerprint"] == self.fingerprint:
+                for building, routes in stored["entries"].items():
+                    if building not in self.entries:
+                        self.entries[building] = routes
+                        if building in stored["searches"]:
+                            self.searches[building] = stored["searches"][building]
+            data = {
+                "version": CACHE_VERSION,
+                "settings": ROUTE_SETTINGS,
+                "fingerprint": self.fingerprint,
+                "edges": edge_table(self._graph),
+                "facilities": self.facilities,
+                "entries": self.entries,
+                "searches": self.searches,
+            }
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(self.path)}.",
+                                            dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        self.dirty = False
+
+    def _read(self):
+        # Содержимое файла кэша; None, если его нет или он записан в другом формате
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as f:
+            stored = pickle.load(f)
+        if stored.get("version") != CACHE_VERSION or stored.get("settings") != ROUTE_SETTINGS:
+            return None
+        return stored
+
+    def _invalidate(self, graph, stored):
+        old_edges = stored["edges"]
+        new_edges = edge_table(graph)
+        inf = float("inf")
+
+        # Рёбра, которые стали хуже (удалены или удлинились), и рёбра, которые стали лучше
+        worse = {key for key, weight in old_edges.items() if new_edges.get(key, inf) > weight}
+        better = [(key, weight) for key, weight in new_edges.items() if weight < old_edges.get(key, inf)]
+
+        new_facilities = {}
+        for type in FacilityIndex.FACILITY_TYPES:
+            old = set(stored["facilities"].get(type, []))
+            added = [node for node in graph.typed_nodes(type) if node not in old]
+            new_facilities[type] = np.array([graph.index[node] for node in added], dtype=np.int64)
+
+        slack = graph.heuristic_slack()
+        coords = graph.coords
+        if better:
+            better_u = coords[[graph.index[key[0]] for key, _ in better]]
+            better_v = coords[[graph.index[key[1]] for key, _ in better]]
+            better_w = np.array([weight for _, weight in better])
+            # Оценка снизу от концов лучших рёбер до ближайшего объекта каждого типа
+            to_type = {}
+            for type in FacilityIndex.FACILITY_TYPES:
+                nodes = np.array([graph.index[node] for node in graph.typed_nodes(type)], dtype=np.int64)
+                if len(nodes):
+                    tree = KDTree(coords[nodes])
+                    margin = slack[nodes].max()
+                    to_type[type] = (tree.query(better_u)[0] - margin, tree.query(better_v)[0] - margin)
+                else:
+                    to_type[type] = (np.full(len(better), inf), np.full(len(better), inf))
+
+        def via_better(b, to_u, to_v):
+            # Оценка снизу длины пути от здания через одно из лучших рёбер; to_u, to_v - от концов ребра до цели
+            pb = coords[b]
+            direct = np.hypot(*(better_u - pb).T) + better_w + to_v
+            reverse = np.hypot(*(better_v - pb).T) + better_w + to_u
+            return np.minimum(direct, reverse).min() - slack[b]
+
+        def changed_by_better(b, f, purpose, distance, reach):
+            if not better:
+                return False
+            if f is None:
+                # Недостижимый объект мог стать достижимым
+                return True
+            pf = coords[f]
+            to_f = (np.hypot(*(better_u - pf).T) - slack[f], np.hypot(*(better_v - pf).T) - slack[f])
+            # Путь, который мог бы найти один из поисков k_alternative_paths, или путь к другому объекту типа
+            return via_better(b, *to_f) <= reach or via_better(b, *to_type[purpose]) <= distance
+
+        for building in list(self.entries):
+            b = graph.index.get(building)
+            search = self.searches.get(building)
+            valid = b is not None and graph.building_types[b] == "building" and search is not None
+            if valid:
+                searched, reach = search
+                valid = worse.isdisjoint(searched)
+            if valid:
+                for purpose, (facility, distance, routes) in self.entries[building].items():
+                    f = graph.index.get(facility) if facility is not None else None
+                    if facility is not None and (f is None or graph.building_types[f] != purpose):
+                        valid = False
+                    elif changed_by_better(b, f, purpose, distance, reach.get(purpose, 0.0)):
+                        valid = False
+                    elif len(new_facilities[purpose]):
+                        candidates = new_facilities[purpose]
+                        bound = np.hypot(*(coords[candidates] - coords[b]).T) - slack[b] - slack[candidates]
+                        valid = bound.min() >= distance
+                    if not valid:
+                        break
+            if not valid:
+                del self.entries[building]
+                self.searches.pop(building, None)
+                self.invalidated += 1
+
+
+@contextlib.contextmanager
+def _locked(path):
+    # Блокировка <path>.lock на время чтения и записи кэша в save(); без fcntl - без блокировки
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,274 @@
+import numpy as np
+
+
+class RoutingGraph:
+    """
+    Компактный граф для маршрутизации в формате CSR.
+
+    Узлы пронумерованы целыми числами в лексикографическом порядке строковых id
+    (`r_<id>_start`, `b_<id>`, ...), поэтому порядок в очереди с приоритетами
+    совпадает с порядком, который давали строковые id в networkx-версии.
+    Каждое неориентированное ребро хранится как два полуребра.
+
+    Атрибуты:
+        node_ids: list[str] - строковые id узлов по целочисленному номеру
+        index: dict - обратная таблица строковый id -> номер узла
+        offsets: np.ndarray[int64] - начало списка соседей узла i (длина n + 1)
+        targets: np.ndarray[int32] - сосед для каждого полуребра
+        weights: np.ndarray[float64 | float32] - вес каждого полуребра
+        edge_index: np.ndarray[int32] - номер неориентированного ребра для полуребра
+        edge_nodes: np.ndarray[int32] - концы неориентированных рёбер (m, 2)
+        edge_ids: list - атрибут `id` исходного ребра (id дороги или None)
+        coords: np.ndarray[float64] - координаты узлов (n, 2)
+        building_types: list - атрибут `building_type` узлов (или None)
+        population: np.ndarray[float64] | None - атрибут `population` узлов (0, если не задан);
+            None - граф построен без оценки населения
+        order: np.ndarray[int32] - номера узлов в исходном порядке networkx
+    """
+
+    def __init__(self, node_ids, offsets, targets, weights, edge_index, edge_nodes, edge_ids, coords,
+                 building_types, order=None, weight_dtype=np.float64, population=None):
+        self.node_ids = list(node_ids)
+        self.index = {node: i for i, node in enumerate(self.node_ids)}
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=weight_dtype)
+        self.edge_index = np.asarray(edge_index, dtype=np.int32)
+        self.edge_nodes = np.asarray(edge_nodes, dtype=np.int32).reshape(-1, 2)
+        self.edge_ids = list(edge_ids)
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.building_types = list(building_types)
+        if order is None:
+            order = np.arange(len(self.node_ids))
+        self.order = np.asarray(order, dtype=np.int32)
+        self.population = None if population is None else np.asarray(population, dtype=np.float64)
+
+        # memoryview по массивам: индексация возвращает обычные int/float
+        # и работает так же быстро, как по спискам, без копирования данных
+        self._offsets_view = memoryview(self.offsets)
+        self._targets_view = memoryview(self.targets)
+        self._weights_view = memoryview(self.weights)
+        self._edge_index_view = memoryview(self.edge_index)
+        self._coords_view = memoryview(np.ascontiguousarray(self.coords).reshape(-1))
+        self._slack = None
+        self._halves = None
+
+    @classmethod
+    def from_networkx(cls, G, weight="weight", weight_dtype=np.float64):
+        """
+        Строит CSR-граф из графа networkx, полученного из Graph.get_graph
+
+        Args:
+            G: nx.Graph - граф дорожной сети
+            weight: str - имя атрибута с весом ребра
+            weight_dtype: np.float64 или np.float32. float32 вдвое компактнее, но на почти
+                равных по длине маршрутах округление может выбрать другой из них
+
+        Returns:
+            RoutingGraph
+        """
+        original = list(G.nodes)
+        node_ids = sorted(original)
+        index = {node: i for i, node in enumerate(node_ids)}
+        order = [index[node] for node in original]
+
+        # Нумеруем неориентированные рёбра в порядке G.edges
+        edge_nodes = []
+        edge_ids = []
+        edge_lookup = {}
+        for u, v, attrs in G.edges(data=True):
+            edge_lookup[(u, v)] = len(edge_nodes)
+            edge_lookup[(v, u)] = len(edge_nodes)
+            edge_nodes.append((index[u], index[v]))
+            edge_ids.append(attrs.get("id"))
+
+        # Списки соседей сохраняют порядок обхода G.neighbors
+        offsets = [0]
+        targets = []
+        weights = []
+        edge_index = []
+        for node in node_ids:
+            for neighbor, attrs in G.adj[node].items():
+                targets.append(index[neighbor])
+                weights.append(attrs.get(weight, 1.0))
+                edge_index.append(edge_lookup[(node, neighbor)])
+            offsets.append(len(targets))
+
+        coords = []
+        building_types = []
+        population = []
+        for node in node_ids:
+            attrs = G.nodes[node]
+            pos = attrs.get("pos", (np.nan, np.nan))
+            coords.append((pos[0], pos[1]))
+            building_types.append(attrs.get("building_type"))
+            population.append(attrs.get("population"))
+        if all(value is None for value in population):
+            population = None
+        else:
+            population = [0.0 if value is None else value for value in population]
+
+        return cls(node_ids, offsets, targets, weights, edge_index, edge_nodes, edge_ids, coords,
+                   building_types, order, weight_dtype, population)
+
+    def to_arrays(self):
+        """
+        Граф в виде плоских numpy-массивов - для np.save и общего доступа из процессов
+
+        Строковые столбцы (node_ids, edge_ids, building_types) кодируются таблицей
+        строк: байты UTF-8, смещения и маска заполненности (None -> False).
+        Нестроковые id рёбер сохраняются как str(id).
+        """
+        arrays = {
+            "offsets": self.offsets,
+            "targets": self.targets,
+            "weights": self.weights,
+            "edge_index": self.edge_index,
+            "edge_nodes": self.edge_nodes,
+            "coords": self.coords,
+            "order": self.order,
+        }
+        if self.population is not None:
+            arrays["population"] = self.population
+        for name in ("node_ids", "edge_ids", "building_types"):
+            arrays.update(encode_strings(name, getattr(self, name)))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Обратное к to_arrays; массивы не копируются (подходит для mmap)"""
+        return cls(decode_strings(arrays, "node_ids"), arrays["offsets"], arrays["targets"], arrays["weights"],
+                   arrays["edge_index"], arrays["edge_nodes"], decode_strings(arrays, "edge_ids"), arrays["coords"],
+                   decode_strings(arrays, "building_types"), arrays["order"], arrays["weights"].dtype,
+                   arrays.get("population"))
+
+    @classmethod
+    def ensure(cls, graph):
+        """Возвращает RoutingGraph как есть, граф networkx - конвертирует"""
+        if isinstance(graph, cls):
+            return graph
+        return cls.from_networkx(graph)
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_ids)
+
+    def adjacency(self):
+        """Представления offsets/targets/weights для горячих циклов поиска"""
+        return self._offsets_view, self._targets_view, self._weights_view
+
+    def coordinates(self):
+        """Плоское представление координат: x узла i - [2 * i], y - [2 * i + 1]"""
+        return self._coords_view
+
+    def heuristic_slack(self):
+        """
+        Насколько рёбра узла короче расстояния по прямой между их концами
+
+        Рёбра к зданиям имеют вес 1.0 независимо от длины, поэтому расстояние
+        по прямой до здания-цели нужно уменьшать на эту величину, чтобы эвристика
+        A* оставалась допустимой.
+
+        Returns:
+            np.ndarray[float64]: запас для каждого узла (0 - если рёбра не короче прямой)
+        """
+        if self._slack is None:
+            sources = np.repeat(np.arange(self.num_nodes), np.diff(self.offsets))
+            delta = self.coords[sources] - self.coords[self.targets]
+            shortcut = np.hypot(delta[:, 0], delta[:, 1]) - self.weights
+            slack = np.zeros(self.num_nodes)
+            np.maximum.at(slack, sources, np.nan_to_num(shortcut, nan=0.0))
+            self._slack = slack
+        return self._slack
+
+    def neighbors(self, node):
+        """Соседи узла (строковые id) в исходном порядке"""
+        i = self.index[node]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [self.node_ids[j] for j in self.targets[start:end]]
+
+    def typed_nodes(self, type="building"):
+        """Аналог Graph.get_typed_nodes: узлы заданного типа в исходном порядке networkx"""
+        return [self.node_ids[i] for i in self.order if self.building_types[i] == type]
+
+    def find_edge(self, u, v):
+        """
+        Номер неориентированного ребра между узлами u и v (целые номера)
+
+        Returns:
+            int: номер ребра или -1, если рёбра нет
+        """
+        off, tg = self._offsets_view, self._targets_view
+        for k in range(off[u], off[u + 1]):
+            if tg[k] == v:
+                return self._edge_index_view[k]
+        return -1
+
+    def edge_id(self, u, v):
+        """Атрибут `id` ребра между узлами u и v (строковые id)"""
+        edge = self.find_edge(self.index[u], self.index[v])
+        if edge < 0:
+            raise KeyError((u, v))
+        return self.edge_ids[edge]
+
+    def half_edges(self, edges):
+        """
+        Позиции полурёбер (в targets/weights) для неориентированных рёбер
+
+        Returns:
+            np.ndarray: массив (len(edges), 2); у петли обе позиции совпадают
+        """
+        if self._halves is None:
+            order = np.argsort(self.edge_index, kind="stable")
+            counts = np.bincount(self.edge_index, minlength=self.num_edges)
+            starts = np.cumsum(counts) - counts
+            self._halves = np.stack([order[starts], order[starts + counts - 1]], axis=1)
+        return self._halves[np.asarray(edges, dtype=np.int64)]
+
+    def loads_by_id(self, loads):
+        """
+        Переводит нагрузку по номерам рёбер в словарь id дороги -> нагрузка (формат trafic.json)
+
+        Дорога, разделённая на участки узлами привязки зданий, получает нагрузку
+        самого загруженного участка: проезд вдоль всей дороги считается один раз.
+        Рёбра без id (связи зданий и склейки перекрёстков) суммируются под ключом None.
+        """
+        result = {}
+        for edge in np.flatnonzero(loads):
+            key = self.edge_ids[edge]
+            if key is None:
+                result[key] = result.get(key, 0) + int(loads[edge])
+            else:
+                result[key] = max(result.get(key, 0), int(loads[edge]))
+        return result
+
+    def path_edges(self, path):
+        """Номера рёбер вдоль пути, заданного строковыми id узлов"""
+        nodes = [self.index[node] for node in path]
+        return [self.find_edge(u, v) for u, v in zip(nodes, nodes[1:])]
+
+
+def encode_strings(name, values):
+    """Кодирует список строк (или None) в три массива: <name>_data, <name>_offsets, <name>_mask"""
+    encoded = [b"" if value is None else str(value).encode("utf-8") for value in values]
+    lengths = np.fromiter((len(value) for value in encoded), dtype=np.int64, count=len(encoded))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return {
+        f"{name}_data": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        f"{name}_offsets": offsets,
+        f"{name}_mask": np.array([value is not None for value in values], dtype=bool),
+    }
+
+
+def decode_strings(arrays, name):
+    """Обратное к encode_strings"""
+    data = arrays[f"{name}_data"].tobytes()
+    offsets = arrays[f"{name}_offsets"].tolist()
+    mask = arrays[f"{name}_mask"].tolist()
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") if present else None
+            for i, present in enumerate(mask)]
@@ -0,0 +1,437 @@
+import os
+import threading
+import time
+from collections import ChainMap, OrderedDict
+
+import numpy as np
+
+import AlternativeRoutes
+import AStar_GOD
+import FacilityIndex
+import GraphSnapshot
+import Main_alko
+
+# Виды правок сценария
+EDIT_KINDS = ("close_road", "close_edge", "population")
+
+
+class EngineNotReady(Exception):
+    """Движок сценариев ещё строится в фоне"""
+
+
+class ScenarioEngine:
+    """
+    Сценарии «что если»: закрытие дорог и изменение населения зданий
+
+    Базовая нагрузка совпадает с Main_alko.process_buildings при том же зерне:
+    каждое здание разыгрывается своим генератором building_rng. Для вкладов
+    (здание, цель, номер маршрута) хранится обратный индекс ребро -> вклады,
+    поэтому сценарий находит затронутые маршруты без обхода всех зданий.
+    Маршруты, проходящие по закрытым рёбрам, перестраиваются, затронутые здания
+    разыгрываются заново тем же генератором, и к базовой нагрузке прибавляется
+    только разница. Сценарий базу не меняет - сценарии независимы.
+
+    Перестроение маршрутов цели:
+      - кратчайший маршрут не задет - объект и расстояние прежние;
+      - кратчайший задет - ближайший объект и путь до него берутся из разметки
+        FacilityIndex с закрытыми рёбрами (один проход на цель за сценарий);
+      - альтернативный маршрут задет - закрытое ребро обходится кратчайшим
+        объездом между его концами, петли вырезаются;
+      - объект сменился - альтернативный маршрут идёт прежним путём до последнего
+        узла, ближайший объект которого - новый, и дальше по разметке к нему.
+    Объезды длиннее AlternativeRoutes.MAX_DETOUR кратчайшего отбрасываются.
+    Поиск со штрафами (k_alternative_paths) для каждой пары (здание, цель) на
+    загруженных рёбрах занимает десятки секунд, поэтому он только по запросу
+    (search_alternatives).
+    """
+
+    def __init__(self, graph, population_data, routes, seed=None, params=None):
+        """
+        Args:
+            graph: RoutingGraph
+            population_data: dict - id здания -> население
+            routes: dict - id здания -> маршруты (Main_alko.load_routes)
+            seed: int - зерно базовой нагрузки
+            params: dict - результат Main_alko.simulation_params (None - по умолчанию)
+        """
+        self.graph = graph
+        self.params = params
+        self.seed = seed
+        self.entropy = np.random.SeedSequence(seed).entropy
+        self.population = {building: int(population_data.get(building, 0)) for building in graph.typed_nodes()}
+        self.routes = dict(routes)
+        self.buildings = [building for building in self.routes if self.population.get(building, 0) > 0]
+
+        self.edge_length = np.zeros(graph.num_edges)
+        self.edge_length[graph.edge_index] = graph.weights
+        self.heuristic = AStar_GOD.euclidean_heuristic(graph)
+        self.roads = {}
+        for edge, road in enumerate(graph.edge_ids):
+            if road is not None:
+                self.roads.setdefault(str(road), []).append(edge)
+        self._facilities = None
+        # Маршрут (кортеж узлов) -> номера рёбер: маршруты длинные, и RoutingGraph.path_edges
+        # на каждом обращении занимал бы большую часть времени сценария. Новые маршруты
+        # переводятся в рёбра одним searchsorted по ключам полурёбер (как Assignment.edges_between)
+        self._route_edges = {}
+        sources = np.repeat(np.arange(graph.num_nodes, dtype=np.int64), np.diff(graph.offsets))
+        keys = sources * graph.num_nodes + graph.targets
+        order = np.argsort(keys, kind="stable")
+        self._half_keys = keys[order]
+        self._half_edges = graph.edge_index[order].astype(np.int64)
+
+        # Базовый розыгрыш и вклады: по вкладу - здание, цель и номер маршрута, по ребру вклада - вклад
+        self.samples = {}
+        slots, purposes, numbers, contribution_edges = [], [], [], []
+        for slot, building in enumerate(self.buildings):
+            self.samples[building] = self._sample(building, self.routes[building], self.population[building],
+                                                  self._route_edges)
+            for k, purpose in enumerate(Main_alko.PURPOSES):
+                for number, route in enumerate(self.routes[building][purpose][2]):
+                    edges = self._edges(route, self._route_edges)
+                    slots.append(slot)
+                    purposes.append(k)
+                    numbers.append(number)
+                    contribution_edges.append(edges)
+        self.contribution_slots = np.array(slots, dtype=np.int64)
+        self.contribution_purposes = np.array(purposes, dtype=np.int64)
+        self.contribution_routes = np.array(numbers, dtype=np.int64)
+        lengths = np.fromiter((len(edges) for edges in contribution_edges), dtype=np.int64,
+                              count=len(contribution_edges))
+        edges = np.concatenate([np.asarray(e, dtype=np.int64) for e in contribution_edges] + [np.zeros(0, np.int64)])
+        contributions = np.repeat(np.arange(len(contribution_edges)), lengths)
+        order = np.argsort(edges, kind="stable")
+        self.index_offsets = np.searchsorted(edges[order], np.arange(graph.num_edges + 1))
+        self.index_contributions = contributions[order]
+
+        self.baseline = self._loads(self.samples.values())
+
+    def contributions(self, edges):
+        """
+        Вклады, маршруты которых проходят по рёбрам edges
+
+        Returns:
+            list: тройки (id здания, цель, номер маршрута)
+        """
+        found = np.unique(np.concatenate([self.index_contributions[self.index_offsets[e]:self.index_offsets[e + 1]]
+                                          for e in edges] + [np.zeros(0, np.int64)]))
+        return [(self.buildings[self.contribution_slots[c]], Main_alko.PURPOSES[self.contribution_purposes[c]],
+                 int(self.contribution_routes[c])) for c in found]
+
+    def apply(self, edits, search_alternatives=False):
+        """
+        Нагрузка при правках edits относительно базовой
+
+        Args:
+            edits: list - словари с полем kind:
+                {"kind": "close_road", "road": id дороги} - закрыть все участки дороги;
+                {"kind": "close_edge", "nodes": [u, v]} - закрыть ребро между узлами;
+                {"kind": "population", "building": id, "population": n} - новое население здания
+                    (или "delta": n - изменение)
+            search_alternatives: bool - маршруты затронутых целей ищутся заново
+                k_alternative_paths, как при полном прогоне (медленно на загруженных рёбрах)
+
+        Raises:
+            ValueError: неизвестный вид правки, дорога, ребро или здание
+
+        Returns:
+            dict: loads - нагрузка по номеру ребра, delta - разница с базовой,
+                rerouted - число перестроенных пар (здание, цель),
+                resampled - число заново разыгранных зданий, seconds - время
+        """
+        started = time.perf_counter()
+        closed, population = self._parse(edits)
+
+        # Здание -> цель -> номера маршрутов, проходящих по закрытым рёбрам
+        affected = {}
+        for building, purpose, number in self.contributions(sorted(closed)):
+            affected.setdefault(building, {}).setdefault(purpose, set()).add(number)
+        for building in population:
+            affected.setdefault(building, {})
+
+        weights = None
+        if closed:
+            weights = self.graph.weights.astype(np.float64)
+            weights[self.graph.half_edges(sorted(closed)).ravel()] = np.inf
+        labels = {}
+        detours = {}
+        # Рёбра новых маршрутов сценария - отдельно, базовые не меняются
+        memo = ChainMap({}, self._route_edges)
+
+        def facility_labels(purpose):
+            if not closed:
+                return self.facilities()[purpose]
+            if purpose not in labels:
+                labels[purpose] = FacilityIndex.label_nearest_facilities(self.graph, (purpose,), weights)[purpose]
+            return labels[purpose]
+
+        old_samples, new_samples = [], []
+        rerouted = 0
+        for building, purposes in affected.items():
+            routes = self.routes.get(building)
+            if routes is None:
+                routes = self._building_routes(building, closed, facility_labels)
+            elif purposes:
+                routes = dict(routes)
+                for purpose, numbers in purposes.items():
+                    routes[purpose] = self._reroute(building, routes[purpose], numbers, closed, weights,
+                                                    facility_labels(purpose), detours, search_alternatives, memo)
+                    rerouted += 1
+            old = self.samples.get(building)
+            if old is not None:
+                old_samples.append(old)
+            new_samples.append(self._sample(building, routes, population.get(building, self.population[building]),
+                                            memo))
+
+        delta = self._loads(new_samples) - self._loads(old_samples)
+        return {
+            "loads": self.baseline + delta,
+            "delta": delta,
+            "rerouted": rerouted,
+            "resampled": len(new_samples),
+            "seconds": time.perf_counter() - started,
+        }
+
+    def facilities(self):
+        """Разметка ближайших объектов без правок; строится при первом обращении"""
+        if self._facilities is None:
+            self._facilities = FacilityIndex.label_nearest_facilities(self.graph)
+        return self._facilities
+
+    def _parse(self, edits):
+        closed = set()
+        population = {}
+        for edit in edits:
+            kind = edit.get("kind")
+            if kind == "close_road":
+                edges = self.roads.get(str(edit.get("road")))
+                if edges is None:
+                    raise ValueError(f"Нет дороги {edit.get('road')}")
+                closed.update(edges)
+            elif kind == "close_edge":
+                nodes = edit.get("nodes") or []
+                if len(nodes) != 2 or any(node not in self.graph.index for node in nodes):
+                    raise ValueError(f"Нет узлов {nodes}")
+                edge = self.graph.find_edge(self.graph.index[nodes[0]], self.graph.index[nodes[1]])
+                if edge < 0:
+                    raise ValueError(f"Нет ребра между {nodes[0]} и {nodes[1]}")
+                closed.add(edge)
+            elif kind == "population":
+                building = edit.get("building")
+                if building not in self.population:
+                    raise ValueError(f"Нет здания {building}")
+                if edit.get("population") is not None:
+                    value = edit["population"]
+                elif edit.get("delta") is not None:
+                    value = population.get(building, self.population[building]) + edit["delta"]
+                else:
+                    raise ValueError(f"Для здания {building} не задано population или delta")
+                population[building] = max(0, int(value))
+            else:
+                raise ValueError(f"Неизвестная правка {kind}, ожидается одна из {EDIT_KINDS}")
+        return closed, population
+
+    def _sample(self, building, routes, population, memo):
+        # Рёбра всех маршрутов здания подряд и число проходов по каждому - как в sample_loads
+        if population <= 0 or routes is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        probabilities, route_edges = Main_alko.building_outcomes(self.graph, routes, self.params,
+                                                                 lambda route: self._edges(route, memo))
+        if not probabilities:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        rng = Main_alko.building_rng(self.entropy, self.graph, building)
+        counts = Main_alko.outcome_counts(probabilities, population, rng)
+        lengths = [len(edges) for edges in route_edges]
+        edges = np.concatenate([np.asarray(e, dtype=np.int64) for e in route_edges])
+        return edges, np.repeat(counts, lengths)
+
+    def _loads(self, samples):
+        samples = list(samples)
+        if not samples:
+            return np.zeros(self.graph.num_edges, dtype=np.int64)
+        edges = np.concatenate([edges for edges, _ in samples])
+        counts = np.concatenate([counts for _, counts in samples])
+        return np.bincount(edges, weights=counts, minlength=self.graph.num_edges).astype(np.int64)
+
+    def _building_routes(self, building, closed, facility_labels):
+        # Маршруты здания, у которого в базе не было жителей, - как Main_alko.building_routes
+        routes = {}
+        for purpose in Main_alko.PURPOSES:
+            facility, distance = facility_labels(purpose).lookup(building)
+            paths = [] if facility is None else AlternativeRoutes.k_alternative_paths(
+                self.graph, building, facility, blocked=closed)
+            routes[purpose] = (facility, distance, paths)
+        return routes
+
+    def _reroute(self, building, entry, numbers, closed, weights, labels, detours, search, memo):
+        # numbers - номера маршрутов цели, проходящих по закрытым рёбрам
+        facility, distance, routes = entry
+        if 0 in numbers or search:
+            i = self.graph.index[building]
+            if labels.nearest[i] < 0:
+                return None, float('inf'), []
+            new_facility, distance = self.graph.node_ids[labels.nearest[i]], float(labels.distances[i])
+            if search:
+                return new_facility, distance, AlternativeRoutes.k_alternative_paths(
+                    self.graph, building, new_facility, blocked=closed)
+            shortest = labels.path(building)
+        else:
+            new_facility, shortest = facility, routes[0]
+
+        accepted = [shortest]
+        for number, route in enumerate(routes[1:], start=1):
+            if new_facility != facility:
+                route = self._redirect(route, closed, labels, self.graph.index[new_facility], memo)
+            elif number in numbers:
+                route = self._detour(route, closed, weights, detours, memo)
+            if (route and route not in accepted
+                    and self._length(route, memo) <= AlternativeRoutes.MAX_DETOUR * distance):
+                accepted.append(route)
+        accepted[1:] = sorted(accepted[1:], key=lambda route: self._length(route, memo))
+        return new_facility, distance, accepted
+
+    def _redirect(self, route, closed, labels, target, memo):
+        # Начало маршрута до закрытого ребра, от его последнего узла с ближайшим объектом target - путь разметки
+        edges = self._edges(route, memo).tolist()
+        last = None
+        for i, node in enumerate(route):
+            if labels.nearest[self.graph.index[node]] == target:
+                last = i
+            if i < len(edges) and edges[i] in closed:
+                break
+        if last is None:
+            return None
+        return _erase_loops(route[:last] + labels.path(route[last]))
+
+    def _detour(self, route, closed, weights, detours, memo):
+        # Закрытые рёбра маршрута заменяются кратчайшим объездом между их концами
+        nodes = [route[0]]
+        for (u, v), edge in zip(zip(route, route[1:]), self._edges(route, memo).tolist()):
+            if edge not in closed:
+                nodes.append(v)
+                continue
+            if (u, v) not in detours:
+                _, path = AStar_GOD.astar(self.graph, u, v, self.heuristic, weights=memoryview(weights))
+                detours[(u, v)] = path
+            if not detours[(u, v)]:
+                return None
+            nodes.extend(detours[(u, v)][1:])
+        return _erase_loops(nodes)
+
+    def _edges(self, route, memo):
+        key = tuple(route)
+        edges = memo.get(key)
+        if edges is None:
+            nodes = np.fromiter((self.graph.index[node] for node in route), dtype=np.int64, count=len(route))
+            position = np.searchsorted(self._half_keys, nodes[:-1] * self.graph.num_nodes + nodes[1:])
+            edges = memo[key] = self._half_edges[position]
+        return edges
+
+    def _length(self, route, memo):
+        return float(self.edge_length[self._edges(route, memo)].sum())
+
+
+def _erase_loops(nodes):
+    # Объезд может вернуться на уже пройденный участок маршрута - петля вырезается
+    path = []
+    position = {}
+    for node in nodes:
+        if node in position:
+            for removed in path[position[node] + 1:]:
+                del position[removed]
+            del path[position[node] + 1:]
+        else:
+            position[node] = len(path)
+            path.append(node)
+    return path
+
+
+def road_changes(graph, baseline, loads):
+    """
+    Изменившаяся нагрузка по id дорог (как в trafic.json)
+
+    Returns:
+        dict: id дороги -> {"baseline", "scenario", "delta"}
+    """
+    before = graph.loads_by_id(baseline)
+    after = graph.loads_by_id(loads)
+    changes = {}
+    for road in set(before) | set(after):
+        if road is None:
+            continue
+        old, new = before.get(road, 0), after.get(road, 0)
+        if old != new:
+            changes[road] = {"baseline": old, "scenario": new, "delta": new - old}
+    return changes
+
+
+class Scenarios:
+    """
+    Движки сценариев для API по зерну базовой нагрузки
+
+    Движок строится в фоновом потоке по текущему снимку графа (маршруты - из
+    RouteCache; недостающие ищутся, это может занять минуты) и переиспользуется,
+    пока снимок не изменится. Пока он строится, engine() сразу отвечает
+    EngineNotReady, так что запрос API не ждёт построения и не задерживает
+    сценарии других движков. Хранится не больше keep движков.
+    """
+
+    def __init__(self, snapshot_path=GraphSnapshot.SNAPSHOT_PATH, population_path="population_data.json",
+                 cache_path="route_cache.pkl", keep=2):
+        self.snapshot_path = snapshot_path
+        self.population_path = population_path
+        self.cache_path = cache_path
+        self.keep = keep
+        self._engines = OrderedDict()
+        self._building = set()
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def engine(self, seed=0, params=None):
+        """
+        Движок для зерна seed по текущему графу; если его нет - запускает построение в фоне
+
+        Raises:
+            EngineNotReady: движок строится, запрос нужно повторить позже
+            Exception: ошибка предыдущего построения (следующий вызов построит заново)
+
+        Returns:
+            ScenarioEngine
+        """
+        key = (self._graph_version(), seed, repr(params))
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is not None:
+                self._engines.move_to_end(key)
+                return engine
+            error = self._errors.pop(key, None)
+            if error is not None:
+                raise error
+            if key not in self._building:
+                self._building.add(key)
+                threading.Thread(target=self._build, args=(key, seed, params), daemon=True).start()
+        raise EngineNotReady(key)
+
+    def _build(self, key, seed, params):
+        try:
+            graph = GraphSnapshot.load_routing_graph(self.snapshot_path)
+            population_data = Main_alko.load_population(graph, self.population_path)
+            routes = Main_alko.load_routes(graph, graph.typed_nodes(), population_data, self.cache_path)
+            engine = ScenarioEngine(graph, population_data, routes, seed, params)
+        except Exception as e:
+            with self._lock:
+                self._building.discard(key)
+                self._errors[key] = e
+            return
+        with self._lock:
+            self._building.discard(key)
+            self._engines[key] = engine
+            while len(self._engines) > self.keep:
+                self._engines.popitem(last=False)
+
+    def _graph_version(self):
+        # Снимок заменяется каталогом целиком, поэтому время изменения meta.json меняется с каждым графом
+        path = os.path.join(self.snapshot_path, GraphSnapshot.META_FILE)
+        if not os.path.exists(path):
+            path = "graph.pkl"
+        return os.stat(path).st_mtime_ns if os.path.exists(path) else None
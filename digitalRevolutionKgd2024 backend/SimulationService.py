@@ -0,0 +1,201 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+import FacilityIndex
+import GraphSnapshot
+import Main_alko
+import ParallelSimulation
+from RouteCache import RouteCache
+
+
+class TooManyRuns(Exception):
+    """Одновременно выполняется уже max_runs прогонов"""
+
+
+class SimulationRun:
+    """
+    Прогон симуляции: параметры, ход и накопленная нагрузка по номеру ребра
+
+    version растёт с каждой обработанной пачкой зданий - по ней поток
+    ответа понимает, что есть что отправить.
+    """
+
+    def __init__(self, id, params, seed):
+        self.id = id
+        self.params = params
+        self.seed = seed
+        self.status = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.error = None
+        self.graph = None
+        self.loads = None
+        self.buildings_total = 0
+        self.buildings_done = 0
+        self.version = 0
+        self.cancel_requested = False
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def status_dict(self):
+        return {
+            "run_id": self.id,
+            "status": self.status,
+            "buildings_done": self.buildings_done,
+            "buildings_total": self.buildings_total,
+            "params": self.params,
+            "seed": self.seed,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+    def snapshot(self):
+        """(version, копия накопленной нагрузки, status_dict) под блокировкой прогона"""
+        with self.lock:
+            loads = None if self.loads is None else self.loads.copy()
+            return self.version, loads, self.status_dict()
+
+    def loads_by_id(self):
+        """Итоговая (или текущая) нагрузка в формате trafic.json"""
+        _, loads, _ = self.snapshot()
+        return {} if loads is None else self.graph.loads_by_id(loads)
+
+
+class SimulationRuns:
+    """
+    Реестр прогонов симуляции для API
+
+    Прогон выполняется в фоновом потоке: сам поток только собирает нагрузку
+    пачек зданий, которую считает пул процессов ParallelSimulation, поэтому
+    цикл событий сервера не блокируется. Накопленная нагрузка доступна во
+    время прогона - для потоковой выдачи. Хранится не больше keep
+    завершённых прогонов.
+    """
+
+    def __init__(self, max_runs=1, keep=20, workers=None, chunksize=16, snapshot_path=GraphSnapshot.SNAPSHOT_PATH,
+                 population_path="population_data.json", cache_path="route_cache.pkl"):
+        self.max_runs = max_runs
+        self.keep = keep
+        self.workers = workers
+        self.chunksize = chunksize
+        self.snapshot_path = snapshot_path
+        self.population_path = population_path
+        self.cache_path = cache_path
+        self.runs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, params=None, seed=None):
+        """
+        Запускает прогон по текущему графу
+
+        Args:
+            params: dict - результат Main_alko.simulation_params (None - по умолчанию)
+            seed: int - зерно (None - случайное); с тем же зерном нагрузка повторяется
+
+        Raises:
+            TooManyRuns: выполняется уже max_runs прогонов
+
+        Returns:
+            SimulationRun
+        """
+        if params is None:
+            params = Main_alko.simulation_params()
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+        with self._lock:
+            if sum(run.active for run in self.runs.values()) >= self.max_runs:
+                raise TooManyRuns(self.max_runs)
+            run = SimulationRun(uuid.uuid4().hex, params, seed)
+            self.runs[run.id] = run
+            finished = [run_id for run_id, other in self.runs.items() if not other.active]
+            for run_id in finished[:max(0, len(finished) - self.keep)]:
+                del self.runs[run_id]
+        threading.Thread(target=self._execute, args=(run,), daemon=True).start()
+        return run
+
+    def get(self, run_id):
+        return self.runs.get(run_id)
+
+    def cancel(self, run):
+        """Останавливает прогон после текущей пачки; False - прогон уже завершён"""
+        if not run.active:
+            return False
+        run.cancel_requested = True
+        return True
+
+    def _execute(self, run):
+        try:
+            graph = GraphSnapshot.load_routing_graph(self.snapshot_path)
+            population_data = Main_alko.load_population(graph, self.population_path)
+            buildings = graph.typed_nodes()
+            with run.lock:
+                run.graph = graph
+                run.loads = np.zeros(graph.num_edges, dtype=np.int64)
+                run.buildings_total = len(buildings)
+                run.status = "running"
+
+            # Маршруты не зависят от параметров прогона, поэтому кэш общий для всех прогонов
+            cache = RouteCache(self.cache_path).load(graph) if self.cache_path else None
+            facilities = None
+            if cache is None or any(cache.get(b) is None and int(population_data.get(b, 0)) > 0 for b in buildings):
+                facilities = FacilityIndex.label_nearest_facilities(graph)
+            population = [population_data.get(node, 0) for node in graph.node_ids]
+            entropy = np.random.SeedSequence(run.seed).entropy
+
+            chunks = ParallelSimulation.iter_processes(graph, buildings, population, facilities, self.workers,
+                                                       self.chunksize, entropy, cache=cache, params=run.params)
+            try:
+                for chunk, chunk_loads in chunks:
+                    with run.lock:
+                        run.loads += chunk_loads
+                        run.buildings_done += len(chunk)
+                        run.version += 1
+                    if run.cancel_requested:
+                        break
+            finally:
+                chunks.close()
+            if cache is not None:
+                cache.save()
+            status = "cancelled" if run.cancel_requested else "done"
+        except Exception as e:
+            status = "failed"
+            run.error = f"{type(e).__name__}: {e}"
+        with run.lock:
+            run.status = status
+            run.finished = time.time()
+            run.version += 1
+
+
+def load_updates(run, previous):
+    """
+    Накопленная нагрузка по id дорог, изменившаяся с прошлой отправки
+
+    Args:
+        run: SimulationRun
+        previous: dict - нагрузка по id, отправленная ранее (обновляется на месте)
+
+    Returns:
+        tuple: (version, {id дороги: накопленная нагрузка} - только изменившиеся, status_dict)
+    """
+    version, loads, status = run.snapshot()
+    current = {} if loads is None else run.graph.loads_by_id(loads)
+    changed = {key: value for key, value in current.items() if previous.get(key) != value}
+    previous.update(changed)
+    return version, changed, status
+
+
+def format_event(event, data, format):
+    """Событие потока: строка NDJSON или событие SSE"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if format == "sse":
+        return f"event: {event}\ndata: {payload}\n\n"
+    return payload + "\n"
@@ -0,0 +1,202 @@
+import argparse
+import os
+import tempfile
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+# Левый нижний угол города в EPSG:3857 - рядом с исходными данными
+ORIGIN = (4170000.0, 7460000.0)
+BLOCK_SIZE = 200.0  # сторона квартала, м
+CRS = "EPSG:3857"
+
+# Категория улицы по номеру линии сетки: (делитель номера, ROAD_CATEG, Width); первая подошедшая
+STREET_CATEGORIES = [
+    (8, "Магистральные улицы города", 18.0),
+    (4, "Основные улицы города", 12.0),
+    (1, "Прочие улицы города", 9.0),
+]
+FOOTLESS_SHARE = 0.05  # доля улиц без пешеходного движения (Foot = 0)
+STOP_EVERY = 4  # остановки на перекрёстках каждой STOP_EVERY-й линии
+METRO_EVERY = 8  # выходы метро на перекрёстках линий, кратных METRO_EVERY
+JK_EVERY = 6  # кварталы ЖК - через JK_EVERY кварталов, чтобы радиус отбора покрывал весь город
+
+# Дома квартала: (Type, Purpose, интервал числа квартир или None) -> доля
+HOUSE_KINDS = [
+    (("Частные дома", "Частный дом", None), 0.4),
+    (("Частные дома", "Коттедж", None), 0.2),
+    (("Жилые дома", "Жилой дом", (20, 150)), 0.2),
+    (("Жилые дома", "Малоэтажный жилой дом", None), 0.05),
+    (("Жилые дома", "Таунхаус", None), 0.05),
+    (("Административные сооружения", "Административное здание", None), 0.1),
+]
+JK_APARTMENTS = (100, 300)
+
+# Участки домов в четверти квартала: (xmin, ymin, xmax, ymax) от угла четверти, м
+LOTS = [(20.0, 15.0, 80.0, 40.0), (20.0, 55.0, 80.0, 85.0)]
+LOT_JITTER = 5.0
+
+LAYER_EXTENSIONS = ("shp", "shx", "dbf", "prj", "cpg")
+
+
+def generate_city(size=10, seed=0, origin=ORIGIN, block_size=BLOCK_SIZE):
+    """
+    Синтетический город - слои в том виде, в каком их загружают в /upload
+
+    Город - сетка size x size кварталов. Улицы идут по линиям сетки участками
+    от перекрёстка до перекрёстка, через каждый квартал крестом проходят
+    пешеходные дорожки, в каждой четверти квартала - два дома. Кварталы ЖК
+    (обе очереди) расставлены через JK_EVERY кварталов, так что отбор по
+    радиусу NEAR_HOUSES_RADIUS оставляет весь город. Школы и детсады - по
+    одному дому в части кварталов, остановки и выходы метро - у перекрёстков
+    крупных улиц. При одинаковых size и seed слои совпадают.
+
+    size=10 - около 800 зданий, как в graph_geojson; число объектов растёт как size ** 2.
+
+    Args:
+        size: int - кварталов по стороне
+        seed: int - зерно
+        origin: tuple - левый нижний угол в EPSG:3857
+        block_size: float - сторона квартала, м
+
+    Returns:
+        dict: имя слоя -> GeoDataFrame в EPSG:3857
+    """
+    rng = np.random.default_rng(seed)
+    x0, y0 = origin
+    lines = np.arange(size + 1)
+
+    # Улицы: горизонтальные и вертикальные участки между соседними перекрёстками
+    streets = []
+    for line in lines:
+        _, category, width = next(rule for rule in STREET_CATEGORIES if line % rule[0] == 0)
+        for k in range(size):
+            a, b = k * block_size, (k + 1) * block_size
+            position = line * block_size
+            streets.append((shapely.LineString([(x0 + a, y0 + position), (x0 + b, y0 + position)]), category, width))
+            streets.append((shapely.LineString([(x0 + position, y0 + a), (x0 + position, y0 + b)]), category, width))
+    foot = (rng.random(len(streets)) >= FOOTLESS_SHARE).astype(np.float64)
+    roads = {
+        "ROAD_CATEG": [category for _, category, _ in streets],
+        "Foot": foot.tolist(),
+        "Width": [width for _, _, width in streets],
+        "geometry": [geometry for geometry, _, _ in streets],
+    }
+
+    # Пешеходные дорожки крестом через квартал - примыкают к серединам улиц
+    half = block_size / 2
+    for i in range(size):
+        for j in range(size):
+            bx, by = x0 + i * block_size, y0 + j * block_size
+            for geometry in (shapely.LineString([(bx + half, by), (bx + half, by + block_size)]),
+                             shapely.LineString([(bx, by + half), (bx + block_size, by + half)])):
+                roads["ROAD_CATEG"].append("Пешеходные дорожки")
+                roads["Foot"].append(1.0)
+                roads["Width"].append(None)
+                roads["geometry"].append(geometry)
+
+    # Дома: по два на четверть квартала
+    jk_offset = min(JK_EVERY // 2, size // 2)
+    kinds = [kind for kind, _ in HOUSE_KINDS]
+    shares = np.array([share for _, share in HOUSE_KINDS])
+    houses = {"Type": [], "Purpose": [], "Apartments": [], "geometry": []}
+    queues = {1: {"Type": [], "Purpose": [], "Apartments": [], "geometry": []},
+              2: {"Type": [], "Purpose": [], "Apartments": [], "geometry": []}}
+    for i in range(size):
+        for j in range(size):
+            bx, by = x0 + i * block_size, y0 + j * block_size
+            jk = (i - jk_offset) % JK_EVERY == 0 and (j - jk_offset) % JK_EVERY == 0
+            lot_number = 0
+            for qx in (0.0, half):
+                for qy in (0.0, half):
+                    for xmin, ymin, xmax, ymax in LOTS:
+                        scale = half / 100
+                        jitter = rng.uniform(-LOT_JITTER, LOT_JITTER, 2)
+                        geometry = shapely.box(bx + qx + xmin * scale + jitter[0], by + qy + ymin * scale + jitter[1],
+                                               bx + qx + xmax * scale + jitter[0], by + qy + ymax * scale + jitter[1])
+                        if jk:
+                            layer = queues[1 if lot_number < len(LOTS) * 2 else 2]
+                            kind = ("Жилые дома", "Жилой дом", JK_APARTMENTS)
+                        else:
+                            layer = houses
+                            kind = kinds[rng.choice(len(kinds), p=shares)]
+                            if lot_number == 0 and (i + 2 * j) % 5 == 0:
+                                kind = ("Школы", "Школа", None)
+                            elif lot_number == 1 and (2 * i + j) % 5 == 0:
+                                kind = ("Дошкольные", "Детский сад", None)
+                        type, purpose, apartments = kind
+                        layer["Type"].append(type)
+                        layer["Purpose"].append(purpose)
+                        layer["Apartments"].append(None if apartments is None
+                                                   else float(rng.integers(apartments[0], apartments[1] + 1)))
+                        layer["geometry"].append(geometry)
+                        lot_number += 1
+
+    # Остановки - у перекрёстков крупных улиц, выходы метро - у перекрёстков магистралей
+    stops = {"TrType": [], "Name": [], "geometry": []}
+    metro = {"Text": [], "Number": [], "geometry": []}
+    major = lines[lines % STOP_EVERY == 0]
+    for i in major:
+        for j in major:
+            x, y = x0 + i * block_size, y0 + j * block_size
+            stops["TrType"].append("Автобус")
+            stops["Name"].append(f"Остановка {i}-{j}")
+            stops["geometry"].append(shapely.Point(x + 10.0, y + 10.0))
+    metro_lines = lines[lines % METRO_EVERY == METRO_EVERY // 2]
+    if not len(metro_lines):
+        metro_lines = np.array([size // 2])
+    for station, (i, j) in enumerate((i, j) for i in metro_lines for j in metro_lines):
+        x, y = x0 + i * block_size, y0 + j * block_size
+        for number, (dx, dy) in enumerate([(-15.0, -15.0), (15.0, 15.0)], start=1):
+            metro["Text"].append(f"Станция {station + 1}")
+            metro["Number"].append(str(number))
+            metro["geometry"].append(shapely.Point(x + dx, y + dy))
+
+    return {
+        "House_1очередь_ЖК": gpd.GeoDataFrame(queues[1], crs=CRS),
+        "House_2очередь_ЖК": gpd.GeoDataFrame(queues[2], crs=CRS),
+        "Дома_исходные": gpd.GeoDataFrame(houses, crs=CRS),
+        "Streets_1": gpd.GeoDataFrame(roads, crs=CRS),
+        "Остановки_ОТ": gpd.GeoDataFrame(stops, crs=CRS),
+        "Выходы_метро": gpd.GeoDataFrame(metro, crs=CRS),
+    }
+
+
+def write_shapefiles(layers, directory):
+    """Записывает слои наборами shapefile <имя слоя>.shp/.shx/.dbf/.prj/.cpg в directory"""
+    os.makedirs(directory, exist_ok=True)
+    for name, gdf in layers.items():
+        gdf.to_file(os.path.join(directory, f"{name}.shp"), encoding="utf-8", engine="pyogrio")
+
+
+def to_uploads(layers):
+    """
+    Слои в формате GeojsonService.read_uploads - как если бы их прислали в /upload
+
+    Returns:
+        list: пары (имя слоя, расширение -> байты файла)
+    """
+    uploads = []
+    with tempfile.TemporaryDirectory() as directory:
+        write_shapefiles(layers, directory)
+        for name in layers:
+            files = {}
+            for ext in LAYER_EXTENSIONS:
+                with open(os.path.join(directory, f"{name}.{ext}"), "rb") as f:
+                    files[ext] = f.read()
+            uploads.append((name, files))
+    return uploads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Синтетический город для замеров: наборы shapefile для /upload")
+    parser.add_argument("--size", type=int, default=10, help="кварталов по стороне")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="synthetic_city")
+    args = parser.parse_args()
+
+    layers = generate_city(args.size, args.seed)
+    write_shapefiles(layers, args.output)
+    for name, gdf in layers.items():
+        print(f"{name}: {len(gdf)}")
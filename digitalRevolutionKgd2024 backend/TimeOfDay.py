@@ -0,0 +1,168 @@
+import argparse
+
+import numpy as np
+
+import Citizen
+import GraphSnapshot
+import Main_alko
+from RoutingGraph import encode_strings, decode_strings
+
+HOURS_PER_DAY = 24
+# Часы, в которые жители вообще выходят из дома (вне пиков поездки распределены по ним поровну)
+ACTIVE_HOURS = range(6, 23)
+
+# Часы пик для каждой цели: час начала -> относительный вес внутри пиковой доли.
+# Утром - дорога туда, днём и вечером - обратно
+DEPARTURE_PEAKS = {
+    'school': {7: 3, 13: 1, 14: 1},
+    'sad': {7: 2, 8: 1, 17: 1, 18: 2},
+    'metro': {7: 2, 8: 2, 17: 1, 18: 2, 19: 1},
+    'ot': {7: 2, 8: 2, 17: 1, 18: 2, 19: 1},
+}
+
+
+def departure_profiles(peak_ratio=Citizen.PEAK_RATIO, bucket_hours=1, peaks=None):
+    """
+    Доли поездок каждой цели по интервалам суток
+
+    На часы пик цели приходится peak_ratio её поездок (по весам из peaks),
+    остаток поровну делится между прочими часами ACTIVE_HOURS. Каждая строка
+    в сумме даёт 1, поэтому сумма нагрузки по интервалам равна суточной.
+
+    Args:
+        peak_ratio: float - доля поездок в часы пик
+        bucket_hours: int - длина интервала в часах (делитель 24)
+        peaks: dict - цель -> {час: вес} (None - DEPARTURE_PEAKS)
+
+    Raises:
+        ValueError: peak_ratio вне [0, 1] или 24 не делится на bucket_hours
+
+    Returns:
+        np.ndarray[float64]: (len(PURPOSES), 24 // bucket_hours) в порядке Main_alko.PURPOSES
+    """
+    if not 0 <= peak_ratio <= 1:
+        raise ValueError("peak_ratio должен быть в [0, 1]")
+    if bucket_hours <= 0 or HOURS_PER_DAY % bucket_hours:
+        raise ValueError(f"bucket_hours должен делить {HOURS_PER_DAY}")
+    if peaks is None:
+        peaks = DEPARTURE_PEAKS
+
+    profiles = np.zeros((len(Main_alko.PURPOSES), HOURS_PER_DAY))
+    for k, purpose in enumerate(Main_alko.PURPOSES):
+        weights = peaks[purpose]
+        total = sum(weights.values())
+        for hour, weight in weights.items():
+            profiles[k, hour] = peak_ratio * weight / total
+        off_peak = [hour for hour in ACTIVE_HOURS if hour not in weights]
+        profiles[k, off_peak] = (1 - peak_ratio) / len(off_peak)
+    return profiles.reshape(len(Main_alko.PURPOSES), -1, bucket_hours).sum(axis=2)
+
+
+def purpose_loads(G, buildings, population_data, routes, entropy, params=None):
+    """
+    Нагрузка на рёбра отдельно по каждой цели поездки
+
+    Розыгрыш тот же, что в Main_alko.process_building (outcome_counts с генератором
+    здания building_rng), поэтому сумма по целям совпадает с нагрузкой process_buildings
+    при том же зерне. Из зданий в цикле берутся только числа жителей на исход;
+    рёбра всех маршрутов раскладываются по целям одним bincount.
+
+    Args:
+        G: RoutingGraph
+        buildings: list - id зданий
+        population_data: dict - id здания -> население
+        routes: dict - id здания -> маршруты (Main_alko.building_routes)
+        entropy: int - общее зерно
+        params: dict - результат Main_alko.simulation_params (None - по умолчанию)
+
+    Returns:
+        np.ndarray[int64]: (число рёбер, len(PURPOSES))
+    """
+    route_edges, counts, purposes = [], [], []
+    for building in buildings:
+        population = int(population_data.get(building, 0))
+        if population <= 0 or routes.get(building) is None:
+            continue
+        probabilities, edges = Main_alko.building_outcomes(G, routes[building], params)
+        if not probabilities:
+            continue
+        rng = Main_alko.building_rng(entropy, G, building)
+        route_edges.extend(edges)
+        counts.append(Main_alko.outcome_counts(probabilities, population, rng))
+        purposes.append(np.repeat(np.arange(len(Main_alko.PURPOSES)),
+                                  [len(routes[building][purpose][2]) for purpose in Main_alko.PURPOSES]))
+
+    width = len(Main_alko.PURPOSES)
+    if not route_edges:
+        return np.zeros((G.num_edges, width), dtype=np.int64)
+    lengths = np.fromiter((len(edges) for edges in route_edges), dtype=np.int64, count=len(route_edges))
+    edges = np.concatenate([np.asarray(edges, dtype=np.int64) for edges in route_edges])
+    counts = np.repeat(np.concatenate(counts), lengths)
+    purposes = np.repeat(np.concatenate(purposes), lengths)
+    loads = np.bincount(edges * width + purposes, weights=counts, minlength=G.num_edges * width)
+    return np.rint(loads).astype(np.int64).reshape(G.num_edges, width)
+
+
+def time_of_day_loads(G, buildings, population_data, seed=None, params=None, peak_ratio=Citizen.PEAK_RATIO,
+                      bucket_hours=1, cache_path="route_cache.pkl"):
+    """
+    Нагрузка на рёбра по интервалам суток
+
+    Маршруты берутся из RouteCache (недостающие ищутся один раз и
+    дописываются в кэш), нагрузка по целям считается одним проходом
+    (purpose_loads), и все интервалы получаются одним умножением на матрицу
+    профилей departure_profiles - без повторной симуляции на каждый час.
+
+    Args:
+        G: RoutingGraph
+        buildings: list - id зданий
+        population_data: dict - id здания -> население
+        seed: int - зерно; с тем же зерном сумма по интервалам равна trafic.json
+        params: dict - результат Main_alko.simulation_params (None - по умолчанию)
+        peak_ratio: float - доля поездок в часы пик
+        bucket_hours: int - длина интервала в часах
+        cache_path: str - файл RouteCache (None - без кэша)
+
+    Returns:
+        np.ndarray[float32]: (число рёбер, 24 // bucket_hours)
+    """
+    profiles = departure_profiles(peak_ratio, bucket_hours)
+    routes = Main_alko.load_routes(G, buildings, population_data, cache_path)
+    entropy = np.random.SeedSequence(seed).entropy
+    by_purpose = purpose_loads(G, buildings, population_data, routes, entropy, params)
+    return (by_purpose @ profiles).astype(np.float32)
+
+
+def save_loads(path, G, loads, bucket_hours, peak_ratio, seed):
+    """Сохраняет нагрузку по интервалам в сжатый .npz вместе с id дорог для каждого ребра"""
+    np.savez_compressed(path, loads=loads, bucket_hours=np.int64(bucket_hours),
+                        peak_ratio=np.float64(peak_ratio), seed=np.int64(seed),
+                        **encode_strings("edge_ids", G.edge_ids))
+
+
+def load_loads(path):
+    """Читает .npz из save_loads; edge_ids возвращаются списком"""
+    with np.load(path) as data:
+        arrays = {name: data[name] for name in data.files}
+    arrays["edge_ids"] = decode_strings(arrays, "edge_ids")
+    for name in ("edge_ids_data", "edge_ids_offsets", "edge_ids_mask"):
+        del arrays[name]
+    return arrays
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузка на дороги по часам суток")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--peak-ratio", type=float, default=Citizen.PEAK_RATIO)
+    parser.add_argument("--bucket-hours", type=int, default=1)
+    parser.add_argument("--output", default="trafic_hourly.npz")
+    args = parser.parse_args()
+
+    R = GraphSnapshot.load_routing_graph()
+    population_data = Main_alko.load_population(R)
+
+    loads = time_of_day_loads(R, R.typed_nodes(), population_data, args.seed, peak_ratio=args.peak_ratio,
+                              bucket_hours=args.bucket_hours)
+    save_loads(args.output, R, loads, args.bucket_hours, args.peak_ratio, args.seed)
+    busiest = int(loads.sum(axis=0).argmax())
+    print(f"Самый загруженный интервал: {busiest * args.bucket_hours}:00")
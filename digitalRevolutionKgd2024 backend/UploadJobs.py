@@ -0,0 +1,289 @@
+import itertools
+import multiprocessing
+import pickle
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import Metrics
+
+# Этапы обработки загрузки в порядке выполнения; simulation - только по запросу
+STAGES = ("ingest", "filter", "graph", "simulation")
+
+# Полный граф и слои прошлой загрузки - по ним граф обновляется, а не строится заново
+GRAPH_STATE_PATH = "graph_state.pkl"
+
+
+class JobCancelled(Exception):
+    """Задача отменена между этапами"""
+
+
+class QueueFull(Exception):
+    """Активных задач (в очереди и в работе) уже max_jobs"""
+
+
+class UploadFailed(Exception):
+    """Ошибка обработки загрузки; в отличие от HTTPException переносится из процесса пула"""
+
+
+def process_upload(job_id, uploads, options, progress, cancelled, graph_lock):
+    """
+    Обёртка над _process_upload: ошибки этапов приходят из пула как UploadFailed,
+    метрики процесса пула - в result["metrics"] (их забирает UploadJobs._finish)
+    """
+    started = time.perf_counter()
+    try:
+        result = _process_upload(job_id, uploads, options, progress, cancelled, graph_lock)
+        Metrics.inc("tsodd_worker_busy_seconds_total", time.perf_counter() - started, pool="upload")
+        result["metrics"] = Metrics.collect()
+        return result
+    except JobCancelled:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        raise UploadFailed(getattr(e, "detail", None) or f"{type(e).__name__}: {e}") from None
+
+
+def _process_upload(job_id, uploads, options, progress, cancelled, graph_lock):
+    """
+    Обработка загрузки в процессе пула: чтение слоёв, отбор объектов рядом с ЖК,
+    обновление графа и, если задано options["simulate"], расчёт нагрузки
+
+    Состояние графа одно на сервер, поэтому этапы graph и simulation выполняются
+    под graph_lock: чтение и разбор слоёв у разных задач идут параллельно, а
+    обновления графа и запись trafic.json и route_cache.pkl - по очереди.
+    Отмена проверяется перед каждым этапом, перед записью графа и после каждого
+    здания симуляции; записанный граф при отмене симуляции остаётся.
+
+    Симуляция идёт в пуле потоков внутри процесса задачи, а не в ещё одном пуле
+    процессов. Если зерно не задано, оно выбирается случайно и возвращается в
+    результате: с тем же зерном нагрузка повторяется в любом режиме process_buildings.
+
+    Args:
+        job_id: str - id задачи
+        uploads: list - результат GeojsonService.read_uploads
+        options: dict - full, radius, simulate, seed
+        progress: dict (Manager) - job_id -> {"stage", "stages"}
+        cancelled: dict (Manager) - id отменённых задач
+        graph_lock: Lock (Manager)
+
+    Returns:
+        dict: nodes, edges, changes, а если была симуляция - loaded_edges и seed
+    """
+    # Импорт здесь: модули графа и симуляции нужны только процессам пула
+    import numpy as np
+    import GraphSnapshot
+    import Main_alko
+    from GeojsonService import GeojsonService
+    from IncrementalGraph import GraphState, load_state
+
+    stages = {stage: {"status": "pending", "seconds": None} for stage in STAGES}
+    if not options.get("simulate"):
+        stages["simulation"]["status"] = "skipped"
+
+    def start(stage):
+        if job_id in cancelled:
+            raise JobCancelled(job_id)
+        stages[stage] = {"status": "running", "seconds": None}
+        progress[job_id] = {"stage": stage, "stages": stages}
+        return time.perf_counter()
+
+    def finish(stage, started):
+        stages[stage] = {"status": "done", "seconds": time.perf_counter() - started}
+        progress[job_id] = {"stage": stage, "stages": stages}
+        Metrics.observe("tsodd_upload_stage_seconds", stages[stage]["seconds"], stage=stage)
+
+    service = GeojsonService(options["radius"])
+
+    started = start("ingest")
+    layers = service.layers_from_uploads(uploads)
+    finish("ingest", started)
+
+    started = start("filter")
+    houses = service.merge_houses(layers)
+    buildings = service.add_base_objects(houses, layers)
+    roads = service.add_roads(houses, layers)
+    finish("filter", started)
+
+    started = start("graph")
+    with graph_lock:
+        state = None if options.get("full") else load_state(GRAPH_STATE_PATH)
+        if state is None:
+            state = GraphState.build(buildings, roads)
+            changes = None
+        else:
+            changes = state.update(buildings, roads)
+        if job_id in cancelled:
+            raise JobCancelled(job_id)
+        state.save(GRAPH_STATE_PATH)
+        G = state.graph()
+        Metrics.record_graph(G)
+        with open("graph.pkl", "wb") as f:
+            pickle.dump(G, f)
+        GraphSnapshot.save_snapshot(G)
+    finish("graph", started)
+    result = {
+        "nodes": G.number_of_nodes(),
+        "edges": G.number_of_edges(),
+        "changes": changes,
+    }
+
+    if options.get("simulate"):
+        started = start("simulation")
+        seed = options.get("seed")
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+        with graph_lock:
+            R = GraphSnapshot.load_routing_graph()
+            loads = Main_alko.process_buildings(R, R.typed_nodes(), mode="threads", seed=seed,
+                                                cancelled=lambda: job_id in cancelled)
+        if loads is None:
+            raise JobCancelled(job_id)
+        result["loaded_edges"] = int((loads > 0).sum())
+        result["seed"] = seed
+        finish("simulation", started)
+    return result
+
+
+class Job:
+    def __init__(self, id, options):
+        self.id = id
+        self.options = options
+        self.status = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.future = None
+        self.cancel_requested = False
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+
+class UploadJobs:
+    """
+    Очередь фоновых задач /upload на пуле процессов, без внешних брокеров
+
+    Задача получает id сразу; её этапы выполняются в процессе пула
+    (process_upload), так что цикл событий сервера не блокируется. Ход этапов
+    и флаги отмены передаются через multiprocessing.Manager. Одновременно
+    выполняется не больше workers задач, а всего активных (в очереди и в
+    работе) - не больше max_jobs. Завершённые задачи хранятся в памяти,
+    самые старые сверх keep забываются.
+    """
+
+    def __init__(self, workers=1, max_jobs=8, keep=100):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._manager = None
+        self._broken = False
+
+    def _start(self):
+        # Пул и Manager создаются при первой задаче, а не при импорте Controller
+        if self._executor is not None and self._broken:
+            # Процесс пула упал - следующие задачи идут в новый пул
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._executor is None:
+            self._broken = False
+            if self._manager is None:
+                self._manager = multiprocessing.Manager()
+                self._progress = self._manager.dict()
+                self._cancelled = self._manager.dict()
+                self._graph_lock = self._manager.Lock()
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=Metrics.reset)
+
+    def submit(self, uploads, options):
+        """
+        Ставит загрузку в очередь
+
+        Raises:
+            QueueFull: активных задач уже max_jobs
+
+        Returns:
+            Job
+        """
+        with self._lock:
+            if sum(job.active for job in self.jobs.values()) >= self.max_jobs:
+                raise QueueFull(self.max_jobs)
+            self._start()
+            job = Job(uuid.uuid4().hex, options)
+            self.jobs[job.id] = job
+            self._forget_finished()
+            job.future = self._executor.submit(process_upload, job.id, uploads, options, self._progress,
+                                               self._cancelled, self._graph_lock)
+        job.future.add_done_callback(lambda future: self._finish(job))
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def status(self, job):
+        """Состояние задачи для ответа API: status, stage, stages, error и время"""
+        progress = self._progress.get(job.id) if self._executor is not None else None
+        if job.status == "queued" and progress is not None:
+            job.status = "running"
+        return {
+            "job_id": job.id,
+            "status": "cancelling" if job.active and job.cancel_requested else job.status,
+            "stage": progress["stage"] if progress else None,
+            "stages": progress["stages"] if progress else {},
+            "error": job.error,
+            "created": job.created,
+            "finished": job.finished,
+        }
+
+    def cancel(self, job):
+        """
+        Отменяет задачу: из очереди - сразу, выполняемую - перед следующим этапом или зданием симуляции
+
+        Returns:
+            bool: False, если задача уже завершена
+        """
+        if not job.active:
+            return False
+        job.cancel_requested = True
+        if not job.future.cancel():
+            self._cancelled[job.id] = True
+        return True
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def _finish(self, job):
+        with self._lock:
+            job.finished = time.time()
+            try:
+                job.result = job.future.result()
+                Metrics.merge(job.result.pop("metrics", None))
+                job.status = "done"
+            except (CancelledError, JobCancelled):
+                job.status = "cancelled"
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e) if isinstance(e, UploadFailed) else f"{type(e).__name__}: {e}"
+                if isinstance(e, BrokenProcessPool):
+                    self._broken = True
+            if self._manager is not None:
+                self._cancelled.pop(job.id, None)
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in itertools.islice(finished, max(0, len(finished) - self.keep)):
+            del self.jobs[job_id]
+            self._progress.pop(job_id, None)
@@ -1,78 +1,69 @@
 import geopandas as gpd
 import json
-
-def parse_geo(gdf, load_test_result):
-    # Инициализация списка для удаления дорог
-    delete_roads = []
-    overload_roads = []
-
-    # Поиск и добавление строк, которые удовлетворяют условиям
-    for road in gdf["id"]:
-        if road in load_test_result:
-            if load_test_result[road] < 10:
-                # Преобразование строки GeoDataFrame в формат Feature и добавление в список
-                row = gdf[gdf['id'] == road].iloc[0]  # Получаем строку
-                feature = {
-                    "type": "Feature",
-                    "geometry": row["geometry"].__geo_interface__,  # Преобразование геометрии
-                    "properties": row.drop("geometry").to_dict()  # Преобразование атрибутов
-                }
-                delete_roads.append(feature)
-            elif load_test_result[road] > 800:
-                row = gdf[gdf['id'] == road].iloc[0]  # Получаем строку
-                feature = {
-                    "type": "Feature",
-                    "geometry": row["geometry"].__geo_interface__,  # Преобразование геометрии
-                    "properties": row.drop("geometry").to_dict()  # Преобразование атрибутов
-                }
-                overload_roads.append(feature)
-
-    # Формируем новый GeoJSON с уникальными features
-    merged_geojson = {
-        "type": "FeatureCollection",
-        "features": delete_roads
-    }
-
-    # Преобразуем словарь в GeoDataFrame
-    tmp = gpd.GeoDataFrame.from_features(merged_geojson['features'])
-
-    # Сохраняем результат в GeoJSON файл
-    tmp.to_file('red_roads.geojson', driver='GeoJSON')
-
-    print("GeoJSON файл с удалёнными дорогами создан")
-
-    # Подмножество строк, которые нужно удалить из gdf
-    tmp = gpd.read_file('red_roads.geojson')
-
-    # Используем метод .isin() для фильтрации строк в gdf, которых нет в tmp
-    # Предполагаем, что у вас есть уникальный идентификатор, например, "id"
-    filtered_gdf = gdf[~gdf['id'].isin(tmp['id'])]
-
-    # Формируем новый GeoJSON с уникальными features
-    merged_geojson = {
-        "type": "FeatureCollection",
-        "features": overload_roads
+import os
+import pandas as pd
+
+# Пороги нагрузки: дороги с нагрузкой меньше LOW_LOAD - кандидаты на удаление,
+# больше HIGH_LOAD - перегруженные, остальные (и дороги без нагрузки) - обычные
+LOW_LOAD = 10
+HIGH_LOAD = 800
+
+# Классы дорог и файлы, в которые их записывает write_classes
+CLASS_FILES = {
+    "red": "red_roads.geojson",
+    "overload": "overload_roads.geojson",
+    "grey": "grey_roads.geojson",
+}
+
+
+def classify_roads(gdf, load_test_result, low=LOW_LOAD, high=HIGH_LOAD):
+    """
+    Делит дороги на классы по нагрузке одним проходом
+
+    Нагрузка присоединяется к дорогам по столбцу id одним сопоставлением со
+    словарём нагрузок, классы выбираются масками по порогам.
+
+    Args:
+        gdf: GeoDataFrame - дороги со столбцом id
+        load_test_result: dict - id дороги -> нагрузка (формат trafic.json);
+            ключ None (связи зданий) не относится ни к одной дороге
+        low: float - нагрузка меньше low - класс red
+        high: float - нагрузка больше high - класс overload
+
+    Returns:
+        dict: класс (red, overload, grey) -> GeoDataFrame дорог в исходном порядке
+            со столбцом load (NaN - нагрузки нет)
+    """
+    loads = {road: load for road, load in load_test_result.items() if road is not None}
+    gdf = gdf.assign(load=pd.to_numeric(gdf["id"].map(loads), errors="coerce"))
+    red = (gdf["load"] < low).to_numpy()
+    overload = (gdf["load"] > high).to_numpy() & ~red
+    return {
+        "red": gdf[red],
+        "overload": gdf[overload],
+        "grey": gdf[~red & ~overload],
     }
 
-    # Преобразуем словарь в GeoDataFrame
-    tmp = gpd.GeoDataFrame.from_features(merged_geojson['features'])
-
-    # Сохраняем результат в GeoJSON файл
-    tmp.to_file('overload_roads.geojson', driver='GeoJSON')
-
-    print("GeoJSON файл с перегруженными дорогами создан")
 
-    # Подмножество строк, которые нужно удалить из gdf
-    tmp = gpd.read_file('overload_roads.geojson')
+def write_classes(classes, directory="."):
+    """Записывает классы дорог в GeoJSON-файлы CLASS_FILES (без столбца load)"""
+    for name, roads in classes.items():
+        roads.drop(columns="load").to_file(os.path.join(directory, CLASS_FILES[name]), driver="GeoJSON")
 
-    # Используем метод .isin() для фильтрации строк в gdf, которых нет в tmp
-    # Предполагаем, что у вас есть уникальный идентификатор, например, "id"
-    new_filtered_gdf = filtered_gdf[~filtered_gdf['id'].isin(tmp['id'])]
 
-    # Сохраняем отфильтрованный GeoDataFrame в новый GeoJSON файл
-    new_filtered_gdf.to_file('grey_roads.geojson', driver='GeoJSON')
+def parse_geo(gdf, load_test_result, low=LOW_LOAD, high=HIGH_LOAD, write=True):
+    """
+    Классифицирует дороги по нагрузке (classify_roads) и, если write, пишет
+    red_roads.geojson, overload_roads.geojson и grey_roads.geojson
 
-    print("GeoJSON файл с обычными дорогами создан")
+    Returns:
+        dict: класс -> GeoDataFrame
+    """
+    classes = classify_roads(gdf, load_test_result, low, high)
+    if write:
+        write_classes(classes)
+        print("GeoJSON файлы с удалёнными, перегруженными и обычными дорогами созданы")
+    return classes
 
 
 if __name__ == "__main__":
@@ -81,4 +72,4 @@ if __name__ == "__main__":
     # Чтение файла JSON
     with open('data/loadtest_result.json', 'r', encoding='utf-8') as file:
         load_test_result = json.load(file)
-    parse_geo(gdf, load_test_result)
\ No newline at end of file
+    parse_geo(gdf, load_test_result)
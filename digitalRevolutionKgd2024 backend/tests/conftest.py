@@ -0,0 +1,45 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+# Модули бэкенда лежат плоско в каталоге над tests и импортируются по имени
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Main_alko  # noqa: E402
+import SyntheticCity  # noqa: E402
+from GeojsonService import GeojsonService  # noqa: E402
+from IncrementalGraph import GraphState  # noqa: E402
+from RoutingGraph import RoutingGraph  # noqa: E402
+
+CITY_SIZE = 6  # кварталов по стороне: около 300 зданий, граф строится за доли секунды
+
+
+@pytest.fixture(scope="session")
+def layers():
+    """Здания и дороги синтетического города после отбора, как их получает GraphState"""
+    service = GeojsonService()
+    uploaded = service.layers_from_uploads(SyntheticCity.to_uploads(SyntheticCity.generate_city(CITY_SIZE, seed=0)))
+    houses = service.merge_houses(uploaded)
+    return service.add_base_objects(houses, uploaded), service.add_roads(houses, uploaded)
+
+
+@pytest.fixture(scope="session")
+def route_cache(layers, tmp_path_factory):
+    """Файл RouteCache с маршрутами всех жилых зданий города: поиск маршрутов - самая долгая часть прогона"""
+    path = str(tmp_path_factory.mktemp("routes") / "route_cache.pkl")
+    graph = RoutingGraph.from_networkx(GraphState.build(*layers).graph())
+    Main_alko.load_routes(graph, graph.typed_nodes(), Main_alko.load_population(graph), path)
+    return path
+
+
+@pytest.fixture
+def routing_graph(layers, route_cache, tmp_path, monkeypatch):
+    """
+    RoutingGraph синтетического города; текущий каталог - tmp_path с копией
+    route_cache, так что trafic.json и route_cache.pkl пишутся туда
+    """
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(route_cache, tmp_path / "route_cache.pkl")
+    return RoutingGraph.from_networkx(GraphState.build(*layers).graph())
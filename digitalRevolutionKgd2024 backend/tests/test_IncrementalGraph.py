@@ -0,0 +1,73 @@
+from collections import Counter
+
+import networkx as nx
+import numpy as np
+import pytest
+
+import Graph
+from IncrementalGraph import GraphState
+
+
+def canonical(state):
+    """
+    Граф состояния без id узлов: узлы дорог и зданий названы ключами объектов слоёв
+
+    Новые объекты получают при update другие id, чем при build, поэтому графы
+    сравниваются по ключам объектов (узлы пересечений x_ названы координатами).
+    Концы дорог в одной точке, склеенные ребром нулевой длины, - один узел: к
+    какому из них примкнёт другая дорога, зависит от порядка id.
+
+    Returns:
+        tuple: (множество узлов, Counter рёбер (пара узлов, вес))
+    """
+    names = {}
+    for key, road_id in state.roads.items():
+        if road_id is None:
+            continue
+        names[f"r_{road_id}_start"] = (key, "start")
+        names[f"r_{road_id}_end"] = (key, "end")
+        for offset in state.offsets.get(road_id, ()):
+            names[Graph.road_junction(road_id, offset)] = (key, offset)
+    for key, node in state.buildings.items():
+        if node is not None:
+            names[node] = key
+    G = state.graph()
+    glued = nx.Graph()
+    glued.add_nodes_from(G)
+    glued.add_edges_from((u, v) for u, v, data in G.edges(data=True) if "ids" in data and data["weight"] == 0)
+    merged = {}
+    for component in nx.connected_components(glued):
+        name = frozenset(names.get(node, node) for node in component)
+        merged.update(dict.fromkeys(component, name))
+    edges = Counter((frozenset((merged[u], merged[v])), round(data["weight"], 6))
+                    for u, v, data in G.edges(data=True) if merged[u] != merged[v])
+    return set(merged.values()), edges
+
+
+def without(frame, share, rng):
+    """Слой без случайной доли объектов"""
+    drop = rng.choice(len(frame), size=int(len(frame) * share), replace=False)
+    return frame.drop(index=frame.index[drop])
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_update_matches_build(layers, seed):
+    # build(A) -> update(B) -> update(A) даёт те же графы, что build(B) и build(A)
+    buildings, roads = layers
+    rng = np.random.default_rng(seed)
+    a = without(buildings, 0.1, rng), without(roads, 0.1, rng)
+    b = without(buildings, 0.1, rng), without(roads, 0.1, rng)
+
+    state = GraphState.build(*a)
+    state.update(*b)
+    assert canonical(state) == canonical(GraphState.build(*b))
+    state.update(*a)
+    assert canonical(state) == canonical(GraphState.build(*a))
+
+
+def test_update_without_changes(layers):
+    state = GraphState.build(*layers)
+    before = canonical(state)
+    changes = state.update(*layers)
+    assert not any(changes.values())
+    assert canonical(state) == before
@@ -0,0 +1,34 @@
+import json
+
+import numpy as np
+
+import Main_alko
+
+
+def test_threads_match_processes(routing_graph):
+    # Генератор каждого здания выводится из общего зерна - режим и число исполнителей не важны
+    buildings = routing_graph.typed_nodes()
+    threads = Main_alko.process_buildings(routing_graph, buildings, mode="threads", workers=3, seed=3)
+    processes = Main_alko.process_buildings(routing_graph, buildings, mode="processes", workers=2, chunksize=7,
+                                            seed=3)
+    assert threads.sum() > 0
+    np.testing.assert_array_equal(threads, processes)
+
+
+def test_route_cache_does_not_change_loads(routing_graph):
+    buildings = routing_graph.typed_nodes()
+    fresh = Main_alko.process_buildings(routing_graph, buildings, mode="threads", seed=1, cache_path=None)
+    Main_alko.process_buildings(routing_graph, buildings, mode="threads", seed=2)
+    cached = Main_alko.process_buildings(routing_graph, buildings, mode="threads", seed=1)
+    np.testing.assert_array_equal(fresh, cached)
+
+
+def test_cancelled_run_writes_no_traffic(routing_graph, tmp_path):
+    buildings = routing_graph.typed_nodes()
+    loads = Main_alko.process_buildings(routing_graph, buildings, mode="threads", seed=0, cancelled=lambda: True)
+    assert loads is None
+    assert not (tmp_path / "trafic.json").exists()
+
+    loads = Main_alko.process_buildings(routing_graph, buildings, mode="threads", seed=0)
+    with open(tmp_path / "trafic.json", encoding="utf-8") as file:
+        assert json.load(file) == json.loads(json.dumps(routing_graph.loads_by_id(loads)))
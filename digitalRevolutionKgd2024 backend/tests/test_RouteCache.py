@@ -0,0 +1,104 @@
+import shutil
+
+import numpy as np
+import pytest
+
+import FacilityIndex
+import Main_alko
+from IncrementalGraph import GraphState
+from RouteCache import RouteCache, _edge_key
+from RoutingGraph import RoutingGraph
+
+
+@pytest.fixture
+def city_graph(layers):
+    """Полный nx-граф города - веса рёбер меняются в тестах до перевода в RoutingGraph"""
+    return GraphState.build(*layers).graph()
+
+
+@pytest.fixture
+def cache_path(route_cache, tmp_path):
+    path = tmp_path / "route_cache.pkl"
+    shutil.copy(route_cache, path)
+    return str(path)
+
+
+def with_weights(G, factors):
+    """RoutingGraph по копии G, где вес рёбер (u, v) умножен на factors[(u, v)]"""
+    H = G.copy()
+    for (u, v), factor in factors.items():
+        H.edges[u, v]["weight"] *= factor
+    return RoutingGraph.from_networkx(H)
+
+
+def assert_entries_fresh(cache, graph):
+    # Каждая оставшаяся запись совпадает с маршрутами, найденными заново на новом графе
+    facilities = FacilityIndex.label_nearest_facilities(graph)
+    for building, routes in cache.entries.items():
+        assert Main_alko.building_routes(graph, building, facilities) == routes, building
+
+
+def route_edges(routes):
+    return {_edge_key(u, v) for purpose in Main_alko.PURPOSES for route in routes[purpose][2]
+            for u, v in zip(route, route[1:])}
+
+
+def test_rejected_candidate_edge_invalidates_entry(city_graph, cache_path):
+    # Рёбра отклонённых кандидатов тоже штрафовались поиском: их изменение меняет принятые маршруты
+    graph = RoutingGraph.from_networkx(city_graph)
+    cache = RouteCache(cache_path).load(graph)
+    stale = None
+    for building, (searched, _) in sorted(cache.searches.items()):
+        for edge in sorted(searched - route_edges(cache.entries[building]))[:3]:
+            changed = with_weights(city_graph, {edge: 3.0})
+            fresh = Main_alko.building_routes(changed, building, FacilityIndex.label_nearest_facilities(changed))
+            if fresh != cache.entries[building]:
+                stale = building, changed
+                break
+        if stale is not None:
+            break
+    assert stale is not None, "нет отклонённого ребра, от которого зависят маршруты"
+
+    building, changed = stale
+    reloaded = RouteCache(cache_path).load(changed)
+    assert reloaded.get(building) is None
+    assert reloaded.entries
+    assert_entries_fresh(reloaded, changed)
+
+
+@pytest.mark.parametrize("factor", [0.5, 3.0])
+def test_changed_edges_keep_only_fresh_entries(city_graph, cache_path, factor):
+    rng = np.random.default_rng(0)
+    edges = list(city_graph.edges)
+    picked = [edges[i] for i in rng.choice(len(edges), size=3, replace=False)]
+    changed = with_weights(city_graph, dict.fromkeys(picked, factor))
+
+    cache = RouteCache(cache_path).load(changed)
+    assert cache.invalidated > 0
+    assert cache.entries
+    assert_entries_fresh(cache, changed)
+
+
+def test_save_keeps_entries_of_other_writers(city_graph, cache_path):
+    graph = RoutingGraph.from_networkx(city_graph)
+    first, second = sorted(RouteCache(cache_path).load(graph).entries)[:2]
+
+    # Два прогона начинают без этих зданий и находят по одному из них
+    pruned = RouteCache(cache_path).load(graph)
+    for building in (first, second):
+        del pruned.entries[building]
+        del pruned.searches[building]
+    pruned.dirty = True
+    pruned.save()
+
+    facilities = FacilityIndex.label_nearest_facilities(graph)
+    caches = [RouteCache(cache_path).load(graph), RouteCache(cache_path).load(graph)]
+    for cache, building in zip(caches, (first, second)):
+        searches = {}
+        cache.put(building, Main_alko.building_routes(graph, building, facilities, searches), searches)
+    for cache in caches:
+        cache.save()
+
+    merged = RouteCache(cache_path).load(graph)
+    assert merged.get(first) is not None and merged.get(second) is not None
+    assert first in merged.searches and second in merged.searches
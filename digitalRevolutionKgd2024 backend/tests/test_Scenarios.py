@@ -0,0 +1,24 @@
+import numpy as np
+
+import Main_alko
+from Scenarios import ScenarioEngine
+
+
+def engine_for(graph, seed):
+    population_data = Main_alko.load_population(graph)
+    return ScenarioEngine(graph, population_data, Main_alko.load_routes(graph, graph.typed_nodes(), population_data),
+                          seed=seed)
+
+
+def test_baseline_matches_process_buildings(routing_graph):
+    engine = engine_for(routing_graph, seed=0)
+    expected = Main_alko.process_buildings(routing_graph, routing_graph.typed_nodes(), mode="threads", seed=0)
+    assert expected.sum() > 0
+    np.testing.assert_array_equal(engine.baseline, expected)
+
+
+def test_empty_scenario_keeps_baseline(routing_graph):
+    engine = engine_for(routing_graph, seed=4)
+    result = engine.apply([])
+    np.testing.assert_array_equal(result["loads"], engine.baseline)
+    assert not np.any(result["delta"])
@@ -0,0 +1,29 @@
+import numpy as np
+
+import Main_alko
+import TimeOfDay
+
+
+def test_purpose_loads_sum_to_process_buildings(routing_graph):
+    buildings = routing_graph.typed_nodes()
+    expected = Main_alko.process_buildings(routing_graph, buildings, mode="threads", seed=5)
+    population_data = Main_alko.load_population(routing_graph)
+    routes = Main_alko.load_routes(routing_graph, buildings, population_data)
+    entropy = np.random.SeedSequence(5).entropy
+
+    loads = TimeOfDay.purpose_loads(routing_graph, buildings, population_data, routes, entropy)
+    assert loads.shape == (routing_graph.num_edges, len(Main_alko.PURPOSES))
+    np.testing.assert_array_equal(loads.sum(axis=1), expected)
+
+
+def test_buckets_sum_to_process_buildings(routing_graph):
+    buildings = routing_graph.typed_nodes()
+    expected = Main_alko.process_buildings(routing_graph, buildings, mode="threads", seed=5)
+    population_data = Main_alko.load_population(routing_graph)
+
+    for bucket_hours in (1, 3):
+        loads = TimeOfDay.time_of_day_loads(routing_graph, buildings, population_data, seed=5,
+                                            bucket_hours=bucket_hours)
+        assert loads.shape == (routing_graph.num_edges, 24 // bucket_hours)
+        # Профили отправлений в сумме дают 1, нагрузка интервалов хранится во float32
+        np.testing.assert_allclose(loads.sum(axis=1), expected, rtol=1e-5, atol=1e-3)